@@ -0,0 +1,11 @@
+#! /usr/bin/python3.8 Python3.8
+import os
+from pathlib import Path
+import sys
+
+
+sys.path.append(
+    os.path.join(
+        Path(os.path.dirname(os.path.abspath(__file__))),
+    )
+)
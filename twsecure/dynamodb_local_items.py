@@ -1,16 +1,19 @@
 import json
 
 
-def generate_put_items(table_names):
+def generate_put_items(table_names, key_type='S'):
     return {
-        table_names['transactions']: generate_transaction_items(),
+        table_names['transactions']: generate_transaction_items(key_type),
     }
 
 
-def generate_transaction_items():
+def generate_transaction_items(key_type='S'):
+    transaction_hash = 'abc123abc123abc123abc123abc123ab'
+
     return [
         {
-            'transaction-hash': {'S': 'abc123abc123abc123abc123abc123ab'},
+            'transaction-hash': {'B': bytes.fromhex(transaction_hash)}
+            if key_type == 'B' else {'S': transaction_hash},
             'details': {'S': json.dumps({
                 'account': 'Dummy',
                 'currency': 'USD',
@@ -1,6 +1,7 @@
 #!/.env/bin/python Python3
 import json
 import logging
+import os
 
 import boto3
 import botocore
@@ -12,6 +13,10 @@ from dynamodb_local_items import generate_put_items
 log = logging.getLogger()
 logging.basicConfig(level=logging.INFO)
 
+# Same as the monitor function: "S" (hexadecimal) or "B" (binary) hash keys
+TRANSACTION_KEY_TYPE = os.environ.get('TRANSACTION_KEY_TYPE', 'S')
+ATTRIBUTE_TYPES = ('S', 'N', 'B')
+
 
 def setup(port, tables,  put_items):
     log.info('## Starting setup of local DynamoDB...')
@@ -49,8 +54,14 @@ def setup(port, tables,  put_items):
 
 
 def convert_table_schema(table: dict):
+    '''Convert a schema such as {'transaction-hash': 'B,HASH'} to the
+    CreateTable arguments'''
     schema = table['schema'].items()
 
+    for attr, typ in schema:
+        if typ.split(',')[0] not in ATTRIBUTE_TYPES:
+            raise ValueError(f'Unsupported type for "{attr}": {typ}')
+
     return {
         'TableName': table['name'],
         'BillingMode': 'PAY_PER_REQUEST',
@@ -90,7 +101,7 @@ if __name__ == '__main__':
         {
             'name': transactions_table_name,
             'schema': {
-                'transaction-hash': 'S,HASH',
+                'transaction-hash': f'{TRANSACTION_KEY_TYPE},HASH',
             },
         },
     ]
@@ -98,6 +109,7 @@ if __name__ == '__main__':
     # Specify items that should be inserted in DynamoDB local tables
     put_items = generate_put_items(
         table_names={'transactions': transactions_table_name},
+        key_type=TRANSACTION_KEY_TYPE,
     )
 
     # Run the DynamoDB setup routine
@@ -0,0 +1,173 @@
+#!/usr/bin/python3 Python3
+'''Backlog of new transactions beyond the per-run write budget
+
+A run stores at most MAX_NEW_TRANSACTIONS_PER_EXECUTION new transactions;
+the others are persisted and stored first by the following runs, which keeps
+each run short on a busy day without losing alerts. The backlog is an item
+of the state table or, without one (local runs), a spill file.
+'''
+from collections import namedtuple
+import json
+import logging
+import os
+import zlib
+from typing import List, Optional, Tuple, TYPE_CHECKING
+
+import aws_clients
+
+from datetime_routines import calculate_dynamodb_ttl
+from state_keys import tenant_key, tenant_path
+from transaction_record import TransactionRecord
+
+if TYPE_CHECKING:
+    import botocore  # NOQA
+
+
+log = logging.getLogger(os.environ.get('LOGGER_NAME', 'MONITOR_LOGGER'))
+
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME')
+# Zero (or less) stores every new transaction in the same run
+MAX_NEW_TRANSACTIONS_PER_EXECUTION = int(os.environ.get('MAX_NEW_TRANSACTIONS_PER_EXECUTION', 10))  # NOQA
+BACKLOG_SPILL_PATH = os.environ.get(
+    'BACKLOG_SPILL_PATH', '/tmp/twsecure-monitor-backlog.json')
+# Past the transactions TTL, backlogged debits are too old to be worth alerting
+BACKLOG_TTL_IN_DAYS = int(os.environ.get('DYNAMODB_TTL_IN_DAYS', 7))
+
+BACKLOG_KEY = {'pk': {'S': 'monitor-backlog'}, 'sk': {'S': 'default'}}
+
+backlog_store = namedtuple('backlog_store', 'load save')
+
+
+def serialize(transactions: List[TransactionRecord]) -> str:
+    # Records are flat tuples: rows are shorter than field-named objects
+    return json.dumps([list(t) for t in transactions])
+
+
+def deserialize(text: str) -> List[TransactionRecord]:
+    return [TransactionRecord(*row) for row in json.loads(text)]
+
+
+def file_backlog_store(path: str = BACKLOG_SPILL_PATH) -> backlog_store:
+    '''Backlog spilled to a local file, for runs without a state table'''
+    def load() -> List[TransactionRecord]:
+        if not os.path.exists(path):
+            return []
+
+        with open(path) as file:
+            return deserialize(file.read())
+
+    def save(transactions: List[TransactionRecord]) -> None:
+        if len(transactions) == 0:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+
+        # Replacing the file is atomic: a crash never leaves a partial backlog
+        temp_path = f'{path}.tmp'
+
+        with open(temp_path, 'w') as file:
+            file.write(serialize(transactions))
+
+        os.replace(temp_path, path)
+
+    return backlog_store(load=load, save=save)
+
+
+def dynamodb_backlog_store(
+    table_name: str = STATE_TABLE_NAME,
+    client: Optional['botocore.client.BaseClient'] = None,
+    ttl_in_days: int = BACKLOG_TTL_IN_DAYS,
+    key: dict = BACKLOG_KEY,
+) -> backlog_store:
+    '''Backlog kept in a single, compressed state table item'''
+    if client is None:
+        client = aws_clients.get_client('dynamodb')
+
+    def load() -> List[TransactionRecord]:
+        response = client.get_item(
+            TableName=table_name,
+            Key=key,
+            ConsistentRead=True,
+        )
+
+        item = response.get('Item')
+
+        if not item:
+            return []
+
+        return deserialize(
+            zlib.decompress(bytes(item['transactions']['B'])).decode('utf-8'))
+
+    def save(transactions: List[TransactionRecord]) -> None:
+        if len(transactions) == 0:
+            client.delete_item(TableName=table_name, Key=key)
+            return
+
+        ttl = calculate_dynamodb_ttl(delta_period={'days': ttl_in_days})
+        data = zlib.compress(serialize(transactions).encode('utf-8'))
+
+        client.put_item(
+            TableName=table_name,
+            Item={
+                **key,
+                # Compressed to stay well within the 400 KB item size limit
+                'transactions': {'B': data},
+                'count': {'N': str(len(transactions))},
+                'ttl': {'N': str(ttl)},
+            },
+        )
+
+    return backlog_store(load=load, save=save)
+
+
+def get_backlog_store(
+    table_name: Optional[str] = STATE_TABLE_NAME,
+    tenant: Optional[str] = None,
+) -> backlog_store:
+    if table_name:
+        return dynamodb_backlog_store(
+            table_name=table_name,
+            key=tenant_key(BACKLOG_KEY, tenant),
+        )
+
+    return file_backlog_store(path=tenant_path(BACKLOG_SPILL_PATH, tenant))
+
+
+def merge_backlog(
+    backlog: List[TransactionRecord],
+    transactions: List[TransactionRecord],
+) -> List[TransactionRecord]:
+    '''Backlogged transactions first, then those not already backlogged'''
+    merged = {}
+
+    for transaction in backlog + transactions:
+        merged.setdefault(transaction.transaction_hash, transaction)
+
+    return list(merged.values())
+
+
+def split_budget(
+    transactions: List[TransactionRecord],
+    budget: int = MAX_NEW_TRANSACTIONS_PER_EXECUTION,
+) -> Tuple[List[TransactionRecord], List[TransactionRecord]]:
+    '''Split transactions into those to store now and those to backlog'''
+    if budget <= 0:
+        return transactions, []
+
+    return transactions[:budget], transactions[budget:]
+
+
+def save_backlog(
+    store: backlog_store,
+    transactions: List[TransactionRecord],
+    previous_count: int,
+) -> None:
+    '''Persist the backlog, skipping the write when it stays empty'''
+    if len(transactions) == 0 and previous_count == 0:
+        return
+
+    if len(transactions) > 0:
+        log.warning(f'## Backlogging {len(transactions)} transactions over '
+                    'the write budget')
+
+    store.save(transactions)
@@ -0,0 +1,195 @@
+#!/usr/bin/python3 Python3
+'''Checkpoint of a monitoring cycle interrupted before fetching everything
+
+A cycle fetches one statement per (profile, account, currency, interval
+slice) unit. When a run ends before fetching every unit (the invocation
+deadline got near, or the run failed), the checkpoint keeps the cycle time
+interval and the units already fetched and committed: the next run resumes
+the same cycle from the first incomplete unit, instead of starting over.
+A long backfill window becomes a series of bounded, restartable runs.
+
+The checkpoint is an item of the state table or, without one (local runs),
+a local file. It is cleared once a cycle completes.
+'''
+from collections import namedtuple
+import datetime
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, Optional, TYPE_CHECKING
+
+import aws_clients
+
+from datetime_routines import calculate_dynamodb_ttl, str_to_utc, utc_to_str
+from state_keys import tenant_key, tenant_path
+
+if TYPE_CHECKING:
+    import botocore  # NOQA
+
+
+log = logging.getLogger(os.environ.get('LOGGER_NAME', 'MONITOR_LOGGER'))
+
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME')
+CHECKPOINT_PATH = os.environ.get(
+    'CHECKPOINT_PATH', '/tmp/twsecure-monitor-checkpoint.json')
+# An abandoned cycle is not resumed past the transactions TTL
+CHECKPOINT_TTL_IN_DAYS = int(os.environ.get('DYNAMODB_TTL_IN_DAYS', 7))
+
+CHECKPOINT_KEY = {'pk': {'S': 'monitor-checkpoint'}, 'sk': {'S': 'default'}}
+
+monitor_checkpoint = namedtuple('monitor_checkpoint', [
+    'interval',  # Time interval of the cycle, kept by the resuming runs
+    'done_units',  # Units whose statement was fetched and committed
+])
+
+checkpoint_store = namedtuple('checkpoint_store', 'load save clear')
+
+
+def statement_unit(
+        profile_id: str,
+        account_id: str,
+        currency: str,
+        interval_slice: Dict[str, datetime.datetime],
+        ) -> str:
+    '''Key of the statement fetched for a balance over an interval slice'''
+    start = utc_to_str(interval_slice['start'])
+
+    return f'{profile_id}/{account_id}/{currency}/{start}'
+
+
+def serialize(checkpoint: monitor_checkpoint) -> str:
+    return json.dumps({
+        'start': utc_to_str(checkpoint.interval['start']),
+        'end': utc_to_str(checkpoint.interval['end']),
+        'done_units': sorted(checkpoint.done_units),
+    })
+
+
+def deserialize(text: str) -> monitor_checkpoint:
+    data = json.loads(text)
+
+    return monitor_checkpoint(
+        interval={
+            'start': str_to_utc(data['start']),
+            'end': str_to_utc(data['end']),
+        },
+        done_units=frozenset(data['done_units']),
+    )
+
+
+def file_checkpoint_store(path: str = CHECKPOINT_PATH) -> checkpoint_store:
+    '''Checkpoint kept in a local file, for runs without a state table'''
+    def load() -> Optional[monitor_checkpoint]:
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as file:
+            return deserialize(file.read())
+
+    def save(checkpoint: monitor_checkpoint) -> None:
+        # Replacing the file is atomic: a crash never leaves a partial one
+        temp_path = f'{path}.tmp'
+
+        with open(temp_path, 'w') as file:
+            file.write(serialize(checkpoint))
+
+        os.replace(temp_path, path)
+
+    def clear() -> None:
+        if os.path.exists(path):
+            os.remove(path)
+
+    return checkpoint_store(load=load, save=save, clear=clear)
+
+
+def dynamodb_checkpoint_store(
+    table_name: str = STATE_TABLE_NAME,
+    client: Optional['botocore.client.BaseClient'] = None,
+    ttl_in_days: int = CHECKPOINT_TTL_IN_DAYS,
+    key: dict = CHECKPOINT_KEY,
+    now: Callable = time.time,
+) -> checkpoint_store:
+    '''Checkpoint kept in a single state table item'''
+    if client is None:
+        client = aws_clients.get_client('dynamodb')
+
+    def load() -> Optional[monitor_checkpoint]:
+        response = client.get_item(
+            TableName=table_name,
+            Key=key,
+            ConsistentRead=True,
+        )
+
+        item = response.get('Item')
+
+        if not item:
+            return None
+
+        # DynamoDB deletes expired items only eventually: the cycle of an
+        # expired checkpoint was abandoned
+        if int(item['ttl']['N']) <= now():
+            return None
+
+        return deserialize(item['checkpoint']['S'])
+
+    def save(checkpoint: monitor_checkpoint) -> None:
+        ttl = calculate_dynamodb_ttl(delta_period={'days': ttl_in_days})
+
+        client.put_item(
+            TableName=table_name,
+            Item={
+                **key,
+                'checkpoint': {'S': serialize(checkpoint)},
+                'count': {'N': str(len(checkpoint.done_units))},
+                'ttl': {'N': str(ttl)},
+            },
+        )
+
+    def clear() -> None:
+        client.delete_item(TableName=table_name, Key=key)
+
+    return checkpoint_store(load=load, save=save, clear=clear)
+
+
+def get_checkpoint_store(
+    table_name: Optional[str] = STATE_TABLE_NAME,
+    tenant: Optional[str] = None,
+) -> checkpoint_store:
+    if table_name:
+        return dynamodb_checkpoint_store(
+            table_name=table_name,
+            key=tenant_key(CHECKPOINT_KEY, tenant),
+        )
+
+    return file_checkpoint_store(path=tenant_path(CHECKPOINT_PATH, tenant))
+
+
+def save_checkpoint(
+    store: checkpoint_store,
+    interval: Dict[str, datetime.datetime],
+    done_units: Iterable[str],
+    complete: bool,
+    previous: Optional[monitor_checkpoint],
+) -> None:
+    '''Persist the progress of a cycle, or clear it once the cycle completes
+
+    Called only after the fetched transactions were committed (stored or
+    backlogged), every few units: a run failing in between leaves the last
+    checkpoint as is.
+    '''
+    if complete:
+        if previous is not None:
+            log.info('## Monitoring cycle completed: clearing the checkpoint')
+            store.clear()
+        return
+
+    done_units = frozenset(done_units)
+
+    if previous is not None and previous.done_units == done_units:
+        return
+
+    log.info(f'## Monitoring cycle in progress: checkpoint of '
+             f'{len(done_units)} units')
+
+    store.save(monitor_checkpoint(interval=interval, done_units=done_units))
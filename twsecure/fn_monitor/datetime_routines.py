@@ -1,7 +1,7 @@
 #!/usr/bin/python3 Python3
 import calendar
 import datetime
-from typing import Dict
+from typing import Dict, List, Optional
 
 
 DEFAULT_DATETIME_STR_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
@@ -14,6 +14,14 @@ def utc_to_str(
     return dt.strftime(datetime_str_format)
 
 
+def str_to_utc(
+        text: str,
+        datetime_str_format: str = DEFAULT_DATETIME_STR_FORMAT,
+        ) -> datetime.datetime:
+    return datetime.datetime.strptime(text, datetime_str_format).replace(
+        tzinfo=datetime.timezone.utc)
+
+
 def last_delta_interval(
         delta_period: dict,
         now: datetime.datetime = None,
@@ -34,6 +42,26 @@ def last_24_hours_interval(
     return last_delta_interval(delta_period={'hours': 24}, timezone=timezone)
 
 
+def interval_slices(
+        interval: Dict[str, datetime.datetime],
+        slice_period: Optional[dict] = None,
+        ) -> List[Dict[str, datetime.datetime]]:
+    '''Split an interval in consecutive slices of (at most) slice_period'''
+    if not slice_period:
+        return [interval]
+
+    step = datetime.timedelta(**slice_period)
+    slices = []
+    start = interval['start']
+
+    while start < interval['end']:
+        end = min(start + step, interval['end'])
+        slices.append({'start': start, 'end': end})
+        start = end
+
+    return slices
+
+
 def calculate_dynamodb_ttl(delta_period: Dict[str, int]) -> int:
     future = datetime.datetime.utcnow() + datetime.timedelta(**delta_period)
     return calendar.timegm(future.timetuple())
@@ -1,83 +1,171 @@
 #!/usr/bin/python3 Python3
 from collections import namedtuple
+import datetime
 from functools import partial
-import json
 import logging
 import os
-from typing import Callable, List, NamedTuple, Optional
-
-import botocore
-
-from datetime_routines import calculate_dynamodb_ttl
+from typing import (
+    Callable,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    TYPE_CHECKING,
+)
+
+from datetime_routines import calculate_dynamodb_ttl, str_to_utc
 import simple_dynamodb as simple_ddb
+from transaction_record import (
+    attribute_hash,
+    key_attribute,
+    KeyType,
+    to_dynamodb_item,
+    TransactionRecord,
+)
+
+if TYPE_CHECKING:
+    import botocore  # NOQA
 
 
 log = logging.getLogger(os.environ.get('LOGGER_NAME', 'MONITOR_LOGGER'))
 
 TRANSACTIONS_TABLE_NAME = os.environ.get('TRANSACTIONS_TABLE_NAME')
 DYNAMODB_TTL_IN_DAYS = int(os.environ.get('DYNAMODB_TTL_IN_DAYS', 7))
-MAX_NEW_TRANSACTIONS_PER_EXECUTION = int(os.environ.get('MAX_NEW_TRANSACTIONS_PER_EXECUTION', 10))  # NOQA
 
+# "S" (hexadecimal string) or "B" (binary) transaction-hash keys; the key type
+# is fixed when a table is created
+TRANSACTION_KEY_TYPE = os.environ.get('TRANSACTION_KEY_TYPE', KeyType.STRING)
+# String-keyed table also looked up while migrating to a binary-keyed one
+LEGACY_TRANSACTIONS_TABLE_NAME = \
+    os.environ.get('LEGACY_TRANSACTIONS_TABLE_NAME') or None
+# UTC time ('%Y-%m-%dT%H:%M:%SZ') after which every transaction of the legacy
+# table has expired (switch time + TTL): it is no longer looked up
+LEGACY_TRANSACTIONS_UNTIL = os.environ.get('LEGACY_TRANSACTIONS_UNTIL') or None
 
-def filter_new_transactions(
+
+def legacy_lookup_active(
+    until: Optional[str] = LEGACY_TRANSACTIONS_UNTIL,
+    now: Optional[datetime.datetime] = None,
+) -> bool:
+    '''Whether the legacy table may still hold unexpired transactions'''
+    if not until:
+        return True
+
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+    return now < str_to_utc(until)
+
+
+def lookup_hashes(
     batch_get: Callable,
-    transactions: List[dict],
-) -> List[dict]:
-    '''Filter a list of transactions and return those not yet in the DB'''
+    hashes: Iterable[str],
+    key_type: str = TRANSACTION_KEY_TYPE,
+) -> Set[str]:
+    '''Return which of the transaction hashes are stored in a table'''
     items = batch_get(
         keys=[
-            {'transaction-hash': {'S': t['transaction-hash']}}
-            for t in transactions
+            {'transaction-hash': key_attribute(transaction_hash, key_type)}
+            for transaction_hash in hashes
         ]
     )
 
-    transactions_in_db = [
-        item['transaction-hash']['S']
+    return {
+        attribute_hash(item['transaction-hash'])
         for item in items
-    ]
+    }
+
+
+def filter_new_transactions(
+    batch_get: Callable,
+    transactions: List[TransactionRecord],
+    key_type: str = TRANSACTION_KEY_TYPE,
+    legacy_batch_get: Optional[Callable] = None,
+) -> List[TransactionRecord]:
+    '''Filter a list of transactions and return those not yet in the DB
+
+    Transactions stored under their legacy fingerprint count as known, as do
+    those stored in the legacy (string-keyed) table while migrating to
+    binary keys.
+    '''
+    hashes = dict.fromkeys(
+        transaction_hash
+        for t in transactions
+        for transaction_hash in (t.transaction_hash, t.legacy_hash)
+        if transaction_hash is not None
+    )
+
+    transactions_in_db = lookup_hashes(batch_get, hashes, key_type=key_type)
+
+    if legacy_batch_get is not None:
+        transactions_in_db |= lookup_hashes(
+            legacy_batch_get,
+            [h for h in hashes if h not in transactions_in_db],
+            key_type=KeyType.STRING,
+        )
 
     return [
         transaction
         for transaction in transactions
-        if transaction['transaction-hash'] not in transactions_in_db
+        if transaction.transaction_hash not in transactions_in_db
+        if transaction.legacy_hash not in transactions_in_db
     ]
 
 
 def insert_transactions(
-    transactions: List[dict],
+    transactions: List[TransactionRecord],
     batch_put: Callable,
-    max_queue_size: int = MAX_NEW_TRANSACTIONS_PER_EXECUTION,
     ttl_in_days: int = DYNAMODB_TTL_IN_DAYS,
-) -> dict:
+    key_type: str = TRANSACTION_KEY_TYPE,
+) -> List[TransactionRecord]:
+    '''Store transactions, returning those left unprocessed (not stored)'''
     ttl = calculate_dynamodb_ttl(delta_period={'days': ttl_in_days})
 
-    return batch_put(
+    response = batch_put(
         items=[
-            {
-                'transaction-hash': {'S': t['transaction-hash']},
-                'details': {'S': json.dumps(t['details'])},
-                'ttl': {'N': str(ttl)},
-            }
+            to_dynamodb_item(t, ttl=ttl, key_type=key_type)
             for t in transactions
         ],
-        max_queue_size=max_queue_size,
     )
 
+    unprocessed_hashes = {
+        attribute_hash(item['transaction-hash'])
+        for item in response.unprocessed_items
+    }
+
+    return [
+        transaction
+        for transaction in transactions
+        if transaction.transaction_hash in unprocessed_hashes
+    ]
+
 
 def query_batch_get(
     keys: List[str],
     ddb_api: NamedTuple,
     table_name: str,
+    batch_size: int = simple_ddb.BATCH_GET_MAX_SIZE,
 ) -> List[dict]:
-    response = ddb_api.batch_get(keys=keys)
-    return response['Responses'][table_name]
+    items = []
+
+    # BatchGetItem accepts a limited number of keys per request
+    for index in range(0, len(keys), batch_size):
+        response = ddb_api.batch_get(keys=keys[index:index + batch_size])
+        items.extend(response['Responses'][table_name])
+
+    return items
 
 
 def query(
     table_name: str = TRANSACTIONS_TABLE_NAME,
-    client: Optional[botocore.client.BaseClient] = None,
+    client: Optional['botocore.client.BaseClient'] = None,
     ddb_api: Optional[NamedTuple] = None,
     query_batch_get: Optional[Callable] = query_batch_get,
+    key_type: str = TRANSACTION_KEY_TYPE,
+    legacy_table_name: Optional[str] = LEGACY_TRANSACTIONS_TABLE_NAME,
+    legacy_ddb_api: Optional[NamedTuple] = None,
+    legacy_until: Optional[str] = LEGACY_TRANSACTIONS_UNTIL,
 ):
     query = namedtuple('query', 'filter_new insert')
 
@@ -93,14 +181,32 @@ def query(
         ddb_api=ddb_api,
     )
 
+    legacy_batch_get = None
+
+    if legacy_table_name and legacy_lookup_active(until=legacy_until):
+        if not legacy_ddb_api:
+            legacy_ddb_api = simple_ddb.get_table_operations(
+                table_name=legacy_table_name,
+                client=client,
+            )
+
+        legacy_batch_get = partial(
+            query_batch_get,
+            table_name=legacy_table_name,
+            ddb_api=legacy_ddb_api,
+        )
+
     filter_new = partial(
         filter_new_transactions,
         batch_get=batch_get,
+        key_type=key_type,
+        legacy_batch_get=legacy_batch_get,
     )
 
     insert = partial(
         insert_transactions,
         batch_put=ddb_api.batch_put,
+        key_type=key_type,
     )
 
     return query(
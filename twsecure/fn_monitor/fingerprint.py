@@ -0,0 +1,104 @@
+#!/usr/bin/python3 Python3
+'''Transaction fingerprints, identifying a debit across monitor runs
+
+TransferWise's own reference number identifies a debit when the statement
+has one; otherwise the transaction fields (including its date, so that two
+debits of the same amount to the same payee stay distinct) are encoded into
+canonical, length-prefixed bytes. Either key is hashed with blake2b.
+
+The "legacy" fingerprint is the md5 of the details JSON, which the monitor
+stored before. While FINGERPRINT_LEGACY_LOOKUP is on, it is also computed so
+that transactions stored under it are still recognized.
+'''
+import hashlib
+import json
+import os
+from typing import List
+
+from transaction_record import record_details, TransactionRecord
+
+
+class FingerprintAlgorithm():
+    BLAKE2B = 'blake2b'
+    LEGACY = 'legacy'
+
+
+TRANSACTION_FINGERPRINT = os.environ.get(
+    'TRANSACTION_FINGERPRINT', FingerprintAlgorithm.BLAKE2B)
+# Digest size in bytes (hexadecimal fingerprints are twice as long)
+FINGERPRINT_DIGEST_SIZE = int(os.environ.get('FINGERPRINT_DIGEST_SIZE', 16))
+# Stored legacy fingerprints expire with the table TTL, after which this can
+# be turned off
+FINGERPRINT_LEGACY_LOOKUP = \
+    os.environ.get('FINGERPRINT_LEGACY_LOOKUP', 'true') == 'true'
+
+# Distinguishes these digests from any other blake2b use of the same bytes
+FINGERPRINT_PERSON = b'twsecure-txn'
+
+
+def md5(data: str) -> str:
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
+def legacy_fingerprint(record: TransactionRecord) -> str:
+    return md5(json.dumps(record_details(record)))
+
+
+def canonical_key(record: TransactionRecord) -> bytes:
+    '''Unambiguous byte encoding of what identifies a transaction'''
+    if record.reference:
+        fields = ('ref', record.currency, record.reference)
+    else:
+        fields = (
+            'txn',
+            record.account,
+            record.currency,
+            str(record.value_minor),
+            record.payee,
+            record.timestamp or '',
+        )
+
+    return b''.join(
+        len(encoded).to_bytes(4, 'big') + encoded
+        for encoded in (field.encode('utf-8') for field in fields)
+    )
+
+
+def hash_transactions(
+    transactions: List[TransactionRecord],
+    algorithm: str = TRANSACTION_FINGERPRINT,
+    digest_size: int = FINGERPRINT_DIGEST_SIZE,
+    legacy_lookup: bool = FINGERPRINT_LEGACY_LOOKUP,
+) -> List[TransactionRecord]:
+    '''Fill in the fingerprints of a list of records
+
+    A single blake2b state is parametrized up front and copied for each
+    record, instead of setting up a new hash per transaction.
+    '''
+    if algorithm == FingerprintAlgorithm.LEGACY:
+        return [
+            t._replace(transaction_hash=legacy_fingerprint(t))
+            for t in transactions
+        ]
+
+    if algorithm != FingerprintAlgorithm.BLAKE2B:
+        raise ValueError(f'Unknown fingerprint algorithm: {algorithm}')
+
+    prototype = hashlib.blake2b(
+        digest_size=digest_size,
+        person=FINGERPRINT_PERSON,
+    )
+
+    hashed = []
+
+    for transaction in transactions:
+        digest = prototype.copy()
+        digest.update(canonical_key(transaction))
+
+        hashed.append(transaction._replace(
+            transaction_hash=digest.hexdigest(),
+            legacy_hash=legacy_fingerprint(transaction)
+            if legacy_lookup else None,
+        ))
+
+    return hashed
@@ -0,0 +1,323 @@
+#!/usr/bin/python3 Python3
+'''Lease keeping monitor runs from overlapping
+
+The schedule may start a run while the previous one is still going (e.g. on
+a slow API day): both would fetch the same statements and race through
+filter_new/insert. A run first acquires the lease, an item of the state
+table written conditionally with its owner id and expiration. A heartbeat
+extends it while the run goes on, and it is released when the run ends.
+A lease left expired by a failed run is taken over.
+
+A run whose lease is lost (taken over, or not renewed in time) stops: it
+checks "lost" before fetching more statements and before each commit.
+
+On a lease held by another run, MONITOR_LEASE_MODE decides:
+  - "skip": the run ends right away, the next scheduled run catches up
+  - "wait": the run waits up to MONITOR_LEASE_WAIT_SECONDS for the lease
+  - "off": no lease is used
+Without a state table (local runs), the lease only covers the process.
+'''
+from collections import namedtuple
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+from typing import Callable, Iterator, Optional, TYPE_CHECKING
+import uuid
+
+import aws_clients
+import deadline
+import metrics
+
+if TYPE_CHECKING:
+    import botocore  # NOQA
+
+
+log = logging.getLogger(os.environ.get('LOGGER_NAME', 'MONITOR_LOGGER'))
+
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME')
+MONITOR_LEASE_MODE = os.environ.get('MONITOR_LEASE_MODE', 'skip')
+# Longer than a heartbeat interval, short enough for a failed run's lease to
+# be taken over by the next scheduled one
+MONITOR_LEASE_DURATION = float(
+    os.environ.get('MONITOR_LEASE_DURATION_SECONDS', 60))
+MONITOR_LEASE_WAIT = float(os.environ.get('MONITOR_LEASE_WAIT_SECONDS', 30))
+MONITOR_LEASE_POLL_INTERVAL = float(
+    os.environ.get('MONITOR_LEASE_POLL_INTERVAL_SECONDS', 1))
+
+LEASE_MODES = ('skip', 'wait', 'off')
+LEASE_KEY = {'pk': {'S': 'monitor-lease'}, 'sk': {'S': 'default'}}
+
+# Leases of the process, by key: the local stand-in of the state table
+LEASES = {}
+LEASES_LOCK = threading.Lock()
+
+# Set by the heartbeat once the lease of the running invocation is lost
+CURRENT = {'lost': threading.Event()}
+
+monitor_lease = namedtuple('monitor_lease', 'acquire renew release')
+
+
+class LeaseLostException(Exception):
+    pass
+
+
+def lost(current: dict = CURRENT) -> bool:
+    '''Whether the running invocation lost its lease to another run'''
+    return current['lost'].is_set()
+
+
+def memory_lease(
+    duration: float = MONITOR_LEASE_DURATION,
+    state: dict = LEASES,
+    now: Callable = time.time,
+) -> monitor_lease:
+    '''Local stand-in for the lease, only covering the running process'''
+    key = 'monitor-lease'
+
+    def acquire(owner: str) -> bool:
+        timestamp = now()
+
+        with LEASES_LOCK:
+            holder = state.get(key)
+
+            if holder is not None and holder[0] != owner and \
+                    holder[1] > timestamp:
+                return False
+
+            state[key] = (owner, timestamp + duration)
+            return True
+
+    def renew(owner: str) -> bool:
+        with LEASES_LOCK:
+            holder = state.get(key)
+
+            if holder is None or holder[0] != owner:
+                return False
+
+            state[key] = (owner, now() + duration)
+            return True
+
+    def release(owner: str) -> None:
+        with LEASES_LOCK:
+            if state.get(key, (None,))[0] == owner:
+                del state[key]
+
+    return monitor_lease(acquire=acquire, renew=renew, release=release)
+
+
+def dynamodb_lease(
+    table_name: str = STATE_TABLE_NAME,
+    client: Optional['botocore.client.BaseClient'] = None,
+    duration: float = MONITOR_LEASE_DURATION,
+    now: Callable = time.time,
+) -> monitor_lease:
+    '''Lease shared by all containers, backed by conditional writes
+
+    Only one owner at a time gets its put through: the lease is written if
+    absent, expired, or already held by the same owner.
+    '''
+    if client is None:
+        client = aws_clients.get_client('dynamodb')
+
+    from botocore.exceptions import ClientError
+
+    def put(owner: str, condition: str, values: Callable) -> bool:
+        timestamp = now()
+        expires_at = timestamp + duration
+
+        try:
+            client.put_item(
+                TableName=table_name,
+                Item={
+                    **LEASE_KEY,
+                    'owner': {'S': owner},
+                    'expires_at': {'N': f'{expires_at:.3f}'},
+                    # Cleans up leases of runs that failed to release them
+                    'ttl': {'N': str(int(expires_at) + 3600)},
+                },
+                ConditionExpression=condition,
+                ExpressionAttributeNames={'#owner': 'owner'},
+                ExpressionAttributeValues={
+                    ':owner': {'S': owner},
+                    **values(timestamp),
+                },
+            )
+
+        except ClientError as exc:
+            if exc.response['Error']['Code'] != \
+                    'ConditionalCheckFailedException':
+                raise
+
+            return False
+
+        return True
+
+    def acquire(owner: str) -> bool:
+        return put(
+            owner,
+            condition='attribute_not_exists(pk) OR expires_at < :now OR '
+                      '#owner = :owner',
+            values=lambda timestamp: {':now': {'N': f'{timestamp:.3f}'}},
+        )
+
+    def renew(owner: str) -> bool:
+        return put(owner, condition='#owner = :owner', values=lambda _: {})
+
+    def release(owner: str) -> None:
+        try:
+            client.delete_item(
+                TableName=table_name,
+                Key=LEASE_KEY,
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#owner': 'owner'},
+                ExpressionAttributeValues={':owner': {'S': owner}},
+            )
+
+        except ClientError as exc:
+            if exc.response['Error']['Code'] != \
+                    'ConditionalCheckFailedException':
+                raise
+
+            # Taken over after expiring: the new owner keeps it
+            log.warning('## Monitor lease was taken over before release')
+
+    return monitor_lease(acquire=acquire, renew=renew, release=release)
+
+
+def get_lease(table_name: Optional[str] = STATE_TABLE_NAME) -> monitor_lease:
+    if table_name:
+        return dynamodb_lease(table_name=table_name)
+
+    return memory_lease()
+
+
+def acquire_lease(
+    lease: monitor_lease,
+    owner: str,
+    mode: str = MONITOR_LEASE_MODE,
+    wait: float = MONITOR_LEASE_WAIT,
+    poll_interval: float = MONITOR_LEASE_POLL_INTERVAL,
+    deadline_expired: Callable = deadline.expired,
+    sleep: Callable = time.sleep,
+    clock: Callable = time.monotonic,
+) -> bool:
+    '''Acquire the lease, waiting for it in "wait" mode'''
+    give_up_at = clock() + (wait if mode == 'wait' else 0)
+
+    while not lease.acquire(owner):
+        if clock() + poll_interval > give_up_at or \
+                deadline_expired(reserve=poll_interval):
+            return False
+
+        sleep(poll_interval)
+
+    return True
+
+
+def heartbeat(
+    lease: monitor_lease,
+    owner: str,
+    stop: threading.Event,
+    interval: float,
+    duration: float = MONITOR_LEASE_DURATION,
+    current: dict = CURRENT,
+    clock: Callable = time.monotonic,
+) -> None:
+    '''Extend the lease every interval, until stopped or the lease is lost
+
+    Renewals failing until the lease expires lose it as well: another run
+    may take it over from then on.
+    '''
+    renewed_at = clock()
+
+    while not stop.wait(interval):
+        try:
+            if lease.renew(owner):
+                renewed_at = clock()
+                continue
+
+            log.error('## Monitor lease lost to another run')
+
+        except Exception as exc:
+            log.warning(f'## Could not renew the monitor lease: {exc}')
+
+            if clock() - renewed_at < duration:
+                continue
+
+            log.error('## Monitor lease expired before being renewed')
+
+        metrics.count('lease_lost', 1)
+        current['lost'].set()
+        return
+
+
+@contextmanager
+def held_lease(
+    mode: str = MONITOR_LEASE_MODE,
+    get_lease: Callable = get_lease,
+    duration: float = MONITOR_LEASE_DURATION,
+    acquire_lease: Callable = acquire_lease,
+    current: dict = CURRENT,
+) -> Iterator[bool]:
+    '''Hold the lease for the "with" block, yielding whether it was acquired'''
+    if mode not in LEASE_MODES:
+        raise ValueError(f'Invalid MONITOR_LEASE_MODE: {mode}')
+
+    current['lost'].clear()
+
+    if mode == 'off':
+        yield True
+        return
+
+    lease = get_lease()
+    owner = uuid.uuid4().hex
+
+    if not acquire_lease(lease, owner=owner, mode=mode):
+        yield False
+        return
+
+    stop = threading.Event()
+    beat = threading.Thread(
+        target=heartbeat,
+        kwargs={
+            'lease': lease,
+            'owner': owner,
+            'stop': stop,
+            'interval': duration / 3,
+            'duration': duration,
+            'current': current,
+        },
+        daemon=True,
+    )
+    beat.start()
+
+    try:
+        yield True
+
+    finally:
+        stop.set()
+        beat.join()
+        lease.release(owner)
+
+
+def run_exclusive(
+    run_func: Callable,
+    held_lease: Callable = held_lease,
+) -> dict:
+    '''Run the monitor unless another run holds the lease'''
+    with held_lease() as acquired:
+        if acquired:
+            try:
+                return run_func()
+
+            except LeaseLostException:
+                log.error('## Monitor lease lost: run stopped before its '
+                          'next commit')
+                return {'Stopped': 'Monitor lease lost to another run'}
+
+    log.warning('## Another monitor run holds the lease: skipping this one')
+    metrics.count('lease_skipped', 1)
+
+    return {'Skipped': 'Another monitor run holds the lease'}
@@ -3,12 +3,34 @@ from functools import partial
 import json
 import os
 
+import aws_clients
+import deadline
+import metrics
+import profiling
+import structured_log
+
 from datetime_routines import last_delta_interval
+import lease
+import tenants
 import transferwise
 
 
+# Create the AWS clients during the Lambda init phase (AWS_CLIENTS_PREWARM)
+aws_clients.prewarm()
+
+
+# Unwrapped unless PROFILING_MODES is set
+@profiling.profiled('monitor')
 def handler(event, context):
-    print(json.dumps(event))
+    # No-op unless METRICS_ENABLED is "true"
+    metrics.start()
+
+    # Network calls are bounded by the time left in this invocation
+    deadline.start(context)
+
+    # Payloads are logged for a sample of invocations, redacted and bounded
+    structured_log.start()
+    structured_log.log_payload('event', event)
 
     delta_unit = os.environ.get('TIME_DELTA_UNIT')
     delta_value = os.environ.get('TIME_DELTA_VALUE')
@@ -21,15 +43,25 @@ def handler(event, context):
             delta_period={delta_unit: int(delta_value)},
         )
 
-    tw_monitor = transferwise.monitor()
-    response = tw_monitor.run(**monitor_kwargs)
+    if tenants.MONITOR_TENANT_SECRET_ARNS:
+        # A single invocation monitors every tenant
+        tw_monitor = transferwise.monitor(run_func=tenants.run_tenants)
+    else:
+        tw_monitor = transferwise.monitor()
+
+    # Skipped (or delayed) while a previous run is still going
+    response = lease.run_exclusive(lambda: tw_monitor.run(**monitor_kwargs))
+
+    structured_log.log_payload('response', response)
+
+    body = {'response': response}
+
+    metrics_summary = metrics.emit(dimensions={'Service': 'monitor'})
 
-    print('RESPONSE from tw_monitor.run():')
-    print(json.dumps(response))
+    if metrics_summary is not None:
+        body['metrics'] = metrics_summary
 
     return {
         'statusCode': 200,
-        'body': json.dumps({
-            'response': response,
-        }),
+        'body': json.dumps(body),
     }
@@ -0,0 +1,27 @@
+#!/usr/bin/python3 Python3
+'''Keys of the monitor state (backlog, checkpoint), scoped by tenant
+
+In multi-tenant mode every tenant keeps its own state: state table items are
+sorted by tenant, local files get the tenant as a suffix. The single-tenant
+monitor keeps the default keys.
+'''
+import os
+import re
+from typing import Optional
+
+
+def tenant_key(key: dict, tenant: Optional[str] = None) -> dict:
+    if tenant is None:
+        return key
+
+    return {**key, 'sk': {'S': f'tenant#{tenant}'}}
+
+
+def tenant_path(path: str, tenant: Optional[str] = None) -> str:
+    if tenant is None:
+        return path
+
+    root, extension = os.path.splitext(path)
+    safe_tenant = re.sub(r'[^A-Za-z0-9_.-]', '_', tenant)
+
+    return f'{root}-{safe_tenant}{extension}'
@@ -0,0 +1,281 @@
+#!/usr/bin/python3 Python3
+'''Multi-tenant monitor: many TransferWise tokens in one invocation
+
+MONITOR_TENANT_SECRET_ARNS lists one secret per tenant (an entity with its own
+TransferWise API token), all loaded in a single batch. An invocation runs the
+monitor of every tenant concurrently, instead of one stack (schedule, cold
+start) per token:
+  - each tenant keeps its own backlog and checkpoint, and its API requests
+    are spaced out by its own rate limiter (TransferWise limits are per token)
+  - a failing tenant is reported in the response, without affecting others
+  - the inserts of all tenants go through one writer, which groups them in
+    shared BatchWriteItem requests
+A tenant secret holds its "api_token" and, optionally, a "tenant_id" (the
+secret name otherwise).
+'''
+from collections import namedtuple
+from concurrent import futures
+from functools import partial
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import metrics
+from secret import get_secret_values
+
+import backlog
+import checkpoint
+import ddb
+import lease
+import transferwise
+from transaction_record import TransactionRecord
+
+
+log = logging.getLogger(os.environ.get('LOGGER_NAME', 'MONITOR_LOGGER'))
+
+# Comma-separated tenant secret ARNs; empty runs the single-tenant monitor
+MONITOR_TENANT_SECRET_ARNS = [
+    secret_arn.strip()
+    for secret_arn in os.environ.get(
+        'MONITOR_TENANT_SECRET_ARNS', '').split(',')
+    if secret_arn.strip()
+]
+MONITOR_TENANT_CONCURRENCY = int(os.environ.get('MONITOR_TENANT_CONCURRENCY', 4))  # NOQA
+# TransferWise API requests per second of each tenant; zero is unlimited
+MONITOR_TENANT_MAX_RPS = float(os.environ.get('MONITOR_TENANT_MAX_RPS', 0))
+# Seconds an insert waits for those of other tenants to share its batches
+MONITOR_WRITE_LINGER = float(
+    os.environ.get('MONITOR_WRITE_LINGER_SECONDS', 0.05))
+
+tenant = namedtuple('tenant', 'tenant_id secret')
+
+
+def tenant_id(secret_arn: str, secret: Optional[dict] = None) -> str:
+    '''Explicit tenant id of a secret, or the secret name from its ARN'''
+    if secret and secret.get('tenant_id'):
+        return str(secret['tenant_id'])
+
+    return secret_arn.rsplit(':', 1)[-1]
+
+
+def load_tenants(
+    secret_arns: List[str],
+    get_secret_values: Callable = get_secret_values,
+) -> Tuple[List[tenant], Dict[str, str]]:
+    '''Load the tenant secrets, returning the tenants and errors by tenant id
+
+    Secrets are loaded in a single batch; if it fails, they are loaded one by
+    one, so that a missing secret only fails its own tenant.
+    '''
+    values = {}
+    errors = {}
+
+    try:
+        values = get_secret_values(secret_arns)
+
+    except Exception as exc:
+        log.warning(f'## Could not load tenant secrets in batch: {exc}')
+
+        for secret_arn in secret_arns:
+            try:
+                values.update(get_secret_values([secret_arn]))
+
+            except Exception as exc:
+                errors[tenant_id(secret_arn)] = repr(exc)
+
+    tenants = []
+
+    for secret_arn in secret_arns:
+        if secret_arn not in values:
+            # Not returned by the batch, without an error of its own
+            errors.setdefault(tenant_id(secret_arn), 'Secret not returned')
+            continue
+
+        try:
+            secret = json.loads(values[secret_arn])
+
+        except ValueError as exc:
+            errors[tenant_id(secret_arn)] = repr(exc)
+            continue
+
+        tenants.append(tenant(
+            tenant_id=tenant_id(secret_arn, secret),
+            secret=secret,
+        ))
+
+    return tenants, errors
+
+
+def rate_limiter(
+    max_rps: float,
+    clock: Callable = time.monotonic,
+    sleep: Callable = time.sleep,
+) -> Optional[Callable]:
+    '''Throttle spacing out calls by 1 / max_rps seconds (None if unlimited)'''
+    if max_rps <= 0:
+        return None
+
+    interval = 1 / max_rps
+    lock = threading.Lock()
+    state = {'next_at': 0.0}
+
+    def throttle() -> None:
+        with lock:
+            now = clock()
+            wait = state['next_at'] - now
+            state['next_at'] = max(now, state['next_at']) + interval
+
+        if wait > 0:
+            sleep(wait)
+
+    return throttle
+
+
+def batched_writer(
+    insert: Callable,
+    linger: float = MONITOR_WRITE_LINGER,
+    sleep: Callable = time.sleep,
+) -> Callable:
+    '''Insert shared by concurrent callers, writing their items together
+
+    The first caller waits "linger" seconds for others to join, then inserts
+    every pending transaction at once (in full BatchWriteItem requests) and
+    hands each caller its own outcome. A caller returns once its transactions
+    are written, so the backlog and checkpoint are still saved after them.
+    A transaction queued by several callers is written once: a batch may not
+    put the same key twice. If the shared insert fails, each caller's
+    transactions are inserted on their own, so that an error only fails the
+    callers it belongs to.
+    '''
+    lock = threading.Lock()
+    pending = []
+
+    def unprocessed_of(
+        queued: List[TransactionRecord],
+        unprocessed: List[TransactionRecord],
+    ) -> List[TransactionRecord]:
+        hashes = {t.transaction_hash for t in unprocessed}
+
+        return [t for t in queued if t.transaction_hash in hashes]
+
+    def write(
+        transactions: List[TransactionRecord],
+    ) -> List[TransactionRecord]:
+        future = futures.Future()
+
+        with lock:
+            pending.append((transactions, future))
+            leader = len(pending) == 1
+
+        if leader:
+            sleep(linger)
+
+            with lock:
+                batch = pending[:]
+                pending.clear()
+
+            unique = {
+                transaction.transaction_hash: transaction
+                for queued, _ in batch
+                for transaction in queued
+            }
+
+            try:
+                unprocessed = insert(transactions=list(unique.values()))
+
+            except Exception as exc:
+                # The leader alone: its own error, nobody else to retry
+                if len(batch) == 1:
+                    raise
+
+                log.warning(f'## Shared insert failed ({exc!r}): inserting '
+                            f'the transactions of each caller on their own')
+
+                for queued, waiting in batch:
+                    try:
+                        waiting.set_result(insert(transactions=queued))
+
+                    except Exception as caller_exc:
+                        waiting.set_exception(caller_exc)
+
+            else:
+                metrics.count('shared_writes', 1)
+
+                # Each caller gets its own transactions left unprocessed
+                for queued, waiting in batch:
+                    waiting.set_result(unprocessed_of(queued, unprocessed))
+
+        return future.result()
+
+    return write
+
+
+def run_tenants(
+    secret_arns: List[str] = MONITOR_TENANT_SECRET_ARNS,
+    concurrency: int = MONITOR_TENANT_CONCURRENCY,
+    max_rps: float = MONITOR_TENANT_MAX_RPS,
+    write_linger: float = MONITOR_WRITE_LINGER,
+    load_tenants: Callable = load_tenants,
+    get_ddb_query: Callable = ddb.query,
+    run_monitor: Callable = transferwise.run_monitor,
+    get_latest_transactions: Callable = transferwise.get_latest_transactions,
+    **monitor_kwargs,
+) -> dict:
+    '''Run the monitor of every tenant, recording the results per tenant'''
+    with metrics.timer('load_tenants'):
+        tenants, errors = load_tenants(secret_arns)
+
+    ddb_query = get_ddb_query()
+    shared_query = ddb_query._replace(
+        insert=batched_writer(ddb_query.insert, linger=write_linger))
+
+    def run_tenant(member: tenant) -> dict:
+        try:
+            return run_monitor(
+                secret=member.secret,
+                ddb_query=shared_query,
+                get_latest_transactions=partial(
+                    get_latest_transactions,
+                    throttle=rate_limiter(max_rps),
+                ),
+                get_backlog_store=partial(
+                    backlog.get_backlog_store, tenant=member.tenant_id),
+                get_checkpoint_store=partial(
+                    checkpoint.get_checkpoint_store, tenant=member.tenant_id),
+                **monitor_kwargs,
+            )
+
+        # The lease covers every tenant: all of them stop
+        except lease.LeaseLostException:
+            raise
+
+        except Exception as exc:
+            log.exception(f'## Monitor of tenant {member.tenant_id} failed')
+            return {'Error': repr(exc)}
+
+    results = {
+        name: {'Error': error}
+        for name, error in errors.items()
+    }
+
+    if len(tenants) > 0:
+        with futures.ThreadPoolExecutor(
+            max_workers=min(concurrency, len(tenants)),
+        ) as executor:
+            results.update(zip(
+                [member.tenant_id for member in tenants],
+                executor.map(run_tenant, tenants),
+            ))
+
+    failed = sum(1 for result in results.values() if 'Error' in result)
+
+    metrics.count('tenants', len(results))
+    metrics.count('tenants_failed', failed)
+
+    return {
+        'Tenants': results,
+        'Tenants failed': failed,
+    }
@@ -0,0 +1,120 @@
+#!/usr/bin/python3 Python3
+from unittest import mock
+
+import pytest
+
+from backlog import (
+    BACKLOG_KEY,
+    BACKLOG_SPILL_PATH,
+    deserialize,
+    dynamodb_backlog_store,
+    file_backlog_store,
+    get_backlog_store,
+    merge_backlog,
+    save_backlog,
+    serialize,
+    split_budget,
+)
+from fingerprint import hash_transactions
+from transaction_record import new_record
+
+
+@pytest.fixture
+def records():
+    return hash_transactions([
+        new_record(
+            account='Dummy',
+            currency='USD',
+            value_minor=100 * i,
+            payee=f'Dummy Merchant {i}',
+            reference=str(i),
+        )
+        for i in range(5)
+    ])
+
+
+def test_serialize(records):
+    assert deserialize(serialize(records)) == records
+
+
+def test_file_backlog_store(tmp_path, records):
+    path = str(tmp_path / 'backlog.json')
+    store = file_backlog_store(path=path)
+
+    assert store.load() == []
+
+    store.save(records)
+
+    assert store.load() == records
+    assert file_backlog_store(path=path).load() == records
+
+    store.save([])
+
+    assert store.load() == []
+    assert not (tmp_path / 'backlog.json').exists()
+
+
+def test_dynamodb_backlog_store(records):
+    items = {}
+    client = mock.Mock()
+    client.put_item.side_effect = \
+        lambda TableName, Item: items.update(Item=Item)
+    client.get_item.side_effect = lambda **kwargs: items
+    client.delete_item.side_effect = lambda **kwargs: items.clear()
+
+    store = dynamodb_backlog_store(table_name='state', client=client)
+
+    assert store.load() == []
+
+    store.save(records)
+
+    item = client.put_item.call_args[1]['Item']
+    assert item['pk'] == BACKLOG_KEY['pk']
+    assert item['count'] == {'N': '5'}
+    assert isinstance(item['transactions']['B'], bytes)
+    assert store.load() == records
+
+    store.save([])
+
+    client.delete_item.assert_called_with(TableName='state', Key=BACKLOG_KEY)
+    assert store.load() == []
+
+
+@mock.patch('backlog.dynamodb_backlog_store')
+@mock.patch('backlog.file_backlog_store')
+def test_get_backlog_store(file_store, dynamodb_store):
+    assert get_backlog_store(table_name='state') == \
+        dynamodb_store.return_value
+    dynamodb_store.assert_called_with(table_name='state', key=BACKLOG_KEY)
+
+    assert get_backlog_store(table_name=None) == file_store.return_value
+    file_store.assert_called_with(path=BACKLOG_SPILL_PATH)
+
+    # Multi-tenant runs keep a state per tenant
+    get_backlog_store(table_name='state', tenant='acme')
+    assert dynamodb_store.call_args[1]['key']['sk'] == {'S': 'tenant#acme'}
+
+
+def test_merge_backlog(records):
+    merged = merge_backlog(records[3:], records[:4])
+
+    assert merged == records[3:] + records[:3]
+
+
+def test_split_budget(records):
+    assert split_budget(records, budget=2) == (records[:2], records[2:])
+    assert split_budget(records, budget=10) == (records, [])
+    assert split_budget(records, budget=0) == (records, [])
+
+
+def test_save_backlog(records):
+    store = mock.Mock()
+
+    save_backlog(store, transactions=[], previous_count=0)
+    store.save.assert_not_called()
+
+    save_backlog(store, transactions=records, previous_count=0)
+    store.save.assert_called_with(records)
+
+    save_backlog(store, transactions=[], previous_count=5)
+    store.save.assert_called_with([])
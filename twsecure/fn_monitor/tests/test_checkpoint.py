@@ -0,0 +1,146 @@
+#!/usr/bin/python3 Python3
+import datetime
+from unittest import mock
+
+import pytest
+
+from checkpoint import (
+    CHECKPOINT_KEY,
+    CHECKPOINT_PATH,
+    deserialize,
+    dynamodb_checkpoint_store,
+    file_checkpoint_store,
+    get_checkpoint_store,
+    monitor_checkpoint,
+    save_checkpoint,
+    serialize,
+    statement_unit,
+)
+
+
+@pytest.fixture
+def checkpoint():
+    end = datetime.datetime(2020, 12, 2, tzinfo=datetime.timezone.utc)
+
+    return monitor_checkpoint(
+        interval={'start': end - datetime.timedelta(days=7), 'end': end},
+        done_units=frozenset({'1/10/EUR/2020-11-25T00:00:00Z'}),
+    )
+
+
+def test_statement_unit(checkpoint):
+    unit = statement_unit(
+        profile_id=1,
+        account_id=10,
+        currency='EUR',
+        interval_slice=checkpoint.interval,
+    )
+
+    assert unit in checkpoint.done_units
+
+
+def test_serialize(checkpoint):
+    assert deserialize(serialize(checkpoint)) == checkpoint
+
+
+def test_file_checkpoint_store(tmp_path, checkpoint):
+    path = str(tmp_path / 'checkpoint.json')
+    store = file_checkpoint_store(path=path)
+
+    assert store.load() is None
+
+    store.save(checkpoint)
+
+    assert store.load() == checkpoint
+    assert file_checkpoint_store(path=path).load() == checkpoint
+
+    store.clear()
+
+    assert store.load() is None
+    assert not (tmp_path / 'checkpoint.json').exists()
+
+
+def test_dynamodb_checkpoint_store(checkpoint):
+    items = {}
+    client = mock.Mock()
+    client.put_item.side_effect = \
+        lambda TableName, Item: items.update(Item=Item)
+    client.get_item.side_effect = lambda **kwargs: items
+    client.delete_item.side_effect = lambda **kwargs: items.clear()
+
+    store = dynamodb_checkpoint_store(table_name='state', client=client)
+
+    assert store.load() is None
+
+    store.save(checkpoint)
+
+    item = client.put_item.call_args[1]['Item']
+    assert item['pk'] == CHECKPOINT_KEY['pk']
+    assert item['count'] == {'N': '1'}
+    assert store.load() == checkpoint
+
+    store.clear()
+
+    client.delete_item.assert_called_with(
+        TableName='state', Key=CHECKPOINT_KEY)
+    assert store.load() is None
+
+
+def test_dynamodb_checkpoint_store_expired(checkpoint):
+    '''An expired checkpoint not deleted yet by DynamoDB is ignored'''
+    client = mock.Mock()
+    client.get_item.return_value = {'Item': {
+        **CHECKPOINT_KEY,
+        'checkpoint': {'S': serialize(checkpoint)},
+        'ttl': {'N': '1000'},
+    }}
+
+    store = dynamodb_checkpoint_store(
+        table_name='state', client=client, now=lambda: 999)
+    assert store.load() == checkpoint
+
+    store = dynamodb_checkpoint_store(
+        table_name='state', client=client, now=lambda: 1000)
+    assert store.load() is None
+
+
+@mock.patch('checkpoint.dynamodb_checkpoint_store')
+@mock.patch('checkpoint.file_checkpoint_store')
+def test_get_checkpoint_store(file_store, dynamodb_store):
+    assert get_checkpoint_store(table_name='state') == \
+        dynamodb_store.return_value
+    dynamodb_store.assert_called_with(table_name='state', key=CHECKPOINT_KEY)
+
+    assert get_checkpoint_store(table_name=None) == file_store.return_value
+    file_store.assert_called_with(path=CHECKPOINT_PATH)
+
+    # Multi-tenant runs keep a state per tenant
+    get_checkpoint_store(table_name='state', tenant='acme')
+    assert dynamodb_store.call_args[1]['key']['sk'] == {'S': 'tenant#acme'}
+
+
+def test_save_checkpoint(checkpoint):
+    store = mock.Mock()
+    save = dict(store=store, interval=checkpoint.interval)
+
+    # A cycle completed in a single run leaves nothing to clear
+    save_checkpoint(**save, done_units=[], complete=True, previous=None)
+    store.save.assert_not_called()
+    store.clear.assert_not_called()
+
+    save_checkpoint(
+        **save, done_units=checkpoint.done_units, complete=False,
+        previous=None)
+    store.save.assert_called_with(checkpoint)
+
+    # No progress since the previous checkpoint: no write
+    store.reset_mock()
+    save_checkpoint(
+        **save, done_units=checkpoint.done_units, complete=False,
+        previous=checkpoint)
+    store.save.assert_not_called()
+
+    save_checkpoint(
+        **save, done_units=checkpoint.done_units, complete=True,
+        previous=checkpoint)
+    store.clear.assert_called_once()
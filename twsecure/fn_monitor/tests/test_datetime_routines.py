@@ -6,8 +6,10 @@ import pytest
 
 from datetime_routines import (
     calculate_dynamodb_ttl,
+    interval_slices,
     last_24_hours_interval,
     last_delta_interval,
+    str_to_utc,
     utc_to_str,
 )
 
@@ -89,6 +91,31 @@ def test_utc_to_str(dummy_datetime_str, datetime_str_format):
     mock_datetime.strftime.assert_called_with(datetime_str_format)
 
 
+def test_str_to_utc():
+    dt = datetime.datetime(
+        2020, 6, 15, 12, 30, 30, tzinfo=datetime.timezone.utc)
+
+    assert str_to_utc('2020-06-15T12:30:30Z') == dt
+    assert str_to_utc(utc_to_str(dt)) == dt
+
+
+def test_interval_slices(dummy_datetime, dummy_datetime_two_days_before):
+    interval = {'start': dummy_datetime_two_days_before, 'end': dummy_datetime}
+
+    assert interval_slices(interval, slice_period=None) == [interval]
+
+    slices = interval_slices(interval, slice_period={'hours': 20})
+
+    assert len(slices) == 3
+    assert slices[0]['start'] == interval['start']
+    assert slices[-1]['end'] == interval['end']
+    assert slices[-1]['end'] - slices[-1]['start'] == \
+        datetime.timedelta(hours=8)
+
+    for previous, current in zip(slices, slices[1:]):
+        assert previous['end'] == current['start']
+
+
 @mock.patch('datetime_routines.last_delta_interval')
 def test_last_24_hours_interval(last_delta_interval):
     dummy_interval = {
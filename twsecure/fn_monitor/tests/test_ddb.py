@@ -1,5 +1,6 @@
 #!/usr/bin/python3 Python3
 import copy
+import datetime
 from functools import partial
 import json
 import os
@@ -9,6 +10,8 @@ import pytest
 
 import ddb
 import simple_dynamodb as simple_ddb
+from fingerprint import hash_transactions
+from transaction_record import KeyType, new_record, record_details
 
 
 @pytest.fixture
@@ -18,19 +21,21 @@ def sample_transactions_size():
 
 @pytest.fixture
 def sample_transactions(sample_transactions_size):
-    return [
-        {
-            'transaction-hash': f'hash-{str(i)}',
-            'details': {'i': i},
-        }
+    return hash_transactions([
+        new_record(
+            account='Dummy',
+            currency='USD',
+            value_minor=i,
+            payee=f'Payee {i}',
+        )
         for i in range(0, sample_transactions_size)
-    ]
+    ], legacy_lookup=False)
 
 
 @pytest.fixture
 def sample_transaction_ddb_items(sample_transactions):
     return [
-        {'transaction-hash': {'S': t['transaction-hash']}}
+        {'transaction-hash': {'S': t.transaction_hash}}
         for t in sample_transactions
     ]
 
@@ -48,11 +53,25 @@ def test_query_batch_get():
     assert response == items
     ddb_api.batch_get.assert_called_with(keys=keys)
 
+    # Keys are split in batches the API accepts
+    ddb_api.batch_get.reset_mock()
+
+    response = ddb.query_batch_get(keys, ddb_api, table_name, batch_size=2)
+
+    assert response == items + items
+    assert ddb_api.batch_get.call_args_list == [
+        mock.call(keys=['A', 'B']),
+        mock.call(keys=['C']),
+    ]
+
 
-@mock.patch('boto3.client')
-def test_query_default_args(boto3_client):
+@mock.patch('aws_clients.get_client')
+def test_query_default_args(get_client):
     query = ddb.query()
 
+    # The container-wide client is reused
+    get_client.assert_called_with('dynamodb')
+
     assert hasattr(query, 'filter_new')
     assert hasattr(query, 'insert')
 
@@ -73,8 +92,8 @@ def test_query_default_args(boto3_client):
     assert 'batch_put' in query.insert.keywords
 
 
-@mock.patch('boto3.client')
-def test_get_transactions_operations(boto3_client):
+@mock.patch('aws_clients.get_client')
+def test_get_transactions_operations(get_client):
     assert os.environ.get('LOCAL_ENV_VARS_LOADED') == 'true'
 
     dummy_table = 'dummy_table'
@@ -102,7 +121,7 @@ def test_filter_new_transactions(
 
     batch_get.assert_called_once_with(
         keys=[
-            {'transaction-hash': {'S': t['transaction-hash']}}
+            {'transaction-hash': {'S': t.transaction_hash}}
             for t in sample_transactions
         ]
     )
@@ -127,7 +146,7 @@ def test_filter_new_transactions(
         batch_get=batch_get,
     )
 
-    new_hashes = [t['transaction-hash'] for t in new_transactions]
+    new_hashes = [t.transaction_hash for t in new_transactions]
 
     assert len(new_transactions) == removal_count
 
@@ -148,23 +167,115 @@ def test_filter_new_transactions(
     assert len(new_transactions) == len(sample_transactions)
 
 
+def test_filter_new_transactions_legacy_lookup(sample_transactions):
+    '''Transactions stored under their legacy fingerprint are not new'''
+    transactions = hash_transactions(sample_transactions, legacy_lookup=True)
+
+    batch_get = mock.Mock(return_value=[
+        {'transaction-hash': {'S': transactions[0].legacy_hash}},
+        {'transaction-hash': {'S': transactions[1].transaction_hash}},
+    ])
+
+    new_transactions = ddb.filter_new_transactions(
+        transactions=transactions,
+        batch_get=batch_get,
+    )
+
+    assert new_transactions == transactions[2:]
+
+    keys = batch_get.call_args[1]['keys']
+    assert len(keys) == 2 * len(transactions)
+    assert {'transaction-hash': {'S': transactions[0].legacy_hash}} in keys
+
+
+def test_filter_new_transactions_binary_keys(sample_transactions):
+    batch_get = mock.Mock(return_value=[
+        {'transaction-hash': {
+            'B': bytes.fromhex(sample_transactions[0].transaction_hash),
+        }},
+    ])
+
+    # Transactions stored before the switch to binary keys
+    legacy_batch_get = mock.Mock(return_value=[
+        {'transaction-hash': {'S': sample_transactions[1].transaction_hash}},
+    ])
+
+    new_transactions = ddb.filter_new_transactions(
+        transactions=sample_transactions,
+        batch_get=batch_get,
+        key_type=KeyType.BINARY,
+        legacy_batch_get=legacy_batch_get,
+    )
+
+    assert new_transactions == sample_transactions[2:]
+
+    batch_get.assert_called_once_with(keys=[
+        {'transaction-hash': {'B': bytes.fromhex(t.transaction_hash)}}
+        for t in sample_transactions
+    ])
+
+    # Hashes found in the new table are not looked up again
+    legacy_batch_get.assert_called_once_with(keys=[
+        {'transaction-hash': {'S': t.transaction_hash}}
+        for t in sample_transactions[1:]
+    ])
+
+
+@mock.patch('aws_clients.get_client')
+def test_query_legacy_table(get_client):
+    query = ddb.query(
+        table_name='binary-table',
+        key_type=KeyType.BINARY,
+        legacy_table_name='string-table',
+    )
+
+    assert query.filter_new.keywords['key_type'] == KeyType.BINARY
+    assert query.insert.keywords['key_type'] == KeyType.BINARY
+
+    legacy_batch_get = query.filter_new.keywords['legacy_batch_get']
+    assert legacy_batch_get.keywords['table_name'] == 'string-table'
+
+    query = ddb.query(table_name='string-table', legacy_table_name=None)
+
+    assert query.filter_new.keywords['legacy_batch_get'] is None
+
+    query = ddb.query(
+        table_name='binary-table',
+        legacy_table_name='string-table',
+        legacy_until='2020-01-01T00:00:00Z',
+    )
+
+    assert query.filter_new.keywords['legacy_batch_get'] is None
+
+
+def test_legacy_lookup_active():
+    now = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+    assert ddb.legacy_lookup_active(until=None, now=now)
+    assert ddb.legacy_lookup_active(until='2020-01-02T00:00:00Z', now=now)
+    assert not ddb.legacy_lookup_active(until='2020-01-01T00:00:00Z', now=now)
+
+
 @mock.patch('ddb.calculate_dynamodb_ttl')
 def test_insert_transactions(calculate_dynamodb_ttl, sample_transactions):
     ttl_in_days = 7
     ttl_timestamp = 1234567890
     calculate_dynamodb_ttl.return_value = ttl_timestamp
 
-    batch_put_response = mock.Mock()
-    batch_put = mock.Mock(return_value=batch_put_response)
+    batch_put = mock.Mock(return_value=simple_ddb.batch_put_result(
+        responses=[],
+        unprocessed_items=[{
+            'transaction-hash': {'S': sample_transactions[1].transaction_hash},
+        }],
+    ))
 
-    response = ddb.insert_transactions(
+    unprocessed = ddb.insert_transactions(
         transactions=sample_transactions,
         batch_put=batch_put,
-        max_queue_size=10,
         ttl_in_days=ttl_in_days,
     )
 
-    assert response == batch_put_response
+    assert unprocessed == [sample_transactions[1]]
 
     calculate_dynamodb_ttl.assert_called_with(
         delta_period={'days': ttl_in_days},
@@ -173,11 +284,10 @@ def test_insert_transactions(calculate_dynamodb_ttl, sample_transactions):
     batch_put.assert_called_with(
         items=[
             {
-                'transaction-hash': {'S': t['transaction-hash']},
-                'details': {'S': json.dumps(t['details'])},
+                'transaction-hash': {'S': t.transaction_hash},
+                'details': {'S': json.dumps(record_details(t))},
                 'ttl': {'N': str(ttl_timestamp)},
             }
             for t in sample_transactions
         ],
-        max_queue_size=ddb.MAX_NEW_TRANSACTIONS_PER_EXECUTION,
     )
@@ -0,0 +1,94 @@
+#!/usr/bin/python3 Python3
+import json
+
+import pytest
+
+from fingerprint import (
+    canonical_key,
+    FingerprintAlgorithm,
+    hash_transactions,
+    legacy_fingerprint,
+    md5,
+)
+from transaction_record import new_record
+
+
+@pytest.fixture
+def record():
+    return new_record(
+        account='Dummy',
+        currency='USD',
+        value_minor=1000,
+        payee='Dummy Merchant',
+        timestamp='2020-12-01T17:05:44.286576Z',
+        reference='CARD-12345678',
+    )
+
+
+def test_md5():
+    test_set = {
+        'testing 123': '29628f6790da2e7daa6f40ab933e05d9',
+        'xyz': 'd16fb36f0911f878998c136191af705e',
+        json.dumps({'hello': 'world'}): '49dfdd54b01cbcd2d2ab5e9e5ee6b9b9',
+    }
+
+    for value, expected_hash in test_set.items():
+        hash_ = md5(value)
+        assert hash_ == expected_hash
+
+
+def test_legacy_fingerprint(record):
+    # Same hash the monitor stored for the details dict
+    assert legacy_fingerprint(record) == md5(json.dumps({
+        'account': 'Dummy',
+        'currency': 'USD',
+        'value': '10.00',
+        'payee': 'Dummy Merchant',
+    }))
+
+
+def test_canonical_key(record):
+    # A reference number identifies the transaction on its own
+    assert canonical_key(record) == \
+        canonical_key(record._replace(payee='DUMMY MERCHANT*123'))
+    assert canonical_key(record) != \
+        canonical_key(record._replace(reference='CARD-87654321'))
+
+    unreferenced = record._replace(reference=None)
+
+    # Same amount to the same payee at another time is another debit
+    assert canonical_key(unreferenced) != canonical_key(
+        unreferenced._replace(timestamp='2020-12-01T18:00:00.000000Z'))
+
+    # Fields are length-prefixed: moving a separator changes the key
+    assert canonical_key(unreferenced._replace(account='a', payee='bc')) != \
+        canonical_key(unreferenced._replace(account='ab', payee='c'))
+
+
+def test_hash_transactions(record):
+    records = [record, record._replace(reference=None)]
+
+    hashed = hash_transactions(records, digest_size=16, legacy_lookup=False)
+
+    assert [len(t.transaction_hash) for t in hashed] == [32, 32]
+    assert hashed[0].transaction_hash != hashed[1].transaction_hash
+    assert [t.legacy_hash for t in hashed] == [None, None]
+
+    # Stable across runs, and configurable in size
+    assert hash_transactions(records, legacy_lookup=False) == hashed
+    assert len(hash_transactions(records, digest_size=8)[0].transaction_hash) \
+        == 16
+
+    hashed = hash_transactions(records, legacy_lookup=True)
+
+    assert hashed[0].legacy_hash == legacy_fingerprint(record)
+
+
+def test_hash_transactions_legacy(record):
+    hashed = hash_transactions([record], algorithm=FingerprintAlgorithm.LEGACY)
+
+    assert hashed[0].transaction_hash == legacy_fingerprint(record)
+    assert hashed[0].legacy_hash is None
+
+    with pytest.raises(ValueError):
+        hash_transactions([record], algorithm='sha1')
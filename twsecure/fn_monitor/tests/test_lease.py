@@ -0,0 +1,246 @@
+#!/usr/bin/python3 Python3
+import threading
+from unittest import mock
+
+from botocore.exceptions import ClientError
+import pytest
+
+from lease import (
+    acquire_lease,
+    dynamodb_lease,
+    get_lease,
+    heartbeat,
+    held_lease,
+    LEASE_KEY,
+    LeaseLostException,
+    lost,
+    memory_lease,
+    run_exclusive,
+)
+
+
+def conditional_check_failed():
+    return ClientError(
+        {'Error': {'Code': 'ConditionalCheckFailedException'}},
+        'PutItem',
+    )
+
+
+def test_memory_lease():
+    now = mock.Mock(return_value=1000)
+    lease = memory_lease(duration=60, state={}, now=now)
+
+    assert lease.acquire('run-1') is True
+    assert lease.acquire('run-2') is False
+    assert lease.renew('run-2') is False
+
+    # The heartbeat pushes the expiration back
+    now.return_value = 1050
+    assert lease.renew('run-1') is True
+    now.return_value = 1100
+    assert lease.acquire('run-2') is False
+
+    # Expired leases are taken over
+    now.return_value = 1111
+    assert lease.acquire('run-2') is True
+    assert lease.renew('run-1') is False
+
+    lease.release('run-1')
+    assert lease.acquire('run-3') is False
+
+    lease.release('run-2')
+    assert lease.acquire('run-3') is True
+
+
+def test_dynamodb_lease():
+    client = mock.Mock()
+    lease = dynamodb_lease(
+        table_name='state',
+        client=client,
+        duration=60,
+        now=lambda: 1000.5,
+    )
+
+    assert lease.acquire('run-1') is True
+
+    kwargs = client.put_item.call_args[1]
+    assert kwargs['Item'] == {
+        **LEASE_KEY,
+        'owner': {'S': 'run-1'},
+        'expires_at': {'N': '1060.500'},
+        'ttl': {'N': '4660'},
+    }
+    assert 'expires_at < :now' in kwargs['ConditionExpression']
+    assert kwargs['ExpressionAttributeValues'] == {
+        ':owner': {'S': 'run-1'},
+        ':now': {'N': '1000.500'},
+    }
+
+    assert lease.renew('run-1') is True
+    assert client.put_item.call_args[1]['ConditionExpression'] == \
+        '#owner = :owner'
+
+    client.put_item.side_effect = conditional_check_failed()
+
+    assert lease.acquire('run-2') is False
+    assert lease.renew('run-2') is False
+
+    client.delete_item.side_effect = conditional_check_failed()
+    lease.release('run-2')
+
+    client.delete_item.assert_called_with(
+        TableName='state',
+        Key=LEASE_KEY,
+        ConditionExpression='#owner = :owner',
+        ExpressionAttributeNames={'#owner': 'owner'},
+        ExpressionAttributeValues={':owner': {'S': 'run-2'}},
+    )
+
+    # Other errors are not swallowed
+    client.put_item.side_effect = ClientError(
+        {'Error': {'Code': 'ProvisionedThroughputExceededException'}},
+        'PutItem',
+    )
+
+    with pytest.raises(ClientError):
+        lease.acquire('run-2')
+
+
+@mock.patch('lease.dynamodb_lease')
+@mock.patch('lease.memory_lease')
+def test_get_lease(memory_lease, dynamodb_lease):
+    assert get_lease(table_name='state') == dynamodb_lease.return_value
+    dynamodb_lease.assert_called_with(table_name='state')
+
+    assert get_lease(table_name=None) == memory_lease.return_value
+
+
+def test_acquire_lease():
+    lease = mock.Mock()
+    lease.acquire.side_effect = [False, False, True]
+    clock = mock.Mock(return_value=0)
+    acquire = mock.Mock(wraps=acquire_lease)
+
+    kwargs = dict(
+        owner='run-1',
+        wait=10,
+        poll_interval=1,
+        deadline_expired=lambda reserve: False,
+        sleep=mock.Mock(),
+        clock=clock,
+    )
+
+    assert acquire(lease, mode='wait', **kwargs) is True
+    assert kwargs['sleep'].call_count == 2
+
+    # Skipping at once
+    lease.acquire.side_effect = None
+    lease.acquire.return_value = False
+    kwargs['sleep'].reset_mock()
+
+    assert acquire(lease, mode='skip', **kwargs) is False
+    kwargs['sleep'].assert_not_called()
+
+    # Waiting, until the wait or the invocation deadline is over
+    clock.side_effect = [0, 5, 9.5]
+    assert acquire(lease, mode='wait', **kwargs) is False
+    assert kwargs['sleep'].call_count == 1
+
+    clock.side_effect = None
+    kwargs['deadline_expired'] = lambda reserve: True
+    assert acquire(lease, mode='wait', **kwargs) is False
+
+
+def test_heartbeat():
+    lease = mock.Mock()
+    lease.renew.side_effect = [True, Exception('Throttled'), False]
+    stop = mock.Mock()
+    stop.wait.return_value = False
+    current = {'lost': threading.Event()}
+
+    heartbeat(
+        lease,
+        owner='run-1',
+        stop=stop,
+        interval=20,
+        duration=60,
+        current=current,
+    )
+
+    # Transient errors are retried, a lost lease ends the heartbeat
+    assert lease.renew.call_count == 3
+    stop.wait.assert_called_with(20)
+    assert lost(current=current)
+
+
+def test_heartbeat_renewals_failing():
+    '''Renewals failing for longer than the lease duration lose it'''
+    lease = mock.Mock()
+    lease.renew.side_effect = Exception('Throttled')
+    stop = mock.Mock()
+    stop.wait.return_value = False
+    current = {'lost': threading.Event()}
+
+    heartbeat(
+        lease,
+        owner='run-1',
+        stop=stop,
+        interval=20,
+        duration=60,
+        current=current,
+        clock=mock.Mock(side_effect=[0, 20, 40, 60]),
+    )
+
+    assert lease.renew.call_count == 3
+    assert lost(current=current)
+
+
+def test_held_lease():
+    state = {}
+    get = mock.Mock(return_value=memory_lease(duration=60, state=state))
+    held = mock.Mock(wraps=held_lease)
+
+    with held(mode='skip', get_lease=get) as acquired:
+        assert acquired is True
+        assert len(state) == 1
+        assert threading.active_count() > 1
+
+        # A concurrent run is skipped
+        with held(mode='skip', get_lease=get) as other_acquired:
+            assert other_acquired is False
+
+    assert state == {}
+
+    with held(mode='off', get_lease=get) as acquired:
+        assert acquired is True
+        get.reset_mock()
+
+    get.assert_not_called()
+
+    with pytest.raises(ValueError):
+        with held(mode='sometimes', get_lease=get):
+            pass
+
+
+def test_run_exclusive():
+    run_func = mock.Mock(return_value={'foo': 'bar'})
+
+    assert run_exclusive(run_func) == {'foo': 'bar'}
+
+    response = run_exclusive(
+        run_func,
+        held_lease=mock.Mock(return_value=mock.MagicMock(
+            __enter__=mock.Mock(return_value=False))),
+    )
+
+    assert response == {'Skipped': 'Another monitor run holds the lease'}
+    run_func.assert_called_once()
+
+    # A run that lost its lease stops with a response
+    response = run_exclusive(
+        mock.Mock(side_effect=LeaseLostException('Lost')),
+        held_lease=mock.Mock(return_value=mock.MagicMock(
+            __enter__=mock.Mock(return_value=True))),
+    )
+
+    assert response == {'Stopped': 'Monitor lease lost to another run'}
@@ -1,8 +1,12 @@
+from functools import partial
 import os
 import json
 from unittest import mock
 
+import metrics
+
 import monitor
+import tenants
 
 
 @mock.patch('transferwise.monitor')
@@ -21,6 +25,34 @@ def test_handler(transferwise_monitor):
     assert response.get('body') == json.dumps({'response': monitor_response})
 
 
+@mock.patch('transferwise.monitor')
+def test_handler_metrics(transferwise_monitor):
+    def run():
+        metrics.count('transactions_retrieved', 3)
+        return {'foo': 'bar'}
+
+    transferwise_monitor.return_value.run = run
+
+    with mock.patch('metrics.start', partial(metrics.start, enabled=True)):
+        response = monitor.handler({}, None)
+
+    body = json.loads(response['body'])
+
+    assert body['response'] == {'foo': 'bar'}
+    assert body['metrics']['counters'] == {'transactions_retrieved': 3}
+
+
+@mock.patch('transferwise.monitor')
+def test_handler_tenants(transferwise_monitor):
+    transferwise_monitor.return_value.run.return_value = {'Tenants': {}}
+
+    with mock.patch('tenants.MONITOR_TENANT_SECRET_ARNS', ['secret:acme']):
+        response = monitor.handler({}, None)
+
+    transferwise_monitor.assert_called_with(run_func=tenants.run_tenants)
+    assert json.loads(response['body'])['response'] == {'Tenants': {}}
+
+
 @mock.patch('transferwise.monitor')
 @mock.patch('monitor.last_delta_interval')
 @mock.patch('monitor.partial')
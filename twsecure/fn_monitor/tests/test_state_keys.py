@@ -0,0 +1,21 @@
+#!/usr/bin/python3 Python3
+from state_keys import tenant_key, tenant_path
+
+
+def test_tenant_key():
+    key = {'pk': {'S': 'monitor-backlog'}, 'sk': {'S': 'default'}}
+
+    assert tenant_key(key) == key
+    assert tenant_key(key, tenant='acme') == {
+        'pk': {'S': 'monitor-backlog'},
+        'sk': {'S': 'tenant#acme'},
+    }
+
+
+def test_tenant_path():
+    path = '/tmp/backlog.json'
+
+    assert tenant_path(path) == path
+    assert tenant_path(path, tenant='acme') == '/tmp/backlog-acme.json'
+    assert tenant_path(path, tenant='../acme/x') == \
+        '/tmp/backlog-.._acme_x.json'
@@ -0,0 +1,231 @@
+#!/usr/bin/python3 Python3
+from collections import namedtuple
+import json
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from lease import LeaseLostException
+from tenants import (
+    batched_writer,
+    load_tenants,
+    rate_limiter,
+    run_tenants,
+    tenant,
+    tenant_id,
+)
+
+
+def test_tenant_id():
+    secret_arn = 'arn:aws:secretsmanager:us-east-1:123:secret:acme-tw-AbC123'
+
+    assert tenant_id(secret_arn) == 'acme-tw-AbC123'
+    assert tenant_id(secret_arn, secret={'api_token': 'x'}) == \
+        'acme-tw-AbC123'
+    assert tenant_id(secret_arn, secret={'tenant_id': 'acme'}) == 'acme'
+
+
+def test_load_tenants():
+    values = {
+        'secret:acme': json.dumps({'api_token': 'A', 'tenant_id': 'acme'}),
+        'secret:globex': json.dumps({'api_token': 'G'}),
+        'secret:broken': 'not json',
+    }
+
+    get_values = mock.Mock(
+        side_effect=lambda ids: {i: values[i] for i in ids})
+
+    tenants, errors = load_tenants(list(values), get_secret_values=get_values)
+
+    # A single batch for all tenants
+    get_values.assert_called_once()
+    assert tenants == [
+        tenant('acme', secret={'api_token': 'A', 'tenant_id': 'acme'}),
+        tenant('globex', secret={'api_token': 'G'}),
+    ]
+    assert list(errors) == ['broken']
+
+    # A failing batch is retried one secret at a time
+    tenants, errors = load_tenants(
+        ['secret:acme', 'secret:missing'],
+        get_secret_values=get_values,
+    )
+
+    assert [t.tenant_id for t in tenants] == ['acme']
+    assert list(errors) == ['missing']
+    assert 'KeyError' in errors['missing']
+
+    # A secret left out of the batch response fails its tenant
+    tenants, errors = load_tenants(
+        ['secret:acme', 'secret:globex'],
+        get_secret_values=lambda ids: {'secret:acme': values['secret:acme']},
+    )
+
+    assert [t.tenant_id for t in tenants] == ['acme']
+    assert errors == {'globex': 'Secret not returned'}
+
+
+def test_rate_limiter():
+    assert rate_limiter(max_rps=0) is None
+
+    sleep = mock.Mock()
+    throttle = rate_limiter(max_rps=4, clock=lambda: 100, sleep=sleep)
+
+    for _ in range(3):
+        throttle()
+
+    assert [c[0][0] for c in sleep.call_args_list] == [0.25, 0.5]
+
+
+def record(transaction_hash):
+    return mock.Mock(transaction_hash=transaction_hash)
+
+
+def test_batched_writer():
+    a, b, c, d = (record(h) for h in 'abcd')
+    insert = mock.Mock(return_value=[record('c')])
+    lingering = threading.Event()
+    results = {}
+
+    def linger(seconds):
+        lingering.set()
+        time.sleep(seconds)
+
+    write = batched_writer(insert, linger=0.2, sleep=linger)
+
+    def caller(transactions):
+        results[transactions[0].transaction_hash] = write(transactions)
+
+    threads = [
+        threading.Thread(target=caller, args=(transactions,))
+        for transactions in ([a], [b, c], [d, a])
+    ]
+
+    # Others join the first caller while it lingers
+    threads[0].start()
+    assert lingering.wait(timeout=5)
+
+    for thread in threads[1:]:
+        thread.start()
+
+    for thread in threads:
+        thread.join(timeout=5)
+
+    # Written together, a transaction queued twice only once
+    insert.assert_called_once()
+    assert sorted(
+        t.transaction_hash for t in insert.call_args[1]['transactions']
+    ) == ['a', 'b', 'c', 'd']
+
+    # Only the caller of an unprocessed transaction gets it back
+    assert results == {'a': [], 'b': [c], 'd': []}
+
+
+def test_batched_writer_errors():
+    write = batched_writer(
+        mock.Mock(side_effect=RuntimeError('Throttled')),
+        linger=0,
+        sleep=lambda seconds: None,
+    )
+
+    with pytest.raises(RuntimeError):
+        write(transactions=[record('a')])
+
+
+def test_batched_writer_caller_errors():
+    '''A failed shared insert is retried per caller, failing only one'''
+    def insert(transactions):
+        if any(t.transaction_hash == 'bad' for t in transactions):
+            raise RuntimeError('ValidationException')
+
+        return []
+
+    lingering = threading.Event()
+    results = {}
+
+    def linger(seconds):
+        lingering.set()
+        time.sleep(seconds)
+
+    write = batched_writer(insert, linger=0.2, sleep=linger)
+
+    def caller(name, transactions):
+        try:
+            results[name] = write(transactions)
+
+        except RuntimeError as exc:
+            results[name] = exc
+
+    threads = [
+        threading.Thread(target=caller, args=(name, transactions))
+        for name, transactions in (
+            ('acme', [record('a')]),
+            ('globex', [record('bad')]),
+        )
+    ]
+
+    threads[0].start()
+    assert lingering.wait(timeout=5)
+    threads[1].start()
+
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert results['acme'] == []
+    assert isinstance(results['globex'], RuntimeError)
+
+
+def test_run_tenants():
+    query = namedtuple('query', 'filter_new insert')
+    ddb_query = query(filter_new=mock.Mock(), insert=mock.Mock())
+
+    def run_monitor(secret, **kwargs):
+        if secret['api_token'] == 'FAIL':
+            raise RuntimeError('Unauthorized')
+
+        # Every tenant shares the writer, and has its own state and throttle
+        assert kwargs['ddb_query'].filter_new is ddb_query.filter_new
+        assert kwargs['ddb_query'].insert is not ddb_query.insert
+        assert kwargs['get_latest_transactions'].keywords['throttle']
+        assert kwargs['get_backlog_store'].keywords['tenant'] == \
+            secret['tenant_id']
+        assert kwargs['time_interval_func'] == 'interval'
+
+        return {'Statements skipped': 0}
+
+    response = run_tenants(
+        secret_arns=['secret:acme', 'secret:globex', 'secret:initech'],
+        concurrency=2,
+        max_rps=5,
+        load_tenants=lambda secret_arns: (
+            [
+                tenant('acme', {'api_token': 'A', 'tenant_id': 'acme'}),
+                tenant('globex', {'api_token': 'FAIL', 'tenant_id': 'globex'}),
+            ],
+            {'initech': "KeyError('secret:initech')"},
+        ),
+        get_ddb_query=lambda: ddb_query,
+        run_monitor=run_monitor,
+        time_interval_func='interval',
+    )
+
+    assert response == {
+        'Tenants': {
+            'initech': {'Error': "KeyError('secret:initech')"},
+            'acme': {'Statements skipped': 0},
+            'globex': {'Error': "RuntimeError('Unauthorized')"},
+        },
+        'Tenants failed': 2,
+    }
+
+    # A lost lease stops the whole run, not a single tenant
+    with pytest.raises(LeaseLostException):
+        run_tenants(
+            secret_arns=['secret:acme'],
+            load_tenants=lambda secret_arns: (
+                [tenant('acme', {'api_token': 'A'})], {}),
+            get_ddb_query=lambda: ddb_query,
+            run_monitor=mock.Mock(side_effect=LeaseLostException('Lost')),
+        )
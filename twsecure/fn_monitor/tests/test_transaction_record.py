@@ -0,0 +1,117 @@
+#!/usr/bin/python3 Python3
+from functools import partial
+import json
+
+import pytest
+
+from details_codec import decode_details, encode_details
+from transaction_record import (
+    attribute_hash,
+    format_minor_units,
+    key_attribute,
+    KeyType,
+    minor_units,
+    new_record,
+    record_details,
+    to_dynamodb_item,
+)
+
+
+@pytest.mark.parametrize('value,value_minor,formatted', [
+    (-10, 1000, '10.00'),
+    (-150.0, 15000, '150.00'),
+    (0.1, 10, '0.10'),
+    (2.675, 267, '2.67'),  # Rounded like '{:.2f}' (2.67499...)
+    (1234567.89, 123456789, '1234567.89'),
+])
+def test_minor_units(value, value_minor, formatted):
+    assert minor_units(value) == value_minor
+    assert format_minor_units(value_minor) == formatted
+    assert format_minor_units(value_minor) == '{:.2f}'.format(abs(value))
+
+
+def test_new_record():
+    record = new_record(
+        account='Dummy',
+        currency='USD',
+        value_minor=1050,
+        payee='Dummy Merchant',
+        timestamp='2020-12-01T17:05:44.286576Z',
+    )
+
+    assert not hasattr(record, '__dict__')
+
+    with pytest.raises(AttributeError):
+        record.payee = 'Someone else'
+
+    assert record_details(record) == {
+        'account': 'Dummy',
+        'currency': 'USD',
+        'value': '10.50',
+        'payee': 'Dummy Merchant',
+    }
+    assert record.reference is None
+    assert record.transaction_hash is None
+
+
+def test_to_dynamodb_item():
+    record = new_record(
+        account='Dummy',
+        currency='USD',
+        value_minor=1000,
+        payee='Dummy Merchant',
+    )._replace(transaction_hash='abc123')
+
+    assert to_dynamodb_item(record, ttl=1234567890) == {
+        'transaction-hash': {'S': 'abc123'},
+        'details': {'S': json.dumps(record_details(record))},
+        'ttl': {'N': '1234567890'},
+    }
+
+
+def test_key_attribute():
+    transaction_hash = 'abc123abc123abc123abc123abc123ab'
+
+    assert key_attribute(transaction_hash) == {'S': transaction_hash}
+
+    binary = key_attribute(transaction_hash, key_type=KeyType.BINARY)
+
+    assert binary == {'B': bytes.fromhex(transaction_hash)}
+    assert len(binary['B']) == 16
+
+    assert attribute_hash(binary) == transaction_hash
+    assert attribute_hash({'S': transaction_hash}) == transaction_hash
+
+    with pytest.raises(ValueError):
+        key_attribute(transaction_hash, key_type='N')
+
+
+def test_to_dynamodb_item_binary_key():
+    record = new_record(
+        account='Dummy',
+        currency='USD',
+        value_minor=1000,
+        payee='Dummy Merchant',
+    )._replace(transaction_hash='abc123')
+
+    item = to_dynamodb_item(record, ttl=1234567890, key_type=KeyType.BINARY)
+
+    assert item['transaction-hash'] == {'B': b'\xab\xc1\x23'}
+
+
+def test_to_dynamodb_item_binary_details():
+    record = new_record(
+        account='Dummy',
+        currency='USD',
+        value_minor=1000,
+        payee='Dummy Merchant',
+    )._replace(transaction_hash='abc123')
+
+    item = to_dynamodb_item(
+        record,
+        ttl=1234567890,
+        encode_details=partial(encode_details, encoding='binary'),
+    )
+
+    assert isinstance(item['details']['B'], bytes)
+    assert decode_details(item['details']) == record_details(record)
@@ -1,22 +1,30 @@
 import copy
+import datetime
 from functools import partial
-import json
 import random
 from unittest import mock
 
 import pytest
 
+from backlog import backlog_store
+from checkpoint import checkpoint_store
+from fingerprint import hash_transactions
+from lease import LeaseLostException
+from transaction_record import minor_units, new_record
 from transferwise import (
     api_endpoints,
     api_request,
     get_accounts,
     get_payee,
     get_profiles,
+    get_reference,
+    get_latest_transactions,
     get_statement,
-    hash_transactions,
-    md5,
     monitor,
     run_monitor,
+    statement_fetch,
+    statement_record,
+    TRANSFERWISE_API_TIMEOUT,
 )
 
 
@@ -120,15 +128,49 @@ def dummy_latest_transactions(
     lastest_transactions_count,
 ):
     payees = [dummy_merchant, dummy_recipient]
-    return [
-        {
-            'account': 'Dummy',
-            'currency': 'XYZ',
-            'value': float(i * -1),
-            'payee': random.choice(payees),
-        }
+    return hash_transactions([
+        new_record(
+            account='Dummy',
+            currency='XYZ',
+            value_minor=minor_units(float(i * -1)),
+            payee=random.choice(payees),
+        )
         for i in range(1, lastest_transactions_count)
-    ]
+    ], legacy_lookup=False)
+
+
+@pytest.fixture
+def memory_backlog():
+    state = {'transactions': []}
+
+    def save(transactions):
+        state['transactions'] = list(transactions)
+
+    return backlog_store(
+        load=mock.Mock(side_effect=lambda: state['transactions']),
+        save=mock.Mock(side_effect=save),
+    )
+
+
+@pytest.fixture
+def memory_checkpoint():
+    state = {'checkpoint': None}
+
+    def save(checkpoint):
+        state['checkpoint'] = checkpoint
+
+    return checkpoint_store(
+        load=mock.Mock(side_effect=lambda: state['checkpoint']),
+        save=mock.Mock(side_effect=save),
+        clear=mock.Mock(side_effect=lambda: save(None)),
+    )
+
+
+@pytest.fixture
+def time_interval():
+    end = datetime.datetime(2020, 12, 2, tzinfo=datetime.timezone.utc)
+
+    return {'start': end - datetime.timedelta(days=1), 'end': end}
 
 
 def test_get_payee(
@@ -152,31 +194,43 @@ def test_get_payee(
     assert payee == default_payee
 
 
-def test_md5():
-    test_set = {
-        'testing 123': '29628f6790da2e7daa6f40ab933e05d9',
-        'xyz': 'd16fb36f0911f878998c136191af705e',
-        json.dumps({'hello': 'world'}): '49dfdd54b01cbcd2d2ab5e9e5ee6b9b9',
-    }
+def test_get_reference(transaction_merchant):
+    assert get_reference(transaction_merchant) == 'CARD-12345678'
 
-    for value, expected_hash in test_set.items():
-        hash_ = md5(value)
-        assert hash_ == expected_hash
+    assert get_reference({'id': 123}) == '123'
+    assert get_reference({'referenceNumber': '', 'id': 123}) == '123'
+    assert get_reference({}) is None
 
 
-def test_hash_transactions(transaction_merchant, transaction_recipient):
-    expected_hashes = {
-        str(transaction_merchant): '373256bff664e73b5051d63108a88b8e',
-        str(transaction_recipient): 'e327997743cbda4ab117d4254371ea9e',
-    }
+def test_statement_record(transaction_merchant, transaction_recipient):
+    profile = {'id': 1, 'details': {'firstName': 'Dummy Person'}}
+
+    record = statement_record(
+        profile=profile,
+        transaction=transaction_merchant,
+    )
 
-    hashed = hash_transactions([transaction_merchant, transaction_recipient])
+    assert record.account == 'Dummy'
+    assert record.currency == 'USD'
+    assert record.value_minor == 1000
+    assert record.payee == 'Dummy Merchant'
+    assert record.timestamp == '2020-12-01T17:05:44.286576Z'
 
-    for item in hashed:
-        transaction_str = str(item['details'])
-        hashed_value = item['transaction-hash']
+    assert record.reference == 'CARD-12345678'
+
+    # Fingerprints are computed for the whole list by hash_transactions
+    assert record.transaction_hash is None
+
+    business_profile = {'id': 2, 'details': {'name': 'Dummy Inc'}}
+
+    record = statement_record(
+        profile=business_profile,
+        transaction=transaction_recipient,
+    )
 
-        assert expected_hashes[transaction_str] == hashed_value
+    assert record.account == 'Dummy'
+    assert record.value_minor == 15000
+    assert record.payee == 'Dummy Recipient'
 
 
 def test_api_endpoints():
@@ -221,6 +275,7 @@ def test_api_request():
         data={},
         params={},
         headers={'Authorization': f'Bearer {api_token}'},
+        timeout=TRANSFERWISE_API_TIMEOUT,
     )
     protocol_response.json.assert_called()
     assert response == dummy_response
@@ -232,6 +287,7 @@ def test_api_request():
         data={'foo': 'bar'},
         params={},
         headers={'Authorization': f'Bearer {api_token}'},
+        timeout=TRANSFERWISE_API_TIMEOUT,
     )
 
     # Test with URI args
@@ -257,8 +313,18 @@ def test_api_request():
         data={},
         params={},
         headers={'Authorization': f'Bearer {api_token}'},
+        timeout=TRANSFERWISE_API_TIMEOUT,
     )
 
+    # Near the deadline, the request timeout is shortened
+    dummy_api_request(uri_args=uri_args, call_timeout=lambda timeout: 1.5)
+    assert http_protocol.call_args[1]['timeout'] == 1.5
+
+    # Requests of a tenant are spaced out by its throttle
+    throttle = mock.Mock()
+    dummy_api_request(uri_args=uri_args, throttle=throttle)
+    throttle.assert_called_once_with()
+
 
 def test_get_profiles():
     api_request = mock.Mock(return_value='test_get_profiles')
@@ -348,13 +414,19 @@ def test_run_monitor(
     get_secret,
     dummy_latest_transactions,
     lastest_transactions_count,
+    memory_backlog,
+    memory_checkpoint,
 ):
     secret_key = 'DUMMY_SECRET'
     api_token = 'dummy-token'
     get_secret.return_value = {'api_token': api_token}
 
     # Getting latest transactions from TransferWise
-    mock_get_latest_trans = mock.Mock(return_value=dummy_latest_transactions)
+    mock_get_latest_trans = mock.Mock(return_value=statement_fetch(
+        transactions=dummy_latest_transactions,
+        skipped_statements=0,
+        fetched_units=['1/10/USD/2020-12-01T00:00:00Z'],
+    ))
 
     # Filtering only new transactions
     cut_transactions = int(lastest_transactions_count / 2)
@@ -365,9 +437,9 @@ def test_run_monitor(
     ddb_query.filter_new = mock.Mock(return_value=new_transactions)
     ddb_mock.query = mock.Mock(return_value=ddb_query)
 
-    # Inserting transactions in DDB
+    # Inserting transactions in DDB, all processed
     inserted_transactions = new_transactions
-    ddb_query.insert = mock.Mock(return_value=inserted_transactions)
+    ddb_query.insert = mock.Mock(return_value=[])
 
     mock_time_interval = mock.Mock()
 
@@ -375,6 +447,9 @@ def test_run_monitor(
         secret_key=secret_key,
         get_latest_transactions=mock_get_latest_trans,
         time_interval_func=mock_time_interval,
+        get_backlog_store=lambda: memory_backlog,
+        get_checkpoint_store=lambda: memory_checkpoint,
+        write_budget=10,
     )
 
     assert type(response) is dict
@@ -392,4 +467,430 @@ def test_run_monitor(
     mock_get_latest_trans.assert_called_with(
         api_token=api_token,
         time_interval=mock_time_interval(),
+        done_units=frozenset(),
+        commit=mock.ANY,
+    )
+
+    ddb_query.filter_new.assert_called_with(
+        transactions=dummy_latest_transactions)
+    ddb_query.insert.assert_called_with(transactions=new_transactions)
+
+    # Nothing was backlogged before nor after this run: no write
+    memory_backlog.save.assert_not_called()
+
+    # A cycle completed without a checkpoint: no write either
+    memory_checkpoint.save.assert_not_called()
+    memory_checkpoint.clear.assert_not_called()
+
+
+@mock.patch('transferwise.get_secret')
+@mock.patch('transferwise.ddb')
+def test_run_monitor_backlog(
+    ddb_mock,
+    get_secret,
+    dummy_latest_transactions,
+    memory_backlog,
+    memory_checkpoint,
+):
+    get_secret.return_value = {'api_token': 'dummy-token'}
+
+    ddb_query = mock.Mock()
+    ddb_query.filter_new = mock.Mock(side_effect=lambda transactions: [
+        t for t in transactions if t.transaction_hash not in stored
+    ])
+    ddb_query.insert = mock.Mock(
+        side_effect=lambda transactions: stored.update(
+            t.transaction_hash for t in transactions) or [])
+    ddb_mock.query = mock.Mock(return_value=ddb_query)
+
+    stored = set()
+    statement = dummy_latest_transactions[:7]
+
+    def fetch(transactions):
+        return mock.Mock(return_value=statement_fetch(
+            transactions=transactions,
+            skipped_statements=0,
+            fetched_units=[],
+        ))
+
+    run = partial(
+        run_monitor,
+        secret_key='DUMMY_SECRET',
+        time_interval_func=mock.Mock(),
+        get_backlog_store=lambda: memory_backlog,
+        get_checkpoint_store=lambda: memory_checkpoint,
+        write_budget=3,
+    )
+
+    response = run(get_latest_transactions=fetch(statement))
+
+    assert response['Transactions Count'] == {
+        'Retrieved from TransferWise': 7,
+        'New (unseen) transactions': 7,
+        'Transactions stored for alerting': 3,
+        'Backlogged for the next runs': 4,
+    }
+    memory_backlog.save.assert_called_with(statement[3:])
+
+    # The next run stores the backlog first, ahead of newer transactions
+    newer = dummy_latest_transactions[7:9]
+    run(get_latest_transactions=fetch(newer))
+
+    ddb_query.insert.assert_called_with(transactions=statement[3:6])
+    assert memory_backlog.load() == [statement[6]] + newer
+
+    # Until it is drained
+    for _ in range(2):
+        run(get_latest_transactions=fetch([]))
+
+    assert stored == {t.transaction_hash for t in statement + newer}
+    assert memory_backlog.load() == []
+
+
+@mock.patch('transferwise.get_secret')
+def test_run_monitor_unprocessed(
+    get_secret,
+    dummy_latest_transactions,
+    memory_backlog,
+    memory_checkpoint,
+):
+    '''Transactions left unprocessed by the insert are backlogged'''
+    get_secret.return_value = {'api_token': 'dummy-token'}
+    statement = dummy_latest_transactions[:4]
+
+    ddb_query = mock.Mock()
+    ddb_query.filter_new = mock.Mock(side_effect=lambda transactions: list(
+        transactions))
+    ddb_query.insert = mock.Mock(return_value=[statement[1]])
+
+    response = run_monitor(
+        secret_key='DUMMY_SECRET',
+        get_latest_transactions=mock.Mock(return_value=statement_fetch(
+            transactions=statement,
+            skipped_statements=0,
+            fetched_units=[],
+        )),
+        time_interval_func=mock.Mock(),
+        get_backlog_store=lambda: memory_backlog,
+        get_checkpoint_store=lambda: memory_checkpoint,
+        write_budget=3,
+        ddb_query=ddb_query,
+    )
+
+    assert response['Transactions Count'] == {
+        'Retrieved from TransferWise': 4,
+        'New (unseen) transactions': 4,
+        'Transactions stored for alerting': 2,
+        'Backlogged for the next runs': 2,
+    }
+    memory_backlog.save.assert_called_with([statement[1], statement[3]])
+
+
+@mock.patch('transferwise.api_endpoints')
+def test_get_latest_transactions(
+    api_endpoints,
+    transaction_merchant,
+    time_interval,
+):
+    api = api_endpoints.return_value
+    api.get_profiles.return_value = [
+        {'id': 1, 'details': {'firstName': 'John Doe'}},
+    ]
+    api.get_accounts.return_value = [
+        {
+            'id': 10,
+            'active': True,
+            'balances': [{'currency': c} for c in ['EUR', 'USD', 'GBP']],
+        },
+        {'id': 11, 'active': False, 'balances': [{'currency': 'EUR'}]},
+    ]
+    api.get_statement.return_value = {'transactions': [
+        {**transaction_merchant, 'type': 'DEBIT', 'referenceNumber': 'R1'},
+        {**transaction_merchant, 'type': 'CREDIT', 'referenceNumber': 'R2'},
+    ]}
+
+    fetch = get_latest_transactions(
+        api_token='TOKEN123',
+        time_interval=time_interval,
+        deadline_expired=lambda: False,
+    )
+
+    assert api.get_statement.call_count == 3
+    assert [t.reference for t in fetch.transactions] == ['R1'] * 3
+    assert all(t.transaction_hash for t in fetch.transactions)
+    assert fetch.skipped_statements == 0
+    assert fetch.fetched_units == [
+        f'1/10/{currency}/2020-12-01T00:00:00Z'
+        for currency in ['EUR', 'USD', 'GBP']
+    ]
+
+    # No statement fetch is started once the deadline is near
+    api.get_statement.reset_mock()
+
+    fetch = get_latest_transactions(
+        api_token='TOKEN123',
+        time_interval=time_interval,
+        deadline_expired=mock.Mock(side_effect=[False, True]),
+    )
+
+    assert api.get_statement.call_count == 1
+    assert len(fetch.transactions) == 1
+    assert fetch.skipped_statements == 2
+    assert fetch.fetched_units == ['1/10/EUR/2020-12-01T00:00:00Z']
+
+    # Units done by a previous run of the cycle are not fetched again, and
+    # slices split the interval in separate statements
+    api.get_statement.reset_mock()
+
+    fetch = get_latest_transactions(
+        api_token='TOKEN123',
+        time_interval=time_interval,
+        deadline_expired=lambda: False,
+        done_units={'1/10/EUR/2020-12-01T00:00:00Z'},
+        slice_period={'hours': 12},
+    )
+
+    assert api.get_statement.call_count == 5
+    assert fetch.fetched_units[0] == '1/10/EUR/2020-12-01T12:00:00Z'
+    assert api.get_statement.call_args[1]['interval'] == {
+        'start': time_interval['start'] + datetime.timedelta(hours=12),
+        'end': time_interval['end'],
+    }
+
+    # Units are committed every "commit_every", the last ones returned
+    commit = mock.Mock()
+
+    fetch = get_latest_transactions(
+        api_token='TOKEN123',
+        time_interval=time_interval,
+        deadline_expired=lambda: False,
+        commit=commit,
+        commit_every=2,
+    )
+
+    commit.assert_called_once()
+    assert [t.reference for t in commit.call_args[1]['transactions']] == \
+        ['R1'] * 2
+    assert commit.call_args[1]['fetched_units'] == [
+        f'1/10/{currency}/2020-12-01T00:00:00Z'
+        for currency in ['EUR', 'USD']
+    ]
+    assert len(fetch.transactions) == 1
+    assert fetch.fetched_units == ['1/10/GBP/2020-12-01T00:00:00Z']
+
+    # No statement is fetched once the lease is lost
+    api.get_statement.reset_mock()
+
+    with pytest.raises(LeaseLostException):
+        get_latest_transactions(
+            api_token='TOKEN123',
+            time_interval=time_interval,
+            deadline_expired=lambda: False,
+            lease_lost=lambda: True,
+        )
+
+    api.get_statement.assert_not_called()
+
+
+@mock.patch('transferwise.get_secret')
+@mock.patch('transferwise.ddb')
+def test_run_monitor_deadline(
+    ddb_mock,
+    get_secret,
+    dummy_latest_transactions,
+    memory_backlog,
+    memory_checkpoint,
+):
+    '''Past the deadline, new transactions are only backlogged'''
+    get_secret.return_value = {'api_token': 'dummy-token'}
+
+    ddb_query = ddb_mock.query.return_value
+    ddb_query.filter_new.side_effect = lambda transactions: transactions
+
+    response = run_monitor(
+        secret_key='DUMMY_SECRET',
+        get_latest_transactions=mock.Mock(return_value=statement_fetch(
+            transactions=dummy_latest_transactions[:3],
+            skipped_statements=4,
+            fetched_units=[],
+        )),
+        time_interval_func=mock.Mock(),
+        get_backlog_store=lambda: memory_backlog,
+        get_checkpoint_store=lambda: memory_checkpoint,
+        write_budget=10,
+        deadline_expired=lambda: True,
     )
+
+    ddb_query.insert.assert_not_called()
+    memory_backlog.save.assert_called_with(dummy_latest_transactions[:3])
+
+    assert response['Transactions Count']['Backlogged for the next runs'] == 3
+    assert response['Statements skipped'] == 4
+
+
+@mock.patch('transferwise.get_secret')
+@mock.patch('transferwise.ddb')
+def test_run_monitor_checkpoint(
+    ddb_mock,
+    get_secret,
+    dummy_latest_transactions,
+    memory_backlog,
+    memory_checkpoint,
+    time_interval,
+):
+    '''An interrupted cycle is resumed from its checkpoint'''
+    get_secret.return_value = {'api_token': 'dummy-token'}
+
+    ddb_query = ddb_mock.query.return_value
+    ddb_query.filter_new.side_effect = lambda transactions: transactions
+
+    run = partial(
+        run_monitor,
+        secret_key='DUMMY_SECRET',
+        get_backlog_store=lambda: memory_backlog,
+        get_checkpoint_store=lambda: memory_checkpoint,
+        write_budget=10,
+        deadline_expired=lambda: False,
+    )
+
+    # The first run is interrupted after two units
+    fetch = mock.Mock(return_value=statement_fetch(
+        transactions=dummy_latest_transactions[:2],
+        skipped_statements=3,
+        fetched_units=['unit-1', 'unit-2'],
+    ))
+    run(
+        get_latest_transactions=fetch,
+        time_interval_func=lambda: time_interval,
+    )
+
+    ddb_query.insert.assert_called_with(
+        transactions=dummy_latest_transactions[:2])
+    assert memory_checkpoint.load() == (
+        time_interval, frozenset({'unit-1', 'unit-2'}))
+
+    # The next one resumes the same interval, skipping the units done
+    fetch = mock.Mock(return_value=statement_fetch(
+        transactions=dummy_latest_transactions[2:3],
+        skipped_statements=0,
+        fetched_units=['unit-3', 'unit-4', 'unit-5'],
+    ))
+    response = run(
+        get_latest_transactions=fetch,
+        time_interval_func=mock.Mock(side_effect=AssertionError),
+    )
+
+    fetch.assert_called_with(
+        api_token='dummy-token',
+        time_interval=time_interval,
+        done_units=frozenset({'unit-1', 'unit-2'}),
+        commit=mock.ANY,
+    )
+    assert response['Statements resumed from a checkpoint'] == 2
+
+    # Completing the cycle, which clears the checkpoint
+    memory_checkpoint.clear.assert_called_once()
+    assert memory_checkpoint.load() is None
+
+
+@mock.patch('transferwise.get_secret')
+def test_run_monitor_incremental_commits(
+    get_secret,
+    dummy_latest_transactions,
+    memory_backlog,
+    memory_checkpoint,
+    time_interval,
+):
+    '''Units are checkpointed as they are committed, not at the end only'''
+    get_secret.return_value = {'api_token': 'dummy-token'}
+
+    stored = set()
+    ddb_query = mock.Mock()
+    ddb_query.filter_new = mock.Mock(side_effect=lambda transactions: [
+        t for t in transactions if t.transaction_hash not in stored
+    ])
+    ddb_query.insert = mock.Mock(
+        side_effect=lambda transactions: stored.update(
+            t.transaction_hash for t in transactions) or [])
+
+    def fetch(api_token, time_interval, done_units, commit):
+        commit(
+            transactions=dummy_latest_transactions[:3],
+            fetched_units=['unit-1'],
+        )
+        assert memory_checkpoint.load().done_units == {'unit-1'}
+
+        commit(
+            transactions=dummy_latest_transactions[3:6],
+            fetched_units=['unit-2'],
+        )
+        assert memory_checkpoint.load().done_units == {'unit-1', 'unit-2'}
+
+        # The run fails before committing its last unit
+        raise RuntimeError('Connection reset')
+
+    with pytest.raises(RuntimeError):
+        run_monitor(
+            secret_key='DUMMY_SECRET',
+            get_latest_transactions=fetch,
+            time_interval_func=lambda: time_interval,
+            get_backlog_store=lambda: memory_backlog,
+            get_checkpoint_store=lambda: memory_checkpoint,
+            write_budget=4,
+            deadline_expired=lambda: False,
+            ddb_query=ddb_query,
+        )
+
+    # The budget is shared by the commits: the rest was backlogged
+    assert stored == {
+        t.transaction_hash for t in dummy_latest_transactions[:4]}
+    assert memory_backlog.load() == dummy_latest_transactions[4:6]
+    assert ddb_query.filter_new.call_args_list[1] == mock.call(
+        transactions=dummy_latest_transactions[3:6])
+    assert memory_checkpoint.load() == (
+        time_interval, frozenset({'unit-1', 'unit-2'}))
+
+
+@mock.patch('transferwise.get_secret')
+def test_run_monitor_lease_lost(
+    get_secret,
+    dummy_latest_transactions,
+    memory_backlog,
+    memory_checkpoint,
+    time_interval,
+):
+    '''A run that lost its lease writes nothing more'''
+    get_secret.return_value = {'api_token': 'dummy-token'}
+    ddb_query = mock.Mock()
+    ddb_query.filter_new = mock.Mock(
+        side_effect=lambda transactions: list(transactions))
+    ddb_query.insert = mock.Mock(return_value=[])
+    lease_lost = mock.Mock(return_value=False)
+
+    def fetch(api_token, time_interval, done_units, commit):
+        commit(
+            transactions=dummy_latest_transactions[:2],
+            fetched_units=['unit-1'],
+        )
+        lease_lost.return_value = True
+        commit(
+            transactions=dummy_latest_transactions[2:4],
+            fetched_units=['unit-2'],
+        )
+
+    with pytest.raises(LeaseLostException):
+        run_monitor(
+            secret_key='DUMMY_SECRET',
+            get_latest_transactions=fetch,
+            time_interval_func=lambda: time_interval,
+            get_backlog_store=lambda: memory_backlog,
+            get_checkpoint_store=lambda: memory_checkpoint,
+            write_budget=0,
+            deadline_expired=lambda: False,
+            ddb_query=ddb_query,
+            lease_lost=lease_lost,
+        )
+
+    ddb_query.insert.assert_called_once_with(
+        transactions=dummy_latest_transactions[:2])
+    assert memory_checkpoint.load().done_units == {'unit-1'}
@@ -0,0 +1,118 @@
+#!/usr/bin/python3 Python3
+'''Compact, immutable transaction record carried through the monitor
+
+Statement entries are converted once on the way in (see transferwise.py);
+the notifier details and the DynamoDB item are only built on the way out.
+'''
+from collections import namedtuple
+from typing import Callable, Optional
+
+from details_codec import encode_details
+
+
+class TransactionRecord(namedtuple('TransactionRecord', [
+    'account',
+    'currency',
+    'value_minor',  # Absolute value, in hundredths of the currency unit
+    'payee',
+    'timestamp',  # Statement date, as an ISO 8601 string
+    'reference',  # TransferWise reference number, when the statement has one
+    'transaction_hash',  # Fingerprint (see fingerprint.py)
+    'legacy_hash',  # Previous fingerprint, only set while still looked up
+])):
+    # No per-instance __dict__, unlike a plain subclass
+    __slots__ = ()
+
+
+def minor_units(value: float) -> int:
+    '''Absolute value in hundredths, rounded the way it is displayed'''
+    return int('{:.2f}'.format(abs(value)).replace('.', ''))
+
+
+def format_minor_units(value_minor: int) -> str:
+    return f'{value_minor // 100}.{value_minor % 100:02d}'
+
+
+def details(
+    account: str,
+    currency: str,
+    value_minor: int,
+    payee: str,
+) -> dict:
+    '''Transaction details, in the format the notifier alerts on'''
+    return {
+        'account': account,
+        'currency': currency,
+        'value': format_minor_units(value_minor),
+        'payee': payee,
+    }
+
+
+def record_details(record: TransactionRecord) -> dict:
+    return details(
+        account=record.account,
+        currency=record.currency,
+        value_minor=record.value_minor,
+        payee=record.payee,
+    )
+
+
+def new_record(
+    account: str,
+    currency: str,
+    value_minor: int,
+    payee: str,
+    timestamp: Optional[str] = None,
+    reference: Optional[str] = None,
+) -> TransactionRecord:
+    '''Build a record, fingerprinted later by fingerprint.hash_transactions'''
+    return TransactionRecord(
+        account=account,
+        currency=currency,
+        value_minor=value_minor,
+        payee=payee,
+        timestamp=timestamp,
+        reference=reference,
+        transaction_hash=None,
+        legacy_hash=None,
+    )
+
+
+class KeyType():
+    STRING = 'S'  # Hexadecimal fingerprint
+    BINARY = 'B'  # Raw fingerprint bytes, half the size
+
+
+def key_attribute(
+    transaction_hash: str,
+    key_type: str = KeyType.STRING,
+) -> dict:
+    '''DynamoDB attribute holding a (hexadecimal) fingerprint'''
+    if key_type == KeyType.BINARY:
+        return {'B': bytes.fromhex(transaction_hash)}
+
+    if key_type != KeyType.STRING:
+        raise ValueError(f'Unsupported key type: {key_type}')
+
+    return {'S': transaction_hash}
+
+
+def attribute_hash(attribute: dict) -> str:
+    '''Hexadecimal fingerprint held by a DynamoDB attribute of any key type'''
+    if 'B' in attribute:
+        return bytes(attribute['B']).hex()
+
+    return attribute['S']
+
+
+def to_dynamodb_item(
+    record: TransactionRecord,
+    ttl: int,
+    key_type: str = KeyType.STRING,
+    encode_details: Callable = encode_details,
+) -> dict:
+    return {
+        'transaction-hash': key_attribute(record.transaction_hash, key_type),
+        'details': encode_details(record_details(record)),
+        'ttl': {'N': str(ttl)},
+    }
@@ -2,71 +2,201 @@
 from collections import namedtuple
 import datetime
 from functools import partial
-import hashlib
-import json
 import logging
 import os
-from typing import Callable, Dict, List, Optional, Tuple, Union
+from typing import Callable, Container, Dict, List, Optional, Tuple, Union
 
-from get_aws_secret import get_secret
-import requests
+import deadline
+import metrics
+from secret import get_secret
 
-from datetime_routines import last_24_hours_interval, utc_to_str
+import backlog
+import checkpoint
+from datetime_routines import (
+    interval_slices, last_24_hours_interval, utc_to_str,
+)
 import ddb
+from fingerprint import hash_transactions
+import lease
+from transaction_record import minor_units, new_record, TransactionRecord
 
 
 log = logging.getLogger(os.environ.get('LOGGER_NAME', 'MONITOR_LOGGER'))
 
+
+def http_get(url: str, **kwargs):
+    # requests is imported on first use, outside of the import-time path
+    import requests
+
+    return requests.get(url, **kwargs)
+
+
 LOCAL_ENV = os.environ.get('AWS_SAM_LOCAL') == 'true'
 SECRET_ARN = os.environ.get('SECRET_ARN')
-API_BASE_URI = 'https://api.transferwise.com'
+# Overridable to point at a local stand-in (see local_stub_servers.py)
+API_BASE_URI = os.environ.get(
+    'TRANSFERWISE_API_BASE_URI', 'https://api.transferwise.com')
 API_ENDPOINT_SPECS = {
     'get_profiles': {
         'uri': '/v1/profiles',
-        'protocol': requests.get,
+        'protocol': http_get,
     },
     'get_accounts': {
         'uri': '/v1/borderless-accounts?profileId={profile_id}',
-        'protocol': requests.get,
+        'protocol': http_get,
     },
     'get_statement': {
         'uri': '/v3/profiles/{profile_id}/borderless-accounts/{account_id}/statement.json',  # NOQA
-        'protocol': requests.get,
+        'protocol': http_get,
     },
 }
 DEFAULT_STATEMENT_TYPE = 'COMPACT'
 DEFAULT_UNDETERMINED_PAYEE = 'Undetermined'
+# Statement fields uniquely identifying a transaction, by preference
+REFERENCE_FIELDS = ('referenceNumber', 'id')
 DEFAULT_TIME_INTERVAL_FUNC = last_24_hours_interval
 
+# Seconds a TransferWise API request may take, shortened near the deadline
+TRANSFERWISE_API_TIMEOUT = float(os.environ.get('TRANSFERWISE_API_TIMEOUT', 10))  # NOQA
+# Seconds kept before the deadline to store what was fetched: no statement
+# fetch is started past that point
+MONITOR_COMMIT_RESERVE = float(
+    os.environ.get('MONITOR_COMMIT_RESERVE_SECONDS', 10))
+# Statement units fetched between two commits (store, backlog, checkpoint):
+# a failing run only fetches again the units of its last uncommitted step
+MONITOR_CHECKPOINT_EVERY_UNITS = int(
+    os.environ.get('MONITOR_CHECKPOINT_EVERY_UNITS', 25))
+
+# Hours of the interval slices fetched as separate statements; zero fetches
+# the whole interval at once. Slices bound each fetch over large windows.
+MONITOR_INTERVAL_SLICE_HOURS = float(
+    os.environ.get('MONITOR_INTERVAL_SLICE_HOURS', 0))
+DEFAULT_SLICE_PERIOD = {'hours': MONITOR_INTERVAL_SLICE_HOURS} \
+    if MONITOR_INTERVAL_SLICE_HOURS > 0 else None
+
+statement_fetch = namedtuple('statement_fetch', [
+    'transactions',
+    'skipped_statements',  # Left for the next run, as the deadline was near
+    'fetched_units',  # Statement units fetched and not committed yet
+])
+
+
+def check_lease(lease_lost: Callable = lease.lost) -> None:
+    '''Stop a run whose lease was lost, before it fetches or writes more'''
+    if lease_lost():
+        raise lease.LeaseLostException('Monitor lease lost to another run')
+
 
 def get_latest_transactions(
         api_token: str,
         time_interval: Dict[str, datetime.datetime],
-) -> Dict[str, str]:
-    api = api_endpoints(api_token=api_token)
-
-    return hash_transactions([
-        {
-            'account': profile['details'].get(
-                'firstName',  # Personal account
-                profile['details'].get('name', '')  # Business account
-            ).split(' ')[0],  # Extract only the first word
-            'currency': transaction['amount']['currency'],
-            'value': '{:.2f}'.format(abs(transaction['amount']['value'])),
-            'payee': get_payee(transaction),
-        }
-        for profile in api.get_profiles()
-        for account in api.get_accounts(profile_id=profile['id'])
-        for balance in account['balances']
-        for transaction in api.get_statement(
-            profile_id=profile['id'],
-            account_id=account['id'],
-            currency=balance['currency'],
-            interval=time_interval,
-        )['transactions']
-        if account['active'] is True
-        if transaction['type'] == 'DEBIT'
-    ])
+        deadline_expired: Callable = partial(
+            deadline.expired, reserve=MONITOR_COMMIT_RESERVE),
+        done_units: Container[str] = frozenset(),
+        slice_period: Optional[dict] = DEFAULT_SLICE_PERIOD,
+        throttle: Optional[Callable] = None,
+        commit: Optional[Callable] = None,
+        commit_every: int = MONITOR_CHECKPOINT_EVERY_UNITS,
+        lease_lost: Callable = lease.lost,
+) -> statement_fetch:
+    '''Fetch the debits of every statement, until the deadline gets near
+
+    Statements not fetched in time are counted as skipped; their debits are
+    fetched by the next run, which resumes the same cycle from its checkpoint.
+    Units in "done_units" were fetched by a previous run of the cycle.
+    Every "commit_every" units, the debits fetched so far are handed to
+    "commit"; those fetched since the last commit are returned.
+    '''
+    api = api_endpoints(api_token=api_token, throttle=throttle)
+    slices = interval_slices(time_interval, slice_period=slice_period)
+    hash_records = metrics.timed('hash_transactions', hash_transactions)
+
+    transactions = []
+    fetched_units = []
+    skipped_statements = 0
+
+    for profile in api.get_profiles():
+        for account in api.get_accounts(profile_id=profile['id']):
+            if account['active'] is not True:
+                continue
+
+            for balance in account['balances']:
+                for interval_slice in slices:
+                    unit = checkpoint.statement_unit(
+                        profile_id=profile['id'],
+                        account_id=account['id'],
+                        currency=balance['currency'],
+                        interval_slice=interval_slice,
+                    )
+
+                    if unit in done_units:
+                        continue
+
+                    if skipped_statements or deadline_expired():
+                        skipped_statements += 1
+                        continue
+
+                    check_lease(lease_lost)
+
+                    statement = api.get_statement(
+                        profile_id=profile['id'],
+                        account_id=account['id'],
+                        currency=balance['currency'],
+                        interval=interval_slice,
+                    )
+
+                    transactions.extend(
+                        statement_record(
+                            profile=profile, transaction=transaction)
+                        for transaction in statement['transactions']
+                        if transaction['type'] == 'DEBIT'
+                    )
+                    fetched_units.append(unit)
+
+                    if commit is not None and \
+                            len(fetched_units) >= commit_every:
+                        commit(
+                            transactions=hash_records(transactions),
+                            fetched_units=fetched_units,
+                        )
+                        transactions = []
+                        fetched_units = []
+
+    if skipped_statements:
+        log.warning(f'## Deadline near: skipped {skipped_statements} '
+                    'statements')
+
+    return statement_fetch(
+        transactions=hash_records(transactions),
+        skipped_statements=skipped_statements,
+        fetched_units=fetched_units,
+    )
+
+
+def statement_record(profile: dict, transaction: dict) -> TransactionRecord:
+    '''Convert a statement entry, the only place TransferWise data is read'''
+    return new_record(
+        account=profile['details'].get(
+            'firstName',  # Personal account
+            profile['details'].get('name', '')  # Business account
+        ).split(' ')[0],  # Extract only the first word
+        currency=transaction['amount']['currency'],
+        value_minor=minor_units(transaction['amount']['value']),
+        payee=get_payee(transaction),
+        timestamp=transaction.get('date'),
+        reference=get_reference(transaction),
+    )
+
+
+def get_reference(
+        transaction: dict,
+        reference_fields: Tuple[str] = REFERENCE_FIELDS,
+        ) -> Optional[str]:
+    for field in reference_fields:
+        if transaction.get(field):
+            return str(transaction[field])
+
+    return None
 
 
 def get_payee(
@@ -84,20 +214,6 @@ def get_payee(
         return default_payee
 
 
-def hash_transactions(transactions):
-    return [
-        {
-            'transaction-hash': md5(json.dumps(transaction)),
-            'details': transaction,
-        }
-        for transaction in transactions
-    ]
-
-
-def md5(data: str) -> str:
-    return hashlib.md5(data.encode('utf-8')).hexdigest()
-
-
 def api_request(
         endpoint: str,
         api_token: str,
@@ -106,6 +222,9 @@ def api_request(
         uri_args: Dict[str, str] = {},
         post_data: Dict[str, str] = {},
         query_strs: Dict[str, str] = {},
+        timeout: float = TRANSFERWISE_API_TIMEOUT,
+        call_timeout: Callable = deadline.call_timeout,
+        throttle: Optional[Callable] = None,
         ) -> Union[dict, list]:
     http_protocol = endpoint_specs[endpoint]['protocol']
     endpoint_uri = endpoint_specs[endpoint]['uri'].format(**uri_args)
@@ -115,11 +234,16 @@ def api_request(
     # log.info(f'.... Query strings: {json.dumps(query_strs)}')
     # log.info(f'.... POST Data: {json.dumps(post_data)}\n')
 
+    # Spaces out the requests made with a token (see tenants.rate_limiter)
+    if throttle is not None:
+        throttle()
+
     response = http_protocol(
         final_url,
         data=post_data,
         params=query_strs,
         headers={'Authorization': f'Bearer {api_token}'},
+        timeout=call_timeout(timeout),
     )
 
     # log.info(f'.... Response: {json.dumps(response.json())}')
@@ -134,6 +258,7 @@ def api_endpoints(
         api_request: Callable = api_request,
         statement_type: str = DEFAULT_STATEMENT_TYPE,
         convert_utc_to_str: Callable = utc_to_str,
+        throttle: Optional[Callable] = None,
         ) -> Tuple[Callable]:
     operations = namedtuple('operations', [
         'get_profiles',
@@ -147,6 +272,7 @@ def api_endpoints(
         api_token=api_token,
         base_uri=base_uri,
         endpoint_specs=endpoint_specs,
+        throttle=throttle,
     )
 
     get_profiles_func = partial(
@@ -167,9 +293,9 @@ def api_endpoints(
     )
 
     return operations(
-        get_profiles=get_profiles_func,
-        get_accounts=get_accounts_func,
-        get_statement=get_statement_func,
+        get_profiles=metrics.timed('get_profiles', get_profiles_func),
+        get_accounts=metrics.timed('get_accounts', get_accounts_func),
+        get_statement=metrics.timed('get_statement', get_statement_func),
     )
 
 
@@ -212,31 +338,167 @@ def run_monitor(
     secret_key: str = SECRET_ARN,
     get_latest_transactions: Callable = get_latest_transactions,
     time_interval_func: Optional[Callable] = DEFAULT_TIME_INTERVAL_FUNC,
+    get_backlog_store: Callable = backlog.get_backlog_store,
+    get_checkpoint_store: Callable = checkpoint.get_checkpoint_store,
+    write_budget: int = backlog.MAX_NEW_TRANSACTIONS_PER_EXECUTION,
+    deadline_expired: Callable = deadline.expired,
+    secret: Optional[dict] = None,
+    ddb_query: Optional[Tuple[Callable]] = None,
+    lease_lost: Callable = lease.lost,
 ) -> dict:
-    secret = get_secret(secret_key, load_json=True)
+    # Multi-tenant runs pass the secret (loaded in batch) and a query sharing
+    # its writer between tenants
+    if secret is None:
+        with metrics.timer('get_secret'):
+            secret = get_secret(secret_key, load_json=True)
+
     api_token = secret['api_token']
 
-    tw_transactions = get_latest_transactions(
-        api_token=api_token,
-        time_interval=time_interval_func(),
-    )
+    checkpoint_store = get_checkpoint_store()
+
+    # An interrupted cycle is resumed over its own time interval
+    with metrics.timer('load_checkpoint'):
+        previous_checkpoint = checkpoint_store.load()
 
-    ddb_query = ddb.query()
+    if previous_checkpoint is not None:
+        log.info(f'## Resuming a monitoring cycle: '
+                 f'{len(previous_checkpoint.done_units)} units done')
+        time_interval = previous_checkpoint.interval
+        done_units = previous_checkpoint.done_units
+    else:
+        time_interval = time_interval_func()
+        done_units = frozenset()
+
+    if ddb_query is None:
+        ddb_query = ddb.query()
+
+    backlog_store = get_backlog_store()
+
+    # Transactions left over by previous runs are stored first
+    with metrics.timer('load_backlog'):
+        backlogged = backlog_store.load()
+
+    state = {
+        'backlog': backlogged,
+        'filtered': 0,  # Leading backlog transactions known not to be stored
+        'done_units': done_units,
+        'checkpoint': previous_checkpoint,
+        'budget': write_budget,
+        'retrieved': 0,
+        'new': 0,
+        'inserted': 0,
+    }
 
-    # Filter only transactions that aren't already in DynamoDB
-    new_transactions = ddb_query.filter_new(transactions=tw_transactions)
+    def commit(
+        transactions: List[TransactionRecord],
+        fetched_units: List[str],
+        complete: bool = False,
+    ) -> None:
+        '''Store or backlog the transactions, then checkpoint their units'''
+        # Another run took over the cycle: nothing more is written
+        check_lease(lease_lost)
+
+        pending = backlog.merge_backlog(state['backlog'], transactions)
+        known = state['filtered']
+
+        # Filter only transactions that aren't already in DynamoDB (the loaded
+        # backlog included, in case a run stored it but failed to save it)
+        with metrics.timer('filter_new'):
+            new_transactions = pending[:known] + ddb_query.filter_new(
+                transactions=pending[known:])
+
+        # The write budget is shared by all the commits of the run
+        if write_budget > 0 and state['budget'] <= 0:
+            inserted, overflow = [], new_transactions
+        else:
+            inserted, overflow = backlog.split_budget(
+                new_transactions, budget=state['budget'])
+
+        # Past the deadline, only the (single item) backlog is written
+        if deadline_expired():
+            log.warning('## Deadline reached: backlogging all new '
+                        'transactions')
+            inserted, overflow = [], new_transactions
+
+        # Insert the new transactions in DynamoDB
+        if len(inserted) > 0:
+            with metrics.timer('insert'):
+                unprocessed = ddb_query.insert(transactions=inserted)
+
+            # Writes still throttled after the retries go to the next runs
+            if len(unprocessed) > 0:
+                log.warning(f'## {len(unprocessed)} transactions not stored: '
+                            f'backlogging them')
+                inserted = [t for t in inserted if t not in unprocessed]
+                overflow = unprocessed + overflow
+
+        check_lease(lease_lost)
+
+        # Saved after inserting: if the insert fails, the backlog is retried
+        # as is
+        with metrics.timer('save_backlog'):
+            backlog.save_backlog(
+                backlog_store,
+                transactions=overflow,
+                previous_count=len(state['backlog']),
+            )
+
+        # Fetched units are committed once their transactions are stored or
+        # backlogged: only then are they skipped by the next run of the cycle
+        done = state['done_units'] | frozenset(fetched_units)
+
+        with metrics.timer('save_checkpoint'):
+            checkpoint.save_checkpoint(
+                checkpoint_store,
+                interval=time_interval,
+                done_units=done,
+                complete=complete,
+                previous=state['checkpoint'],
+            )
+
+        state.update(
+            backlog=overflow,
+            filtered=len(overflow),
+            done_units=done,
+            checkpoint=None if complete else checkpoint.monitor_checkpoint(
+                interval=time_interval, done_units=done),
+            budget=state['budget'] - len(inserted),
+            retrieved=state['retrieved'] + len(transactions),
+            new=state['new'] + len(new_transactions) - known,
+            inserted=state['inserted'] + len(inserted),
+        )
+
+    with metrics.timer('get_latest_transactions'):
+        fetch = get_latest_transactions(
+            api_token=api_token,
+            time_interval=time_interval,
+            done_units=done_units,
+            commit=commit,
+        )
+
+    # The last units fetched complete the cycle, unless some were skipped
+    commit(
+        transactions=fetch.transactions,
+        fetched_units=fetch.fetched_units,
+        complete=fetch.skipped_statements == 0,
+    )
 
-    # Insert the new transactions in DynamoDB
-    inserted = []
-    if len(new_transactions) > 0:
-        inserted = ddb_query.insert(transactions=new_transactions)
+    metrics.count('transactions_retrieved', state['retrieved'])
+    metrics.count('transactions_new', state['new'])
+    metrics.count('transactions_inserted', state['inserted'])
+    metrics.count('transactions_backlogged', len(state['backlog']))
+    metrics.count('statements_skipped', fetch.skipped_statements)
 
     return {
         'Transactions Count': {
-            'Retrieved from TransferWise': len(tw_transactions),
-            'New (unseen) transactions': len(new_transactions),
-            'Transactions stored for alerting': len(inserted),
-        }
+            'Retrieved from TransferWise': state['retrieved'],
+            'New (unseen) transactions': state['new'],
+            'Transactions stored for alerting': state['inserted'],
+            'Backlogged for the next runs': len(state['backlog']),
+        },
+        # Partial runs ended early as the invocation deadline got near
+        'Statements skipped': fetch.skipped_statements,
+        'Statements resumed from a checkpoint': len(done_units),
     }
 
 
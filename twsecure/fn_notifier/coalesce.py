@@ -0,0 +1,450 @@
+from collections import namedtuple
+from functools import partial
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Iterable, List, Optional, TYPE_CHECKING
+import uuid
+
+import aws_clients
+
+if TYPE_CHECKING:
+    import botocore  # NOQA
+
+
+log = logging.getLogger(os.environ.get('LOGGER_NAME', 'NOTIFIER_LOGGER'))
+
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME')
+
+# Transactions arriving within the window are sent as a single alert; zero
+# (default) disables coalescing and every stream batch is alerted right away
+ALERT_COALESCE_WINDOW = int(os.environ.get('ALERT_COALESCE_WINDOW_SECONDS', 0))
+# Hard latency cap: oldest buffered transaction is never held longer than this
+ALERT_COALESCE_MAX_DELAY = int(os.environ.get('ALERT_COALESCE_MAX_DELAY_SECONDS', 300))  # NOQA
+# Debits of at least this value flush the buffer immediately
+ALERT_COALESCE_FLUSH_VALUE = float(os.environ.get('ALERT_COALESCE_FLUSH_VALUE', 500))  # NOQA
+
+BUFFER_KEY = {'pk': {'S': 'alert-buffer'}, 'sk': {'S': 'default'}}
+
+# State of the local stand-in buffer, persisted across warm invocations
+MEMORY_BUFFER_STATE = {}
+
+# A claimed buffer is being alerted by one invocation, and can't be claimed by
+# another one until the claim expires: longer than the function timeout
+ALERT_COALESCE_CLAIM_TIMEOUT = int(os.environ.get('ALERT_COALESCE_CLAIM_TIMEOUT_SECONDS', 150))  # NOQA
+# Attempts at removing alerted transactions while others are appended
+BUFFER_COMPLETE_ATTEMPTS = 3
+
+alert_buffer = namedtuple('alert_buffer', 'transactions first_seen last_seen')
+buffer_store = namedtuple('buffer_store', 'append peek claim complete release')
+coalescer = namedtuple('coalescer', 'add flush complete restore')
+
+
+def remaining_transactions(
+    transactions: List[dict],
+    transaction_hashes: Iterable[str],
+) -> List[dict]:
+    '''Buffered transactions not among the alerted ones'''
+    alerted = set(transaction_hashes)
+
+    return [t for t in transactions if t['transaction-hash'] not in alerted]
+
+
+def memory_buffer_store(state: dict = MEMORY_BUFFER_STATE) -> buffer_store:
+    '''Local stand-in for the buffer, kept in the container memory'''
+    lock = threading.Lock()
+
+    def append(transactions: List[dict], now: float) -> alert_buffer:
+        with lock:
+            current = state.get('buffer')
+
+            state['buffer'] = alert_buffer(
+                transactions=(current.transactions if current else []) +
+                list(transactions),
+                first_seen=current.first_seen if current else now,
+                last_seen=now,
+            )
+
+            return state['buffer']
+
+    def peek() -> Optional[alert_buffer]:
+        return state.get('buffer')
+
+    def claim(
+        owner: str,
+        now: float,
+        timeout: float,
+    ) -> Optional[alert_buffer]:
+        with lock:
+            holder = state.get('claim')
+
+            if 'buffer' not in state or \
+                    holder is not None and holder[1] > now:
+                return None
+
+            state['claim'] = (owner, now + timeout, now)
+            return state['buffer']
+
+    def complete(owner: str, transaction_hashes: Iterable[str]) -> None:
+        with lock:
+            holder = state.get('claim')
+
+            if holder is None or holder[0] != owner:
+                log.warning('## Alert buffer claim lost before completion')
+                return
+
+            del state['claim']
+            buffer = state.pop('buffer')
+            remaining = remaining_transactions(
+                buffer.transactions, transaction_hashes)
+
+            if len(remaining) > 0:
+                # Appended during the alert: held from the claim onwards
+                state['buffer'] = buffer._replace(
+                    transactions=remaining, first_seen=holder[2])
+
+    def release(owner: str) -> None:
+        with lock:
+            if state.get('claim', (None,))[0] == owner:
+                del state['claim']
+
+    return buffer_store(
+        append=append,
+        peek=peek,
+        claim=claim,
+        complete=complete,
+        release=release,
+    )
+
+
+def dynamodb_buffer_store(
+    table_name: str = STATE_TABLE_NAME,
+    client: Optional['botocore.client.BaseClient'] = None,
+    item_ttl: int = ALERT_COALESCE_MAX_DELAY * 10,
+    complete_attempts: int = BUFFER_COMPLETE_ATTEMPTS,
+) -> buffer_store:
+    '''Buffer kept in a single DynamoDB item, shared by all containers
+
+    Claiming marks the item with its owner, rather than deleting it: the
+    transactions stay buffered until their alert is delivered, so a failed or
+    interrupted send leaves them for the next flush once the claim expires.
+    '''
+    if client is None:
+        client = aws_clients.get_client('dynamodb')
+
+    from botocore.exceptions import ClientError
+
+    def is_condition_failure(exc: ClientError) -> bool:
+        return exc.response['Error']['Code'] == \
+            'ConditionalCheckFailedException'
+
+    def parse_item(item: Optional[dict]) -> Optional[alert_buffer]:
+        if not item:
+            return None
+
+        return alert_buffer(
+            transactions=[
+                json.loads(t['S']) for t in item['transactions']['L']
+            ],
+            first_seen=float(item['first_seen']['N']),
+            last_seen=float(item['last_seen']['N']),
+        )
+
+    def append(transactions: List[dict], now: float) -> alert_buffer:
+        response = client.update_item(
+            TableName=table_name,
+            Key=BUFFER_KEY,
+            UpdateExpression=(
+                'SET #tx = list_append(if_not_exists(#tx, :empty), :new), '
+                '#first = if_not_exists(#first, :now), #last = :now, '
+                '#ttl = :ttl'
+            ),
+            ExpressionAttributeNames={
+                '#tx': 'transactions',
+                '#first': 'first_seen',
+                '#last': 'last_seen',
+                '#ttl': 'ttl',
+            },
+            ExpressionAttributeValues={
+                ':empty': {'L': []},
+                ':new': {'L': [{'S': json.dumps(t)} for t in transactions]},
+                ':now': {'N': str(now)},
+                ':ttl': {'N': str(int(now) + item_ttl)},
+            },
+            ReturnValues='ALL_NEW',
+        )
+
+        return parse_item(response['Attributes'])
+
+    def get_item() -> Optional[dict]:
+        response = client.get_item(
+            TableName=table_name,
+            Key=BUFFER_KEY,
+            ConsistentRead=True,
+        )
+
+        return response.get('Item')
+
+    def peek() -> Optional[alert_buffer]:
+        return parse_item(get_item())
+
+    def claim(
+        owner: str,
+        now: float,
+        timeout: float,
+    ) -> Optional[alert_buffer]:
+        # The conditional update is atomic: only one invocation at a time
+        # holds the claim on the buffer
+        try:
+            response = client.update_item(
+                TableName=table_name,
+                Key=BUFFER_KEY,
+                UpdateExpression='SET #owner = :owner, #until = :until, '
+                                 '#at = :now',
+                ConditionExpression='attribute_exists(pk) AND '
+                                    '(attribute_not_exists(#until) OR '
+                                    '#until < :now)',
+                ExpressionAttributeNames={
+                    '#owner': 'claimed_by',
+                    '#until': 'claimed_until',
+                    '#at': 'claimed_at',
+                },
+                ExpressionAttributeValues={
+                    ':owner': {'S': owner},
+                    ':until': {'N': str(now + timeout)},
+                    ':now': {'N': str(now)},
+                },
+                ReturnValues='ALL_NEW',
+            )
+
+        except ClientError as exc:
+            if not is_condition_failure(exc):
+                raise
+
+            return None
+
+        return parse_item(response['Attributes'])
+
+    def complete(owner: str, transaction_hashes: Iterable[str]) -> None:
+        transaction_hashes = set(transaction_hashes)
+
+        for _ in range(complete_attempts):
+            item = get_item()
+
+            if not item or item.get('claimed_by', {}).get('S') != owner:
+                log.warning('## Alert buffer claim lost before completion')
+                return
+
+            remaining = [
+                t for t in item['transactions']['L']
+                if json.loads(t['S'])['transaction-hash'] not in
+                transaction_hashes
+            ]
+            # Unchanged by appends since it was read
+            condition = {
+                'ConditionExpression':
+                    '#owner = :owner AND size(#tx) = :count',
+                'ExpressionAttributeNames': {
+                    '#owner': 'claimed_by',
+                    '#tx': 'transactions',
+                },
+                'ExpressionAttributeValues': {
+                    ':owner': {'S': owner},
+                    ':count': {'N': str(len(item['transactions']['L']))},
+                },
+            }
+
+            try:
+                if len(remaining) == 0:
+                    client.delete_item(
+                        TableName=table_name, Key=BUFFER_KEY, **condition)
+                else:
+                    # Appended during the alert: held from the claim onwards
+                    client.put_item(
+                        TableName=table_name,
+                        Item={
+                            **BUFFER_KEY,
+                            'transactions': {'L': remaining},
+                            'first_seen': item['claimed_at'],
+                            'last_seen': item['last_seen'],
+                            'ttl': item['ttl'],
+                        },
+                        **condition,
+                    )
+
+                return
+
+            except ClientError as exc:
+                if not is_condition_failure(exc):
+                    raise
+
+        # Alerted transactions are sent again once the claim expires, and
+        # dropped there by the alert ledger
+        log.warning('## Could not complete the alert buffer claim')
+
+    def release(owner: str) -> None:
+        try:
+            client.update_item(
+                TableName=table_name,
+                Key=BUFFER_KEY,
+                UpdateExpression='REMOVE #owner, #until, #at',
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={
+                    '#owner': 'claimed_by',
+                    '#until': 'claimed_until',
+                    '#at': 'claimed_at',
+                },
+                ExpressionAttributeValues={':owner': {'S': owner}},
+            )
+
+        except ClientError as exc:
+            if not is_condition_failure(exc):
+                raise
+
+    return buffer_store(
+        append=append,
+        peek=peek,
+        claim=claim,
+        complete=complete,
+        release=release,
+    )
+
+
+def get_buffer_store(table_name: Optional[str] = STATE_TABLE_NAME):
+    if table_name:
+        return dynamodb_buffer_store(table_name=table_name)
+
+    return memory_buffer_store()
+
+
+def should_flush(
+    buffer: Optional[alert_buffer],
+    now: float,
+    window: int = ALERT_COALESCE_WINDOW,
+    max_delay: int = ALERT_COALESCE_MAX_DELAY,
+    flush_value: float = ALERT_COALESCE_FLUSH_VALUE,
+) -> bool:
+    if buffer is None or len(buffer.transactions) == 0:
+        return False
+
+    return (
+        now - buffer.last_seen >= window or
+        now - buffer.first_seen >= max_delay or
+        any(
+            float(t['details']['value']) >= flush_value
+            for t in buffer.transactions
+        )
+    )
+
+
+def unique_transactions(transactions: List[dict]) -> List[dict]:
+    '''Drop stream redeliveries buffered more than once'''
+    return list({t['transaction-hash']: t for t in transactions}.values())
+
+
+def add_transactions(
+    transactions: List[dict],
+    store: buffer_store,
+    owner: str,
+    now: Callable = time.time,
+    should_flush: Callable = should_flush,
+    claim_timeout: int = ALERT_COALESCE_CLAIM_TIMEOUT,
+) -> Optional[List[dict]]:
+    '''Buffer transactions and claim everything buffered when due to flush
+
+    Returns None while the alert should still be held back.
+    '''
+    timestamp = now()
+
+    # A window that expired before this batch arrived is flushed right away,
+    # together with the new transactions
+    expired = should_flush(store.peek(), now=timestamp)
+
+    buffer = store.append(transactions=transactions, now=timestamp)
+
+    if not expired and not should_flush(buffer, now=timestamp):
+        log.info(f'## Holding {len(buffer.transactions)} transactions')
+        return None
+
+    return claim_transactions(
+        store=store, owner=owner, now=timestamp, timeout=claim_timeout)
+
+
+def flush_transactions(
+    store: buffer_store,
+    owner: str,
+    now: Callable = time.time,
+    should_flush: Callable = should_flush,
+    claim_timeout: int = ALERT_COALESCE_CLAIM_TIMEOUT,
+) -> Optional[List[dict]]:
+    '''Claim buffered transactions once the window has expired'''
+    timestamp = now()
+
+    if not should_flush(store.peek(), now=timestamp):
+        return None
+
+    return claim_transactions(
+        store=store, owner=owner, now=timestamp, timeout=claim_timeout)
+
+
+def complete_transactions(
+    transactions: List[dict],
+    store: buffer_store,
+    owner: str,
+) -> None:
+    '''Remove claimed transactions from the buffer once alerted'''
+    store.complete(
+        owner=owner,
+        transaction_hashes=[t['transaction-hash'] for t in transactions],
+    )
+
+
+def restore_transactions(store: buffer_store, owner: str) -> None:
+    '''Release claimed transactions whose alert could not be delivered
+
+    They are still buffered, and alerted by the next flush.
+    '''
+    store.release(owner=owner)
+
+
+def claim_transactions(
+    store: buffer_store,
+    owner: str,
+    now: float,
+    timeout: int = ALERT_COALESCE_CLAIM_TIMEOUT,
+) -> Optional[List[dict]]:
+    buffer = store.claim(owner=owner, now=now, timeout=timeout)
+
+    if buffer is None:
+        # Another invocation flushed or is flushing the buffer
+        return None
+
+    return unique_transactions(buffer.transactions)
+
+
+def get_coalescer(
+    window: int = ALERT_COALESCE_WINDOW,
+    get_buffer_store: Callable = get_buffer_store,
+) -> Optional[coalescer]:
+    '''Coalescing operations, or None when coalescing is disabled'''
+    if window <= 0:
+        return None
+
+    store = get_buffer_store()
+    # Claims of this invocation
+    owner = uuid.uuid4().hex
+
+    return coalescer(
+        add=partial(add_transactions, store=store, owner=owner),
+        flush=partial(flush_transactions, store=store, owner=owner),
+        complete=partial(complete_transactions, store=store, owner=owner),
+        restore=partial(restore_transactions, store=store, owner=owner),
+    )
+
+
+def is_flush_event(event: dict) -> bool:
+    '''Scheduled (EventBridge) invocations flush the buffer'''
+    return event.get('source') == 'aws.events' or \
+        event.get('detail-type') == 'Scheduled Event'
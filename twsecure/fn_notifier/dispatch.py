@@ -0,0 +1,269 @@
+from concurrent import futures
+import logging
+import math
+import os
+import time
+from typing import (
+    Callable, Dict, List, NamedTuple, Optional, TYPE_CHECKING,
+)
+
+import aws_clients
+import deadline
+
+from secret_bundle import NotifierSecrets
+from sms import send_scheduled_message
+
+if TYPE_CHECKING:
+    import botocore  # NOQA
+
+
+log = logging.getLogger(os.environ.get('LOGGER_NAME', 'NOTIFIER_LOGGER'))
+
+# Additional destinations, e.g. "sms:+15550001,webhook:https://...,email:a@b.c"
+ALERT_RECIPIENTS = os.environ.get('ALERT_RECIPIENTS', '')
+ALERT_EMAIL_FROM = os.environ.get('ALERT_EMAIL_FROM')
+ALERT_EMAIL_SUBJECT = os.environ.get(
+    'ALERT_EMAIL_SUBJECT', 'Transferwise debit alert')
+
+DEFAULT_CHANNEL = 'sms'
+CHANNEL_TIMEOUTS = {
+    'sms': float(os.environ.get('SMS_CHANNEL_TIMEOUT', 8)),
+    'webhook': float(os.environ.get('WEBHOOK_CHANNEL_TIMEOUT', 5)),
+    'email': float(os.environ.get('EMAIL_CHANNEL_TIMEOUT', 5)),
+}
+MAX_DISPATCH_WORKERS = int(os.environ.get('MAX_DISPATCH_WORKERS', 10))
+
+
+class DispatchStatus():
+    SENT = 'SENT'
+    FAILED = 'FAILED'
+    TIMEOUT = 'TIMEOUT'
+
+
+class Recipient(NamedTuple):
+    channel: str
+    address: str
+
+
+def parse_recipients(
+    spec: Optional[str],
+    default_channel: str = DEFAULT_CHANNEL,
+    channels: Dict[str, float] = CHANNEL_TIMEOUTS,
+    email_from: Optional[str] = ALERT_EMAIL_FROM,
+) -> List[Recipient]:
+    '''Parse a comma-separated list of "channel:address" destinations
+
+    Entries without a known channel prefix (e.g. plain phone numbers) are
+    sent through the default channel. Email destinations are rejected when
+    no ALERT_EMAIL_FROM sender is configured, as SES would refuse each send.
+    '''
+    recipients = []
+
+    for entry in (spec or '').split(','):
+        entry = entry.strip()
+
+        if not entry:
+            continue
+
+        channel, _, address = entry.partition(':')
+
+        if channel not in channels or not address:
+            channel, address = default_channel, entry
+
+        if channel == 'email' and not email_from:
+            log.error(f'## Email recipient {address} ignored: '
+                      f'ALERT_EMAIL_FROM is not set')
+            continue
+
+        recipients.append(Recipient(channel=channel, address=address))
+
+    return recipients
+
+
+def get_recipients(
+    to_phone_number: Optional[str],
+    alert_recipients: str = ALERT_RECIPIENTS,
+    email_from: Optional[str] = ALERT_EMAIL_FROM,
+) -> List[Recipient]:
+    '''Combine the SMS phone number(s) and extra destinations, deduplicated'''
+    return list(dict.fromkeys(
+        parse_recipients(to_phone_number, email_from=email_from) +
+        parse_recipients(alert_recipients, email_from=email_from)
+    ))
+
+
+def send_sms(
+    message: str,
+    address: str,
+    from_phone_number: str,
+    secrets: Optional[NotifierSecrets] = None,
+    timeout: Optional[float] = None,
+    **kwargs,
+) -> dict:
+    # Paced and retried within the channel timeout
+    return send_scheduled_message(
+        message=message,
+        from_phone_number=from_phone_number,
+        to_phone_number=address,
+        timeout=timeout,
+        secrets=secrets,
+    )
+
+
+def send_webhook(
+    message: str,
+    address: str,
+    transactions: List[dict],
+    timeout: float,
+    **kwargs,
+) -> dict:
+    import requests
+
+    response = requests.post(
+        address,
+        json={'message': message, 'transactions': transactions},
+        timeout=timeout,
+    )
+    response.raise_for_status()
+
+    return {'status_code': response.status_code}
+
+
+def send_email(
+    message: str,
+    address: str,
+    email_from: Optional[str] = ALERT_EMAIL_FROM,
+    subject: str = ALERT_EMAIL_SUBJECT,
+    client: Optional['botocore.client.BaseClient'] = None,
+    **kwargs,
+) -> dict:
+    if not email_from:
+        raise ValueError('ALERT_EMAIL_FROM is required to send emails')
+
+    if client is None:
+        client = aws_clients.get_client('ses')
+
+    response = client.send_email(
+        Source=email_from,
+        Destination={'ToAddresses': [address]},
+        Message={
+            'Subject': {'Data': subject},
+            'Body': {'Text': {'Data': message}},
+        },
+    )
+
+    return {'message_id': response['MessageId']}
+
+
+def wait_timeout(seconds: float) -> Optional[float]:
+    '''Timeout of a wait of up to "seconds" (None waits without a limit)'''
+    return None if math.isinf(seconds) else max(seconds, 0)
+
+
+def is_delivered(results: List[dict]) -> bool:
+    '''Whether the alert reached at least one recipient'''
+    return any(r['status'] == DispatchStatus.SENT for r in results)
+
+
+CHANNEL_SENDERS = {
+    'sms': send_sms,
+    'webhook': send_webhook,
+    'email': send_email,
+}
+
+
+def dispatch_alert(
+    message: str,
+    recipients: List[Recipient],
+    senders: Dict[str, Callable] = CHANNEL_SENDERS,
+    timeouts: Dict[str, float] = CHANNEL_TIMEOUTS,
+    max_workers: int = MAX_DISPATCH_WORKERS,
+    now: Callable = time.monotonic,
+    call_timeout: Callable = deadline.call_timeout,
+    remaining: Callable = deadline.remaining,
+    **send_kwargs,
+) -> List[dict]:
+    '''Send an alert to every recipient concurrently
+
+    Each channel has its own timeout, counted from the start of the dispatch,
+    so the total latency is bound by the slowest channel instead of the sum of
+    all sends, and shortened to end by the invocation deadline. Returns one
+    result per recipient, in the same order.
+
+    A send past its channel timeout is cancelled if it has not started yet.
+    One already running can't be interrupted: its outcome is awaited until
+    the invocation deadline instead, so that a late delivery is reported as
+    sent rather than retried (and delivered twice).
+    '''
+    if len(recipients) == 0:
+        return []
+
+    timeouts = {
+        channel: call_timeout(timeout)
+        for channel, timeout in timeouts.items()
+    }
+
+    started_at = now()
+    executor = futures.ThreadPoolExecutor(
+        max_workers=min(max_workers, len(recipients)),
+    )
+
+    pending = [
+        (
+            recipient,
+            executor.submit(
+                senders[recipient.channel],
+                message=message,
+                address=recipient.address,
+                timeout=timeouts[recipient.channel],
+                **send_kwargs,
+            ),
+        )
+        for recipient in recipients
+    ]
+
+    # Past its channel timeout, a send is cancelled if still queued, or left
+    # to finish (first, so that no queued one starts meanwhile)
+    late = set()
+
+    for recipient, future in pending:
+        timeout = started_at + timeouts[recipient.channel] - now()
+
+        if not futures.wait([future], timeout=max(timeout, 0)).done and \
+                not future.cancel():
+            log.warning(f'## Alert to {recipient.channel} past its timeout: '
+                        f'waiting for it until the deadline')
+            late.add(future)
+
+    futures.wait(late, timeout=wait_timeout(remaining()))
+
+    results = []
+
+    for recipient, future in pending:
+        result = {
+            'channel': recipient.channel,
+            'recipient': recipient.address,
+            'status': DispatchStatus.SENT,
+            'response': None,
+            'error': None,
+        }
+
+        if not future.done() or future.cancelled():
+            result['status'] = DispatchStatus.TIMEOUT
+            log.error(f'## Alert to {recipient.channel} timed out')
+
+        elif future.exception() is not None:
+            result['status'] = DispatchStatus.FAILED
+            result['error'] = str(future.exception())
+            log.error(f'## Alert to {recipient.channel} failed: '
+                      f'{future.exception()}')
+
+        else:
+            result['response'] = future.result()
+
+        results.append(result)
+
+    # Only sends still running at the deadline are left behind
+    executor.shutdown(wait=False)
+
+    return results
@@ -0,0 +1,224 @@
+from collections import namedtuple
+from concurrent import futures
+from functools import partial
+import logging
+import os
+import threading
+import time
+from typing import Callable, Iterable, List, Optional, TYPE_CHECKING
+
+import aws_clients
+
+if TYPE_CHECKING:
+    import botocore  # NOQA
+
+
+log = logging.getLogger(os.environ.get('LOGGER_NAME', 'NOTIFIER_LOGGER'))
+
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME')
+
+# How long an alerted transaction hash is remembered; stream redeliveries and
+# shard re-reads happen within minutes, so a few hours is plenty
+ALERT_LEDGER_TTL = int(os.environ.get('ALERT_LEDGER_TTL_SECONDS', 6 * 3600))
+# How long a claim holds while its alert is being sent: longer than the
+# function timeout, short enough to alert again after a failed invocation
+ALERT_LEDGER_PENDING_TTL = int(
+    os.environ.get('ALERT_LEDGER_PENDING_TTL_SECONDS', 150))
+# Concurrent DynamoDB writes when claiming many transactions at once
+ALERT_LEDGER_WORKERS = int(os.environ.get('ALERT_LEDGER_WORKERS', 8))
+ALERT_LEDGER_CACHE_SIZE = int(os.environ.get('ALERT_LEDGER_CACHE_SIZE', 10000))
+
+# Hashes known to be alerted (confirmed only), mapped to their expiration
+# timestamp; persisted across warm invocations to skip the DynamoDB round
+# trip on duplicates
+LEDGER_CACHE = {}
+
+alert_ledger = namedtuple('alert_ledger', 'claim confirm release')
+ledger_cache = namedtuple('ledger_cache', 'contains add discard')
+
+
+def ledger_key(transaction_hash: str) -> dict:
+    return {'pk': {'S': f'ledger#{transaction_hash}'}, 'sk': {'S': 'alert'}}
+
+
+def memory_cache(
+    state: dict = LEDGER_CACHE,
+    max_size: int = ALERT_LEDGER_CACHE_SIZE,
+) -> ledger_cache:
+    '''Front cache of alerted hashes, bound in size'''
+    lock = threading.Lock()
+
+    def contains(transaction_hash: str, now: float) -> bool:
+        expires_at = state.get(transaction_hash)
+        return expires_at is not None and expires_at > now
+
+    def add(transaction_hash: str, expires_at: float) -> None:
+        with lock:
+            state.pop(transaction_hash, None)
+            state[transaction_hash] = expires_at
+
+            # Dicts keep insertion order: the oldest entries are evicted first
+            while len(state) > max_size:
+                state.pop(next(iter(state)))
+
+    def discard(transaction_hash: str) -> None:
+        with lock:
+            state.pop(transaction_hash, None)
+
+    return ledger_cache(contains=contains, add=add, discard=discard)
+
+
+def memory_ledger(
+    cache: Optional[ledger_cache] = None,
+    ttl: int = ALERT_LEDGER_TTL,
+    pending_ttl: int = ALERT_LEDGER_PENDING_TTL,
+    now: Callable = time.time,
+) -> alert_ledger:
+    '''Local stand-in for the ledger, only deduplicating within a container'''
+    if cache is None:
+        cache = memory_cache()
+
+    def claim(transaction_hashes: Iterable[str]) -> List[str]:
+        timestamp = now()
+        claimed = []
+
+        for transaction_hash in dict.fromkeys(transaction_hashes):
+            if cache.contains(transaction_hash, now=timestamp):
+                continue
+
+            cache.add(transaction_hash, expires_at=timestamp + pending_ttl)
+            claimed.append(transaction_hash)
+
+        return claimed
+
+    def confirm(transaction_hashes: Iterable[str]) -> None:
+        timestamp = now()
+
+        for transaction_hash in transaction_hashes:
+            cache.add(transaction_hash, expires_at=timestamp + ttl)
+
+    def release(transaction_hashes: Iterable[str]) -> None:
+        for transaction_hash in transaction_hashes:
+            cache.discard(transaction_hash)
+
+    return alert_ledger(claim=claim, confirm=confirm, release=release)
+
+
+def dynamodb_ledger(
+    table_name: str = STATE_TABLE_NAME,
+    client: Optional['botocore.client.BaseClient'] = None,
+    cache: Optional[ledger_cache] = None,
+    ttl: int = ALERT_LEDGER_TTL,
+    pending_ttl: int = ALERT_LEDGER_PENDING_TTL,
+    max_workers: int = ALERT_LEDGER_WORKERS,
+    now: Callable = time.time,
+) -> alert_ledger:
+    '''Ledger shared by all containers, backed by conditional writes
+
+    Each transaction hash is claimed by a single conditional put: the first
+    invocation to write it gets to alert, any other one sees the condition
+    fail. Expired items, not yet removed by the table TTL, can be claimed
+    again.
+
+    A claim first expires after "pending_ttl": should the invocation die
+    while alerting, the transaction can be alerted again shortly. Once the
+    alert is delivered, the claim is confirmed for the full "ttl". Items are
+    written one per hash (conditional writes can't be batched), concurrently.
+    '''
+    if client is None:
+        client = aws_clients.get_client('dynamodb')
+
+    if cache is None:
+        cache = memory_cache()
+
+    from botocore.exceptions import ClientError
+
+    def for_each(func: Callable, transaction_hashes: List[str]) -> list:
+        if len(transaction_hashes) <= 1:
+            return [func(h) for h in transaction_hashes]
+
+        with futures.ThreadPoolExecutor(
+            max_workers=min(max_workers, len(transaction_hashes)),
+        ) as executor:
+            return list(executor.map(func, transaction_hashes))
+
+    def put(transaction_hash: str, expires_at: int, **kwargs) -> None:
+        client.put_item(
+            TableName=table_name,
+            Item={
+                **ledger_key(transaction_hash),
+                'ttl': {'N': str(expires_at)},
+            },
+            **kwargs,
+        )
+
+    def claim_one(transaction_hash: str, timestamp: float) -> bool:
+        expires_at = int(timestamp + pending_ttl)
+
+        try:
+            put(
+                transaction_hash,
+                expires_at=expires_at,
+                ConditionExpression='attribute_not_exists(pk) OR #ttl < :now',
+                ExpressionAttributeNames={'#ttl': 'ttl'},
+                ExpressionAttributeValues={':now': {'N': str(int(timestamp))}},
+            )
+
+        except ClientError as exc:
+            if exc.response['Error']['Code'] != \
+                    'ConditionalCheckFailedException':
+                raise
+
+            # Alerted or being alerted by another invocation. Not cached: a
+            # pending claim is released if its alert fails, and the
+            # redelivered record must then get to claim it
+            return False
+
+        return True
+
+    def claim(transaction_hashes: Iterable[str]) -> List[str]:
+        timestamp = now()
+
+        unknown = [
+            transaction_hash
+            for transaction_hash in dict.fromkeys(transaction_hashes)
+            if not cache.contains(transaction_hash, now=timestamp)
+        ]
+
+        claimed = for_each(
+            partial(claim_one, timestamp=timestamp), unknown)
+
+        return [
+            transaction_hash
+            for transaction_hash, is_claimed in zip(unknown, claimed)
+            if is_claimed
+        ]
+
+    def confirm_one(transaction_hash: str, expires_at: int) -> None:
+        put(transaction_hash, expires_at=expires_at)
+        cache.add(transaction_hash, expires_at=expires_at)
+
+    def confirm(transaction_hashes: Iterable[str]) -> None:
+        for_each(
+            partial(confirm_one, expires_at=int(now() + ttl)),
+            list(transaction_hashes),
+        )
+
+    def release_one(transaction_hash: str) -> None:
+        cache.discard(transaction_hash)
+        client.delete_item(
+            TableName=table_name,
+            Key=ledger_key(transaction_hash),
+        )
+
+    def release(transaction_hashes: Iterable[str]) -> None:
+        for_each(release_one, list(transaction_hashes))
+
+    return alert_ledger(claim=claim, confirm=confirm, release=release)
+
+
+def get_ledger(table_name: Optional[str] = STATE_TABLE_NAME) -> alert_ledger:
+    if table_name:
+        return dynamodb_ledger(table_name=table_name)
+
+    return memory_ledger()
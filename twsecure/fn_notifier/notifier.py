@@ -1,31 +1,83 @@
 import json
 import os
 
-from get_aws_secret import get_secret
+import aws_clients
+import deadline
+import metrics
+import profiling
+import structured_log
 
-from transaction import process_event
+from coalesce import get_coalescer, is_flush_event
+from ledger import get_ledger
+from secret_bundle import get_notifier_secrets
+from sms import prewarm_twilio_client, TWILIO_PREWARM
+from transaction import process_event, process_flush
 
 
+# Create the AWS clients during the Lambda init phase (AWS_CLIENTS_PREWARM)
+aws_clients.prewarm()
+
+if TWILIO_PREWARM:
+    prewarm_twilio_client()
+
+
+# Unwrapped unless PROFILING_MODES is set
+@profiling.profiled('notifier')
 def handler(event, context):
-    print(json.dumps(event))
+    # No-op unless METRICS_ENABLED is "true"
+    metrics.start()
+
+    # Network calls are bounded by the time left in this invocation
+    deadline.start(context)
+
+    # Payloads are logged for a sample of invocations, redacted and bounded
+    structured_log.start()
+    structured_log.log_payload('event', event)
 
     secret_arn = os.environ.get('SECRET_ARN')
     to_phone_number = os.environ.get('SEND_SMS_TO_PHONE_NUMBER')
 
-    secret = get_secret(secret_arn, load_json=True)
+    # All secrets are resolved in a single pass and cached by warm containers
+    with metrics.timer('get_secrets'):
+        secrets = get_notifier_secrets(secret_arn=secret_arn)
+
+    # Optionally coalesce alerts across stream batches (None when disabled)
+    coalescer = get_coalescer()
+
+    # Transactions already alerted (e.g. stream retries) are skipped
+    ledger = get_ledger()
+
+    if coalescer is not None and is_flush_event(event):
+        response = process_flush(
+            coalescer=coalescer,
+            from_phone_number=secrets.phone_number,
+            to_phone_number=to_phone_number,
+            secrets=secrets,
+            ledger=ledger,
+        )
+
+    else:
+        response = process_event(
+            dynamodb_event=event,
+            from_phone_number=secrets.phone_number,
+            to_phone_number=to_phone_number,
+            secrets=secrets,
+            coalescer=coalescer,
+            ledger=ledger,
+        )
+
+    structured_log.log_payload('response', response)
+
+    body = {"response": response}
 
-    response = process_event(
-        dynamodb_event=event,
-        from_phone_number=secret['phone_number'],
-        to_phone_number=to_phone_number,
-    )
+    metrics_summary = metrics.emit(dimensions={'Service': 'notifier'})
 
-    print('RESPONSE from process_event():')
-    print(json.dumps(response))
+    if metrics_summary is not None:
+        body["metrics"] = metrics_summary
 
     return {
         "statusCode": 200,
-        "body": json.dumps({
-            "response": response,
-        }),
+        "body": json.dumps(body),
+        # Only failed stream records are retried by Lambda
+        "batchItemFailures": response.get('batch_item_failures', []),
     }
@@ -0,0 +1,79 @@
+import json
+import os
+import time
+from typing import Callable, Dict, Iterable, NamedTuple, Optional
+
+from secret import get_secret_values, secret_provider
+
+
+SECRET_ARN = os.environ.get('SECRET_ARN')
+
+# Resolved bundles are reused by warm invocations for this many seconds, so
+# rotated credentials are picked up without a SecretsManager call per alert
+SECRETS_CACHE_TTL = int(os.environ.get('SECRETS_CACHE_TTL_SECONDS', 300))
+
+# Maps a secret ARN to a tuple of (expiration timestamp, bundle)
+SECRETS_CACHE = {}
+
+
+class SecretResolutionException(Exception):
+    pass
+
+
+class NotifierSecrets(NamedTuple):
+    '''Every secret value the notifier needs to process an event'''
+    phone_number: str
+    account_id: str
+    api_token: str
+
+
+def fetch_secrets(
+    secret_arns: Iterable[str],
+    provider: Optional[secret_provider] = None,
+) -> Dict[str, dict]:
+    '''Fetch and JSON-parse each secret exactly once, batching requests'''
+    return {
+        secret_arn: json.loads(value)
+        for secret_arn, value in get_secret_values(
+            secret_arns,
+            provider=provider,
+        ).items()
+    }
+
+
+def resolve_secrets(
+    field_arns: Dict[str, str],
+    fetch_secrets: Callable = fetch_secrets,
+) -> Dict[str, str]:
+    '''Map each field to its value in the secret identified by its ARN'''
+    secrets = fetch_secrets(secret_arns=field_arns.values())
+
+    try:
+        return {
+            field: secrets[secret_arn][field]
+            for field, secret_arn in field_arns.items()
+        }
+    except KeyError as exc:
+        raise SecretResolutionException(f'Missing secret: {exc}') from exc
+
+
+def get_notifier_secrets(
+    secret_arn: str = SECRET_ARN,
+    resolve_secrets: Callable = resolve_secrets,
+    cache: dict = SECRETS_CACHE,
+    cache_ttl: int = SECRETS_CACHE_TTL,
+    now: Callable = time.monotonic,
+) -> NotifierSecrets:
+    cached = cache.get(secret_arn)
+
+    if cached is not None and cached[0] > now():
+        return cached[1]
+
+    secrets = NotifierSecrets(**resolve_secrets(
+        field_arns={field: secret_arn for field in NotifierSecrets._fields},
+    ))
+
+    if cache_ttl > 0:
+        cache[secret_arn] = (now() + cache_ttl, secrets)
+
+    return secrets
@@ -0,0 +1,169 @@
+from collections import namedtuple
+import math
+import os
+from typing import Iterable
+
+
+# Maximum number of billed SMS segments per alert message
+SMS_SEGMENT_BUDGET = int(os.environ.get('SMS_SEGMENT_BUDGET', 2))
+
+# GSM 03.38 default alphabet, one septet per character
+GSM7_BASIC_CHARSET = frozenset(
+    '@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+    '¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà'
+)
+# Extension table characters, escaped with an additional septet
+GSM7_EXTENSION_CHARSET = frozenset('\f^{}\\[~]|€')
+
+
+class SmsEncoding():
+    GSM7 = 'GSM-7'
+    UCS2 = 'UCS-2'
+
+
+# Characters (or UTF-16 code units) fitting a single segment message, and
+# each segment of a concatenated message (the rest is taken by the UDH)
+segment_limits = namedtuple('segment_limits', 'single multi')
+
+SEGMENT_LIMITS = {
+    SmsEncoding.GSM7: segment_limits(single=160, multi=153),
+    SmsEncoding.UCS2: segment_limits(single=70, multi=67),
+}
+
+
+def character_units(character: str) -> tuple:
+    '''Length of a character as (GSM-7 septets, UCS-2 code units)
+
+    GSM-7 length is None for characters outside the GSM alphabet.
+    '''
+    ucs2_units = 2 if ord(character) > 0xFFFF else 1
+
+    if character in GSM7_BASIC_CHARSET:
+        return 1, ucs2_units
+
+    if character in GSM7_EXTENSION_CHARSET:
+        return 2, ucs2_units
+
+    return None, ucs2_units
+
+
+text_units = namedtuple('text_units', 'gsm7 ucs2')
+
+
+def measure(text: str) -> text_units:
+    '''Length of a text in both encodings (GSM-7 is None if not encodable)'''
+    gsm7, ucs2 = 0, 0
+
+    for character in text:
+        char_gsm7, char_ucs2 = character_units(character)
+
+        if gsm7 is not None:
+            gsm7 = None if char_gsm7 is None else gsm7 + char_gsm7
+
+        ucs2 += char_ucs2
+
+    return text_units(gsm7=gsm7, ucs2=ucs2)
+
+
+def combine(*units: text_units) -> text_units:
+    '''Length of the concatenation of texts, from their individual lengths'''
+    return text_units(
+        gsm7=None if any(u.gsm7 is None for u in units) else
+        sum(u.gsm7 for u in units),
+        ucs2=sum(u.ucs2 for u in units),
+    )
+
+
+def encoding_length(units: text_units) -> tuple:
+    '''Encoding a text would be sent with, and its length in that encoding'''
+    if units.gsm7 is not None:
+        return SmsEncoding.GSM7, units.gsm7
+
+    return SmsEncoding.UCS2, units.ucs2
+
+
+def count_segments(units: text_units) -> int:
+    encoding, length = encoding_length(units)
+    limits = SEGMENT_LIMITS[encoding]
+
+    if length == 0:
+        return 0
+
+    if length <= limits.single:
+        return 1
+
+    return math.ceil(length / limits.multi)
+
+
+def segment_count(text: str) -> int:
+    return count_segments(measure(text))
+
+
+packed_text = namedtuple('packed_text', 'entries packed_count truncated')
+
+
+def pack_entries(
+    entries: Iterable[str],
+    fixed_units: text_units,
+    separator: str = ', ',
+    truncation_suffix: str = '',
+    segment_budget: int = SMS_SEGMENT_BUDGET,
+    max_length: int = None,
+) -> packed_text:
+    '''Join as many entries as fit in a number of SMS segments
+
+    "fixed_units" is the length of the rest of the message the entries are
+    inserted into. Entries are consumed lazily, one ahead of the one being
+    packed, and packing stops at the first one not fitting, keeping room for
+    the truncation suffix unless it is the last entry. Lengths are kept as
+    running totals, so each entry is only measured once.
+    '''
+    separator_units = measure(separator)
+    suffix_units = measure(truncation_suffix)
+    no_units = text_units(gsm7=0, ucs2=0)
+
+    packed = []
+    packed_units = no_units
+
+    def fits(units: text_units) -> bool:
+        if count_segments(units) > segment_budget:
+            return False
+
+        return max_length is None or units.ucs2 <= max_length
+
+    entries = iter(entries)
+    last = object()
+    entry = next(entries, last)
+
+    while entry is not last:
+        following = next(entries, last)
+        entry_units = measure(entry)
+
+        if packed:
+            entry_units = combine(separator_units, entry_units)
+
+        candidate_units = combine(packed_units, entry_units)
+
+        # The suffix is reserved while entries follow: if packing stops at
+        # one of them, it must fit
+        reserved_units = suffix_units if following is not last else no_units
+
+        if not fits(combine(fixed_units, candidate_units, reserved_units)):
+            break
+
+        packed.append(entry)
+        packed_units = candidate_units
+        entry = following
+
+    else:
+        return packed_text(
+            entries=separator.join(packed),
+            packed_count=len(packed),
+            truncated=False,
+        )
+
+    return packed_text(
+        entries=separator.join(packed) + truncation_suffix,
+        packed_count=len(packed),
+        truncated=True,
+    )
@@ -1,52 +1,218 @@
+import hashlib
+import logging
+import math
 import os
-from typing import Optional
+import random
+import threading
+import time
+from typing import Callable, Optional, TYPE_CHECKING
+from urllib.parse import urlsplit, urlunsplit
 
-from get_aws_secret import get_secret
-from twilio.rest import Client as TwilioClient
+import metrics
 
+from secret_bundle import get_notifier_secrets, NotifierSecrets
 
-SECRET_ARN = os.environ.get('SECRET_ARN')
+# Twilio (and requests beneath it) are imported on first use: most notifier
+# invocations never send a message, so they should not pay for the import
+if TYPE_CHECKING:
+    from twilio.http.http_client import TwilioHttpClient  # NOQA
+    from twilio.rest import Client as TwilioClient  # NOQA
 
 
-def get_twilio_account_secret(
-    secret_key: str,
-    secret_arn: str = SECRET_ARN,
-) -> tuple:
-    secret = get_secret(secret_arn, load_json=True)
+log = logging.getLogger(os.environ.get('LOGGER_NAME', 'NOTIFIER_LOGGER'))
 
-    return secret[secret_key]
+TWILIO_CONNECT_TIMEOUT = float(os.environ.get('TWILIO_CONNECT_TIMEOUT', 3))
+TWILIO_READ_TIMEOUT = float(os.environ.get('TWILIO_READ_TIMEOUT', 5))
+TWILIO_MAX_RETRIES = int(os.environ.get('TWILIO_MAX_RETRIES', 0))
+# Send Twilio API requests elsewhere, e.g. to a local stand-in server
+TWILIO_API_BASE_URL = os.environ.get('TWILIO_API_BASE_URL')
+
+# Build the Twilio client (and optionally open its connection) during the
+# Lambda init phase, instead of on the first alert
+TWILIO_PREWARM = os.environ.get('TWILIO_PREWARM', 'false') == 'true'
+TWILIO_PREWARM_CONNECTION = \
+    os.environ.get('TWILIO_PREWARM_CONNECTION', 'false') == 'true'
+
+# Outbound pacing: messages per second accepted from each sender number;
+# zero (or less) sends without pacing
+SMS_SENDER_RATE = float(os.environ.get('SMS_SENDER_RATE', 1))
+SMS_MAX_ATTEMPTS = int(os.environ.get('SMS_MAX_ATTEMPTS', 4))
+SMS_RETRY_BASE_DELAY = float(os.environ.get('SMS_RETRY_BASE_DELAY', 0.5))
+SMS_RETRY_MAX_DELAY = float(os.environ.get('SMS_RETRY_MAX_DELAY', 8))
+
+# Throttling and server-side errors worth retrying
+TRANSIENT_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+# Next free send slot (monotonic timestamp) per sender phone number, shared by
+# concurrent dispatch threads
+SENDER_SLOTS = {}
+SENDER_SLOTS_LOCK = threading.Lock()
+
+# One client per container, reused across warm invocations; maps a name to a
+# tuple of (credentials fingerprint, client)
+CLIENT_REGISTRY = {}
+
+
+def rewrite_base_url(url: str, base_url: str) -> str:
+    '''Replace the scheme and host of a URL, keeping its path and query'''
+    base = urlsplit(base_url)
+    parts = urlsplit(url)
+
+    return urlunsplit((
+        base.scheme,
+        base.netloc,
+        base.path.rstrip('/') + parts.path,
+        parts.query,
+        parts.fragment,
+    ))
+
+
+class BaseUrlHttpClient():
+    '''Wrap a Twilio HTTP client to send every request to another base URL'''
+
+    def __init__(self, http_client: 'TwilioHttpClient', base_url: str):
+        self.http_client = http_client
+        self.base_url = base_url
+
+    def request(self, method: str, url: str, *args, **kwargs):
+        return self.http_client.request(
+            method, rewrite_base_url(url, self.base_url), *args, **kwargs)
+
+    def __getattr__(self, name: str):
+        return getattr(self.http_client, name)
+
+
+def get_http_client(
+    connect_timeout: float = TWILIO_CONNECT_TIMEOUT,
+    read_timeout: float = TWILIO_READ_TIMEOUT,
+    max_retries: int = TWILIO_MAX_RETRIES,
+    base_url: Optional[str] = TWILIO_API_BASE_URL,
+) -> 'TwilioHttpClient':
+    '''HTTP client keeping a keep-alive connection pool with custom timeouts'''
+    from twilio.http.http_client import TwilioHttpClient
+
+    http_client = TwilioHttpClient(
+        pool_connections=True,
+        timeout=read_timeout,
+        max_retries=max_retries,
+    )
+
+    # Requests accepts separate (connect, read) timeouts, but recent Twilio
+    # versions only validate single float values in the constructor
+    http_client.timeout = (connect_timeout, read_timeout)
+
+    if base_url:
+        return BaseUrlHttpClient(http_client, base_url=base_url)
+
+    return http_client
 
 
 def get_twilio_client(
     account_id: Optional[str] = None,
     api_token: Optional[str] = None,
-) -> TwilioClient:
-    if account_id is None:
-        account_id = get_twilio_account_secret(secret_key='account_id')
+    secrets: Optional[NotifierSecrets] = None,
+    get_secrets: Callable = get_notifier_secrets,
+    http_client: Optional['TwilioHttpClient'] = None,
+) -> 'TwilioClient':
+    from twilio.rest import Client as TwilioClient
+
+    if account_id is None or api_token is None:
+        if secrets is None:
+            secrets = get_secrets()
 
-    if api_token is None:
-        api_token = get_twilio_account_secret(secret_key='api_token')
+        account_id = secrets.account_id if account_id is None else account_id
+        api_token = secrets.api_token if api_token is None else api_token
 
     return TwilioClient(
         username=account_id,
         password=api_token,
+        http_client=http_client,
+    )
+
+
+def credentials_fingerprint(account_id: str, api_token: str) -> str:
+    '''Identify a set of credentials without keeping the token as a key'''
+    return hashlib.sha256(f'{account_id}:{api_token}'.encode()).hexdigest()
+
+
+def get_pooled_client(
+    secrets: Optional[NotifierSecrets] = None,
+    get_secrets: Callable = get_notifier_secrets,
+    registry: dict = CLIENT_REGISTRY,
+    new_client: Callable = get_twilio_client,
+    new_http_client: Callable = get_http_client,
+) -> 'TwilioClient':
+    '''Return the container-wide client, rebuilt only if credentials rotate'''
+    if secrets is None:
+        secrets = get_secrets()
+
+    fingerprint = credentials_fingerprint(
+        account_id=secrets.account_id,
+        api_token=secrets.api_token,
     )
 
+    cached = registry.get('twilio')
+
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+
+    if cached is not None:
+        log.info('## Twilio credentials rotated, rebuilding client')
+
+    client = new_client(
+        account_id=secrets.account_id,
+        api_token=secrets.api_token,
+        http_client=new_http_client(),
+    )
+
+    registry['twilio'] = (fingerprint, client)
+
+    return client
+
+
+def prewarm_twilio_client(
+    open_connection: bool = TWILIO_PREWARM_CONNECTION,
+    get_pooled_client: Callable = get_pooled_client,
+) -> Optional['TwilioClient']:
+    '''Lambda init-phase hook: resolve secrets and build the pooled client
+
+    With "open_connection", the account resource is fetched once so that the
+    TLS connection is already established when the first alert is sent.
+    Failures are logged and left for the first invocation to surface.
+    '''
+    try:
+        client = get_pooled_client()
+
+        if open_connection:
+            client.api.v2010.accounts(client.username).fetch()
+
+    except Exception as exc:
+        log.warning(f'## Could not pre-warm the Twilio client: {exc}')
+        return None
+
+    return client
+
+
+class SmsNotSentInTimeException(Exception):
+    pass
+
 
 def send_message(
     message: str,
     from_phone_number: str,
     to_phone_number: str,
-    client: Optional[TwilioClient] = None,
+    client: Optional['TwilioClient'] = None,
+    secrets: Optional[NotifierSecrets] = None,
 ) -> dict:
     if client is None:
-        client = get_twilio_client()
+        client = get_pooled_client(secrets=secrets)
 
-    response = client.messages.create(
-        body=message,
-        from_=from_phone_number,
-        to=to_phone_number,
-    )
+    with metrics.timer('send_message'):
+        response = client.messages.create(
+            body=message,
+            from_=from_phone_number,
+            to=to_phone_number,
+        )
 
     return {
         'message_id': response.sid,
@@ -54,3 +220,118 @@ def send_message(
         'error_code': response.error_code,
         'error_message': response.error_message,
     }
+
+
+def is_transient_error(exc: Exception) -> bool:
+    from requests.exceptions import ConnectionError, Timeout
+    from twilio.base.exceptions import TwilioRestException
+
+    if isinstance(exc, TwilioRestException):
+        return exc.status in TRANSIENT_STATUS_CODES
+
+    return isinstance(exc, (ConnectionError, Timeout))
+
+
+def retry_delay(
+    attempt: int,
+    base_delay: float = SMS_RETRY_BASE_DELAY,
+    max_delay: float = SMS_RETRY_MAX_DELAY,
+    uniform: Callable = random.uniform,
+) -> float:
+    '''Exponential backoff with full jitter'''
+    return uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def reserve_send_slot(
+    from_phone_number: str,
+    deadline: float,
+    rate: float = SMS_SENDER_RATE,
+    slots: dict = SENDER_SLOTS,
+    lock: threading.Lock = SENDER_SLOTS_LOCK,
+    now: Callable = time.monotonic,
+) -> Optional[float]:
+    '''Reserve the next send slot of a sender, or None if past the deadline'''
+    with lock:
+        slot = max(now(), slots.get(from_phone_number, 0))
+
+        if slot > deadline:
+            return None
+
+        # Without pacing, only a deferred (throttled) sender holds sends back
+        if rate > 0:
+            slots[from_phone_number] = slot + 1 / rate
+
+        return slot
+
+
+def defer_sender(
+    from_phone_number: str,
+    until: float,
+    slots: dict = SENDER_SLOTS,
+    lock: threading.Lock = SENDER_SLOTS_LOCK,
+) -> None:
+    '''Hold back every pending send from a throttled sender'''
+    with lock:
+        slots[from_phone_number] = max(slots.get(from_phone_number, 0), until)
+
+
+def send_scheduled_message(
+    message: str,
+    from_phone_number: str,
+    to_phone_number: str,
+    timeout: Optional[float] = None,
+    client: Optional['TwilioClient'] = None,
+    secrets: Optional[NotifierSecrets] = None,
+    send_message: Callable = send_message,
+    max_attempts: int = SMS_MAX_ATTEMPTS,
+    retry_delay: Callable = retry_delay,
+    reserve_send_slot: Callable = reserve_send_slot,
+    defer_sender: Callable = defer_sender,
+    now: Callable = time.monotonic,
+    sleep: Callable = time.sleep,
+) -> dict:
+    '''Send an SMS paced per sender number, retrying transient errors
+
+    Sends are spaced to the sender rate, and throttled or failed requests are
+    retried with backoff for as long as the timeout allows. A message that
+    cannot be sent in time raises SmsNotSentInTimeException: the alert is
+    not delivered, and retried with its stream records or coalescing buffer.
+    '''
+    deadline = math.inf if timeout is None else now() + timeout
+
+    for attempt in range(0, max_attempts):
+        slot = reserve_send_slot(from_phone_number, deadline=deadline)
+
+        if slot is None:
+            break
+
+        sleep(max(slot - now(), 0))
+
+        try:
+            return send_message(
+                message=message,
+                from_phone_number=from_phone_number,
+                to_phone_number=to_phone_number,
+                client=client,
+                secrets=secrets,
+            )
+
+        except Exception as exc:
+            if not is_transient_error(exc) or attempt == max_attempts - 1:
+                raise
+
+            delay = retry_delay(attempt)
+            metrics.count('sms_retries')
+
+            log.warning(f'## SMS attempt {attempt + 1} failed ({exc}), '
+                        f'retrying in {delay:.2f}s')
+
+            if now() + delay >= deadline:
+                break
+
+            defer_sender(from_phone_number, until=now() + delay)
+
+    metrics.count('sms_not_sent_in_time')
+
+    raise SmsNotSentInTimeException(
+        f'SMS to {to_phone_number} could not be sent in time')
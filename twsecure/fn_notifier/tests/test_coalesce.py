@@ -0,0 +1,335 @@
+import json
+from unittest import mock
+
+from botocore.exceptions import ClientError
+import pytest
+
+from coalesce import (
+    add_transactions,
+    alert_buffer,
+    BUFFER_KEY,
+    claim_transactions,
+    complete_transactions,
+    dynamodb_buffer_store,
+    flush_transactions,
+    get_coalescer,
+    is_flush_event,
+    memory_buffer_store,
+    restore_transactions,
+    should_flush,
+)
+
+
+@pytest.fixture
+def flush_kwargs():
+    return {'window': 30, 'max_delay': 120, 'flush_value': 500}
+
+
+def test_memory_buffer_store(transactions_sample):
+    store = memory_buffer_store(state={})
+
+    assert store.peek() is None
+    assert store.claim(owner='a', now=100, timeout=60) is None
+
+    store.append(transactions=transactions_sample[0:1], now=100)
+    buffer = store.append(transactions=transactions_sample[1:], now=110)
+
+    assert buffer == alert_buffer(
+        transactions=transactions_sample,
+        first_seen=100,
+        last_seen=110,
+    )
+    assert store.peek() == buffer
+    assert store.claim(owner='a', now=120, timeout=60) == buffer
+
+    # Claimed by another invocation until the claim expires
+    assert store.claim(owner='b', now=150, timeout=60) is None
+
+    # Failed alert: released, still buffered
+    store.release(owner='a')
+    assert store.claim(owner='b', now=150, timeout=60) == buffer
+
+    # Appended during the alert: kept once the claimed ones are removed
+    new_transaction = {'transaction-hash': 'hash-new', 'details': {}}
+    store.append(transactions=[new_transaction], now=155)
+    store.complete(owner='a', transaction_hashes=['hash-new'])
+    store.complete(owner='b', transaction_hashes=[
+        t['transaction-hash'] for t in buffer.transactions
+    ])
+
+    assert store.peek() == alert_buffer(
+        transactions=[new_transaction],
+        first_seen=150,
+        last_seen=155,
+    )
+
+    store.claim(owner='c', now=200, timeout=60)
+    store.complete(owner='c', transaction_hashes=['hash-new'])
+
+    assert store.peek() is None
+
+
+def test_memory_buffer_store_claim_expiration(transactions_sample):
+    store = memory_buffer_store(state={})
+    store.append(transactions=transactions_sample, now=100)
+
+    assert store.claim(owner='a', now=100, timeout=60) is not None
+    assert store.claim(owner='b', now=161, timeout=60) is not None
+
+    # Completing a claim taken over leaves the buffer to its new owner
+    store.complete(owner='a', transaction_hashes=['hash-1'])
+
+    assert len(store.peek().transactions) == len(transactions_sample)
+
+
+@pytest.fixture
+def buffer_item(transactions_sample):
+    return {
+        **BUFFER_KEY,
+        'transactions': {
+            'L': [{'S': json.dumps(t)} for t in transactions_sample],
+        },
+        'first_seen': {'N': '100'},
+        'last_seen': {'N': '110.5'},
+        'ttl': {'N': '3710'},
+    }
+
+
+def conditional_check_failed():
+    return ClientError(
+        {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'Operation')
+
+
+def test_dynamodb_buffer_store(transactions_sample, table_name, buffer_item):
+    expected_buffer = alert_buffer(
+        transactions=transactions_sample,
+        first_seen=100,
+        last_seen=110.5,
+    )
+
+    client = mock.Mock()
+    client.update_item.return_value = {'Attributes': buffer_item}
+    client.get_item.return_value = {'Item': buffer_item}
+
+    store = dynamodb_buffer_store(
+        table_name=table_name,
+        client=client,
+        item_ttl=3600,
+    )
+
+    buffer = store.append(transactions=transactions_sample, now=110.5)
+
+    assert buffer == expected_buffer
+    kwargs = client.update_item.call_args[1]
+    assert kwargs['TableName'] == table_name
+    assert kwargs['Key'] == BUFFER_KEY
+    assert kwargs['ExpressionAttributeValues'][':new'] == \
+        buffer_item['transactions']
+    assert kwargs['ExpressionAttributeValues'][':ttl'] == {'N': '3710'}
+
+    assert store.peek() == expected_buffer
+
+    # Claiming marks the item, instead of deleting it
+    assert store.claim(owner='a', now=120, timeout=60) == expected_buffer
+    kwargs = client.update_item.call_args[1]
+    assert kwargs['ExpressionAttributeValues'] == {
+        ':owner': {'S': 'a'},
+        ':until': {'N': '180'},
+        ':now': {'N': '120'},
+    }
+    client.delete_item.assert_not_called()
+
+    client.update_item.side_effect = conditional_check_failed()
+    assert store.claim(owner='b', now=130, timeout=60) is None
+
+    # Releasing a claim taken over is a no-op
+    store.release(owner='b')
+    assert client.update_item.call_args[1]['ConditionExpression'] == \
+        '#owner = :owner'
+
+    client.get_item.return_value = {}
+    assert store.peek() is None
+
+
+def test_dynamodb_buffer_store_complete(
+    transactions_sample,
+    table_name,
+    buffer_item,
+):
+    claimed_item = {
+        **buffer_item,
+        'claimed_by': {'S': 'a'},
+        'claimed_at': {'N': '120'},
+    }
+    new_transaction = {'transaction-hash': 'hash-new', 'details': {}}
+    appended_item = {
+        **claimed_item,
+        'transactions': {'L': claimed_item['transactions']['L'] + [
+            {'S': json.dumps(new_transaction)},
+        ]},
+    }
+
+    client = mock.Mock()
+    store = dynamodb_buffer_store(table_name=table_name, client=client)
+    hashes = [t['transaction-hash'] for t in transactions_sample]
+
+    # Nothing appended since the claim: the item is deleted
+    client.get_item.return_value = {'Item': claimed_item}
+    store.complete(owner='a', transaction_hashes=hashes)
+
+    kwargs = client.delete_item.call_args[1]
+    assert kwargs['ConditionExpression'] == \
+        '#owner = :owner AND size(#tx) = :count'
+    assert kwargs['ExpressionAttributeValues'][':count'] == {'N': '3'}
+
+    # Appended while the first write was attempted: read again, and only
+    # the transactions appended meanwhile are kept
+    client.get_item.side_effect = [
+        {'Item': claimed_item},
+        {'Item': appended_item},
+    ]
+    client.delete_item.side_effect = conditional_check_failed()
+    store.complete(owner='a', transaction_hashes=hashes)
+
+    item = client.put_item.call_args[1]['Item']
+    assert item['transactions'] == {
+        'L': [{'S': json.dumps(new_transaction)}],
+    }
+    assert item['first_seen'] == {'N': '120'}
+    assert 'claimed_by' not in item
+
+    # Claim taken over by another invocation: left to it
+    client.reset_mock()
+    client.get_item.side_effect = None
+    client.get_item.return_value = {
+        'Item': {**claimed_item, 'claimed_by': {'S': 'b'}},
+    }
+    store.complete(owner='a', transaction_hashes=hashes)
+
+    client.put_item.assert_not_called()
+    client.delete_item.assert_not_called()
+
+
+def test_should_flush(transactions_sample, flush_kwargs):
+    buffer = alert_buffer(
+        transactions=transactions_sample,
+        first_seen=1000,
+        last_seen=1050,
+    )
+
+    assert should_flush(None, now=2000, **flush_kwargs) is False
+    assert should_flush(
+        buffer._replace(transactions=[]), now=2000, **flush_kwargs) is False
+
+    # Window still open
+    assert should_flush(buffer, now=1060, **flush_kwargs) is False
+
+    # No new transactions within the window
+    assert should_flush(buffer, now=1080, **flush_kwargs) is True
+
+    # Hard latency cap, even if transactions keep arriving
+    busy_buffer = buffer._replace(last_seen=1115)
+    assert should_flush(busy_buffer, now=1119, **flush_kwargs) is False
+    assert should_flush(busy_buffer, now=1120, **flush_kwargs) is True
+
+    # Large debits are flushed immediately
+    assert should_flush(buffer, now=1050, **{
+        **flush_kwargs,
+        'flush_value': 95.5,
+    }) is True
+
+
+def test_add_transactions(transactions_sample, flush_kwargs):
+    store = memory_buffer_store(state={})
+    now = mock.Mock(return_value=1000)
+
+    def should_flush_mock(buffer, now):
+        return should_flush(buffer, now=now, **flush_kwargs)
+
+    kwargs = {
+        'store': store,
+        'owner': 'a',
+        'now': now,
+        'should_flush': should_flush_mock,
+    }
+
+    assert add_transactions(transactions_sample[0:2], **kwargs) is None
+
+    now.return_value = 1010
+    assert add_transactions(transactions_sample[2:], **kwargs) is None
+
+    # Stream redeliveries are buffered once
+    now.return_value = 1020
+    assert add_transactions(transactions_sample[0:1], **kwargs) is None
+
+    assert len(store.peek().transactions) == 4
+
+    # The window expired before the next batch: everything is flushed
+    now.return_value = 1100
+    new_transaction = {
+        'transaction-hash': 'hash-new',
+        'details': {'value': '1.00'},
+    }
+    flushed = add_transactions([new_transaction], **kwargs)
+
+    assert flushed == transactions_sample + [new_transaction]
+    # Claimed, but buffered until completed
+    assert len(store.peek().transactions) == 5
+    assert add_transactions([], **{**kwargs, 'owner': 'b'}) is None
+
+
+def test_flush_transactions(transactions_sample, flush_kwargs):
+    store = memory_buffer_store(state={})
+    store.append(transactions=transactions_sample, now=1000)
+
+    def should_flush_mock(buffer, now):
+        return should_flush(buffer, now=now, **flush_kwargs)
+
+    kwargs = {'store': store, 'owner': 'a', 'should_flush': should_flush_mock}
+
+    assert flush_transactions(now=lambda: 1010, **kwargs) is None
+    assert flush_transactions(now=lambda: 1030, **kwargs) == \
+        transactions_sample
+    assert flush_transactions(now=lambda: 1040, **kwargs) is None
+
+
+def test_complete_and_restore_transactions(transactions_sample):
+    store = memory_buffer_store(state={})
+    store.append(transactions=transactions_sample, now=1000)
+    kwargs = {'store': store, 'owner': 'a'}
+
+    claim_transactions(now=1000, timeout=60, **kwargs)
+    restore_transactions(**kwargs)
+
+    assert claim_transactions(now=1000, timeout=60, store=store, owner='b') \
+        == transactions_sample
+
+    claim_transactions(now=1100, timeout=60, **kwargs)
+    complete_transactions(transactions_sample[0:1], **kwargs)
+
+    assert store.peek().transactions == transactions_sample[1:]
+
+
+def test_get_coalescer():
+    get_buffer_store = mock.Mock()
+
+    assert get_coalescer(window=0, get_buffer_store=get_buffer_store) is None
+    get_buffer_store.assert_not_called()
+
+    coalescer = get_coalescer(window=30, get_buffer_store=get_buffer_store)
+
+    assert coalescer.add.func == add_transactions
+    assert coalescer.flush.func == flush_transactions
+    assert coalescer.complete.func == complete_transactions
+    assert coalescer.restore.func == restore_transactions
+    assert coalescer.add.keywords['store'] == get_buffer_store.return_value
+    # Every operation of an invocation acts on the same claim
+    assert len({
+        operation.keywords['owner'] for operation in coalescer
+    }) == 1
+
+
+def test_is_flush_event(dynamodb_event):
+    assert is_flush_event({'source': 'aws.events'}) is True
+    assert is_flush_event({'detail-type': 'Scheduled Event'}) is True
+    assert is_flush_event(dynamodb_event) is False
@@ -0,0 +1,258 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from dispatch import (
+    dispatch_alert,
+    DispatchStatus,
+    get_recipients,
+    parse_recipients,
+    Recipient,
+    send_email,
+    send_sms,
+    send_webhook,
+)
+
+
+def test_parse_recipients():
+    spec = ' +1234567890, sms:+1987654321,' \
+        'webhook:https://hooks.local/alert, email:fraud@example.com,,'
+
+    recipients = parse_recipients(spec, email_from='alerts@example.com')
+
+    assert recipients == [
+        Recipient(channel='sms', address='+1234567890'),
+        Recipient(channel='sms', address='+1987654321'),
+        Recipient(channel='webhook', address='https://hooks.local/alert'),
+        Recipient(channel='email', address='fraud@example.com'),
+    ]
+
+    assert parse_recipients(None) == []
+    assert parse_recipients('') == []
+
+
+def test_parse_recipients_without_email_sender():
+    recipients = parse_recipients(
+        '+1234567890,email:fraud@example.com',
+        email_from=None,
+    )
+
+    assert recipients == [Recipient(channel='sms', address='+1234567890')]
+
+
+def test_get_recipients(to_phone_number):
+    recipients = get_recipients(
+        to_phone_number=to_phone_number,
+        alert_recipients=f'{to_phone_number},email:fraud@example.com',
+        email_from='alerts@example.com',
+    )
+
+    assert recipients == [
+        Recipient(channel='sms', address=to_phone_number),
+        Recipient(channel='email', address='fraud@example.com'),
+    ]
+
+
+@mock.patch('dispatch.send_scheduled_message')
+def test_send_sms(send_message, from_phone_number, to_phone_number):
+    secrets = mock.Mock()
+
+    response = send_sms(
+        message='Dummy message',
+        address=to_phone_number,
+        from_phone_number=from_phone_number,
+        secrets=secrets,
+        timeout=5,
+        transactions=[],
+    )
+
+    assert response == send_message.return_value
+    send_message.assert_called_once_with(
+        message='Dummy message',
+        from_phone_number=from_phone_number,
+        to_phone_number=to_phone_number,
+        timeout=5,
+        secrets=secrets,
+    )
+
+
+@mock.patch('requests.post')
+def test_send_webhook(requests_post, transactions_sample):
+    requests_post.return_value.status_code = 204
+
+    response = send_webhook(
+        message='Dummy message',
+        address='https://hooks.local/alert',
+        transactions=transactions_sample,
+        timeout=3,
+        from_phone_number='+1234567890',
+    )
+
+    assert response == {'status_code': 204}
+    requests_post.assert_called_once_with(
+        'https://hooks.local/alert',
+        json={'message': 'Dummy message', 'transactions': transactions_sample},
+        timeout=3,
+    )
+    requests_post.return_value.raise_for_status.assert_called_once_with()
+
+
+def test_send_email():
+    client = mock.Mock()
+    client.send_email.return_value = {'MessageId': 'email-1'}
+
+    response = send_email(
+        message='Dummy message',
+        address='fraud@example.com',
+        email_from='alerts@example.com',
+        subject='Alert',
+        client=client,
+        timeout=5,
+    )
+
+    assert response == {'message_id': 'email-1'}
+    client.send_email.assert_called_once_with(
+        Source='alerts@example.com',
+        Destination={'ToAddresses': ['fraud@example.com']},
+        Message={
+            'Subject': {'Data': 'Alert'},
+            'Body': {'Text': {'Data': 'Dummy message'}},
+        },
+    )
+
+
+def test_send_email_without_sender():
+    client = mock.Mock()
+
+    with pytest.raises(ValueError):
+        send_email(
+            message='Dummy message',
+            address='fraud@example.com',
+            email_from=None,
+            client=client,
+        )
+
+    client.send_email.assert_not_called()
+
+
+def test_dispatch_alert():
+    recipients = [
+        Recipient(channel='sms', address='+1234567890'),
+        Recipient(channel='webhook', address='https://hooks.local/alert'),
+        Recipient(channel='email', address='fraud@example.com'),
+    ]
+
+    senders = {
+        'sms': mock.Mock(return_value={'message_id': 'sid-1'}),
+        'webhook': mock.Mock(side_effect=Exception('Connection refused')),
+        'email': mock.Mock(return_value={'message_id': 'email-1'}),
+    }
+
+    results = dispatch_alert(
+        message='Dummy message',
+        recipients=recipients,
+        senders=senders,
+        timeouts={'sms': 1, 'webhook': 1, 'email': 1},
+        from_phone_number='+9876543210',
+    )
+
+    assert [r['recipient'] for r in results] == [r.address for r in recipients]
+    assert [r['status'] for r in results] == [
+        DispatchStatus.SENT,
+        DispatchStatus.FAILED,
+        DispatchStatus.SENT,
+    ]
+    assert results[0]['response'] == {'message_id': 'sid-1'}
+    assert results[1]['error'] == 'Connection refused'
+
+    senders['sms'].assert_called_once_with(
+        message='Dummy message',
+        address='+1234567890',
+        timeout=1,
+        from_phone_number='+9876543210',
+    )
+
+    assert dispatch_alert(message='Dummy', recipients=[]) == []
+
+
+def test_dispatch_alert_deadline():
+    '''Channel timeouts are shortened to end by the invocation deadline'''
+    sender = mock.Mock(return_value={'message_id': 'sid-1'})
+
+    dispatch_alert(
+        message='Dummy message',
+        recipients=[Recipient(channel='sms', address='+1234567890')],
+        senders={'sms': sender},
+        timeouts={'sms': 8},
+        call_timeout=lambda timeout: min(timeout, 3),
+    )
+
+    assert sender.call_args[1]['timeout'] == 3
+
+
+def test_dispatch_alert_concurrency_and_timeouts():
+    recipients = [
+        Recipient(channel='sms', address=f'+100000000{i}')
+        for i in range(0, 3)
+    ] + [Recipient(channel='webhook', address='https://hooks.local/slow')]
+
+    # All SMS sends only complete when all of them are running concurrently
+    barrier = threading.Barrier(3, timeout=2)
+    release_slow_webhook = threading.Event()
+
+    def send_sms(**kwargs):
+        barrier.wait()
+        return {'to': kwargs['address']}
+
+    def send_slow_webhook(**kwargs):
+        release_slow_webhook.wait(timeout=2)
+
+    results = dispatch_alert(
+        message='Dummy message',
+        recipients=recipients,
+        senders={'sms': send_sms, 'webhook': send_slow_webhook},
+        timeouts={'sms': 2, 'webhook': 0.05},
+        remaining=lambda: 0,
+    )
+
+    release_slow_webhook.set()
+
+    assert [r['status'] for r in results] == [
+        DispatchStatus.SENT,
+        DispatchStatus.SENT,
+        DispatchStatus.SENT,
+        DispatchStatus.TIMEOUT,
+    ]
+
+
+def test_dispatch_alert_waits_for_running_sends():
+    '''A send still running at its timeout is awaited until the deadline'''
+    started = threading.Event()
+
+    def send_late_sms(**kwargs):
+        started.set()
+        time.sleep(0.2)
+        return {'message_id': 'sid-1'}
+
+    def send_queued_webhook(**kwargs):
+        raise AssertionError('Cancelled sends must not run')
+
+    results = dispatch_alert(
+        message='Dummy message',
+        recipients=[
+            Recipient(channel='sms', address='+1234567890'),
+            Recipient(channel='webhook', address='https://hooks.local/a'),
+        ],
+        senders={'sms': send_late_sms, 'webhook': send_queued_webhook},
+        timeouts={'sms': 0.05, 'webhook': 0.05},
+        max_workers=1,
+        remaining=lambda: 1,
+    )
+
+    assert started.is_set()
+    assert results[0]['status'] == DispatchStatus.SENT
+    assert results[0]['response'] == {'message_id': 'sid-1'}
+    # Still queued behind the SMS at its timeout: cancelled, never sent
+    assert results[1]['status'] == DispatchStatus.TIMEOUT
@@ -0,0 +1,166 @@
+import threading
+from unittest import mock
+
+from botocore.exceptions import ClientError
+import pytest
+
+from ledger import (
+    dynamodb_ledger,
+    get_ledger,
+    ledger_key,
+    memory_cache,
+    memory_ledger,
+)
+
+
+def conditional_check_failed():
+    return ClientError(
+        {'Error': {'Code': 'ConditionalCheckFailedException'}},
+        'PutItem',
+    )
+
+
+def test_memory_cache():
+    cache = memory_cache(state={}, max_size=2)
+
+    cache.add('hash-1', expires_at=100)
+    cache.add('hash-2', expires_at=100)
+
+    assert cache.contains('hash-1', now=50) is True
+    assert cache.contains('hash-1', now=100) is False
+    assert cache.contains('hash-3', now=50) is False
+
+    # Oldest entries are evicted first
+    cache.add('hash-3', expires_at=100)
+
+    assert cache.contains('hash-1', now=50) is False
+    assert cache.contains('hash-3', now=50) is True
+
+    cache.discard('hash-3')
+
+    assert cache.contains('hash-3', now=50) is False
+
+
+def test_memory_ledger():
+    now = mock.Mock(return_value=1000)
+    ledger = memory_ledger(
+        cache=memory_cache(state={}),
+        ttl=600,
+        pending_ttl=60,
+        now=now,
+    )
+
+    assert ledger.claim(['hash-1', 'hash-2', 'hash-1']) == ['hash-1', 'hash-2']
+    assert ledger.claim(['hash-1', 'hash-3']) == ['hash-3']
+
+    ledger.release(['hash-1'])
+
+    assert ledger.claim(['hash-1']) == ['hash-1']
+
+    # Delivered alerts are remembered for the whole TTL, while claims left
+    # pending (e.g. by a failed invocation) expire early
+    ledger.confirm(['hash-1'])
+
+    now.return_value = 1060
+    assert ledger.claim(['hash-1', 'hash-2']) == ['hash-2']
+
+    now.return_value = 1600
+    assert ledger.claim(['hash-1']) == ['hash-1']
+
+
+def test_dynamodb_ledger(table_name):
+    client = mock.Mock()
+    client.put_item.side_effect = [None, conditional_check_failed()]
+
+    ledger = dynamodb_ledger(
+        table_name=table_name,
+        client=client,
+        cache=memory_cache(state={}),
+        ttl=600,
+        pending_ttl=60,
+        max_workers=1,
+        now=lambda: 1000.5,
+    )
+
+    assert ledger.claim(['hash-1', 'hash-2']) == ['hash-1']
+
+    kwargs = client.put_item.call_args_list[0][1]
+    assert kwargs['TableName'] == table_name
+    assert kwargs['Item'] == {**ledger_key('hash-1'), 'ttl': {'N': '1060'}}
+    assert kwargs['ExpressionAttributeValues'] == {':now': {'N': '1000'}}
+
+    # Pending claims are not cached: they may be released by their holder
+    client.put_item.reset_mock()
+    client.put_item.side_effect = [conditional_check_failed()] * 2
+
+    assert ledger.claim(['hash-1', 'hash-2']) == []
+    assert client.put_item.call_count == 2
+
+    client.put_item.reset_mock()
+    client.put_item.side_effect = None
+    ledger.confirm(['hash-1'])
+
+    client.put_item.assert_called_once_with(
+        TableName=table_name,
+        Item={**ledger_key('hash-1'), 'ttl': {'N': '1600'}},
+    )
+
+    # Confirmed duplicates are answered by the front cache, without calling
+    # DynamoDB
+    client.put_item.reset_mock()
+
+    assert ledger.claim(['hash-1']) == []
+    client.put_item.assert_not_called()
+
+    ledger.release(['hash-1'])
+
+    client.delete_item.assert_called_once_with(
+        TableName=table_name,
+        Key=ledger_key('hash-1'),
+    )
+
+    assert ledger.claim(['hash-1']) == ['hash-1']
+
+
+def test_dynamodb_ledger_concurrent_claims(table_name):
+    '''Claims of many transactions are written concurrently'''
+    barrier = threading.Barrier(4, timeout=2)
+    client = mock.Mock()
+    client.put_item.side_effect = lambda **kwargs: barrier.wait()
+
+    ledger = dynamodb_ledger(
+        table_name=table_name,
+        client=client,
+        cache=memory_cache(state={}),
+        max_workers=4,
+    )
+
+    hashes = [f'hash-{i}' for i in range(0, 4)]
+
+    assert ledger.claim(hashes) == hashes
+
+
+def test_dynamodb_ledger_errors(table_name):
+    client = mock.Mock()
+    client.put_item.side_effect = ClientError(
+        {'Error': {'Code': 'ProvisionedThroughputExceededException'}},
+        'PutItem',
+    )
+
+    ledger = dynamodb_ledger(
+        table_name=table_name,
+        client=client,
+        cache=memory_cache(state={}),
+    )
+
+    with pytest.raises(ClientError):
+        ledger.claim(['hash-1'])
+
+
+@mock.patch('ledger.memory_ledger')
+@mock.patch('ledger.dynamodb_ledger')
+def test_get_ledger(dynamodb_ledger, memory_ledger, table_name):
+    assert get_ledger(table_name=table_name) == dynamodb_ledger.return_value
+    dynamodb_ledger.assert_called_once_with(table_name=table_name)
+
+    assert get_ledger(table_name=None) == memory_ledger.return_value
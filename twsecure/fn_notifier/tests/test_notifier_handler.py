@@ -1,13 +1,21 @@
+from functools import partial
 import json
 import os
 
 from unittest import mock
 
+import metrics
+
+from secret_bundle import NotifierSecrets
+
 
 @mock.patch('notifier.process_event')
-@mock.patch('notifier.get_secret')
+@mock.patch('notifier.get_notifier_secrets')
+@mock.patch('notifier.get_coalescer', mock.Mock(return_value=None))
+@mock.patch('notifier.get_ledger')
 def test_handler(
-    mock_get_secret,
+    mock_get_ledger,
+    mock_get_secrets,
     mock_process_event,
     dynamodb_event,
     from_phone_number,
@@ -25,21 +33,112 @@ def test_handler(
         process_response = {'foo': 'bar'}
         mock_process_event.return_value = process_response
 
-        mock_get_secret.return_value = {
-            'phone_number': from_phone_number,
-        }
+        secrets = NotifierSecrets(
+            phone_number=from_phone_number,
+            account_id='account-id',
+            api_token='api-token',
+        )
+        mock_get_secrets.return_value = secrets
 
         expected_response = {
             'statusCode': 200,
             'body': json.dumps({'response': process_response}),
+            'batchItemFailures': [],
         }
 
         handler_response = handler(dynamodb_event, None)
 
+        mock_get_secrets.assert_called_once_with(secret_arn=secret_arn)
         mock_process_event.assert_called_with(
             dynamodb_event=dynamodb_event,
-            from_phone_number=mock_get_secret.return_value['phone_number'],
+            from_phone_number=from_phone_number,
             to_phone_number=to_phone_number,
+            secrets=secrets,
+            coalescer=None,
+            ledger=mock_get_ledger.return_value,
         )
 
         assert handler_response == expected_response
+
+        failures = [{'itemIdentifier': '111'}]
+        mock_process_event.return_value = {'batch_item_failures': failures}
+
+        assert handler(dynamodb_event, None)['batchItemFailures'] == failures
+
+
+@mock.patch('notifier.process_flush')
+@mock.patch('notifier.process_event')
+@mock.patch('notifier.get_notifier_secrets')
+@mock.patch('notifier.get_coalescer')
+@mock.patch('notifier.get_ledger')
+def test_handler_scheduled_flush(
+    mock_get_ledger,
+    mock_get_coalescer,
+    mock_get_secrets,
+    mock_process_event,
+    mock_process_flush,
+    from_phone_number,
+    to_phone_number,
+    secret_arn,
+):
+    env_vars = {
+        'SEND_SMS_TO_PHONE_NUMBER': to_phone_number,
+        'SECRET_ARN': secret_arn,
+    }
+
+    with mock.patch.dict(os.environ, env_vars):
+        from notifier import handler
+
+        mock_process_flush.return_value = {'foo': 'bar'}
+        mock_get_secrets.return_value = NotifierSecrets(
+            phone_number=from_phone_number,
+            account_id='account-id',
+            api_token='api-token',
+        )
+
+        scheduled_event = {
+            'source': 'aws.events',
+            'detail-type': 'Scheduled Event',
+        }
+
+        handler_response = handler(scheduled_event, None)
+
+        mock_process_event.assert_not_called()
+        mock_process_flush.assert_called_once_with(
+            coalescer=mock_get_coalescer.return_value,
+            from_phone_number=from_phone_number,
+            to_phone_number=to_phone_number,
+            secrets=mock_get_secrets.return_value,
+            ledger=mock_get_ledger.return_value,
+        )
+        assert handler_response['body'] == \
+            json.dumps({'response': {'foo': 'bar'}})
+
+
+@mock.patch('notifier.process_event')
+@mock.patch('notifier.get_notifier_secrets')
+@mock.patch('notifier.get_coalescer', mock.Mock(return_value=None))
+@mock.patch('notifier.get_ledger', mock.Mock())
+@mock.patch('metrics.start', partial(metrics.start, enabled=True))
+def test_handler_metrics(
+    mock_get_secrets,
+    mock_process_event,
+    dynamodb_event,
+    secret_arn,
+):
+    def process_event(**kwargs):
+        metrics.count('transactions_alerted', 3)
+        return {'foo': 'bar'}
+
+    mock_process_event.side_effect = process_event
+
+    with mock.patch.dict(os.environ, {'SECRET_ARN': secret_arn}):
+        from notifier import handler
+
+        handler_response = handler(dynamodb_event, None)
+
+    body = json.loads(handler_response['body'])
+
+    assert body['response'] == {'foo': 'bar'}
+    assert body['metrics']['counters'] == {'transactions_alerted': 3}
+    assert list(body['metrics']['timers'].keys()) == ['get_secrets']
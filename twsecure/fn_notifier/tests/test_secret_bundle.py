@@ -0,0 +1,120 @@
+import json
+from unittest import mock
+
+import pytest
+
+from secret import secret_provider
+from secret_bundle import (
+    fetch_secrets,
+    get_notifier_secrets,
+    NotifierSecrets,
+    resolve_secrets,
+    SecretResolutionException,
+)
+
+
+@pytest.fixture
+def twilio_secret(from_phone_number):
+    return {
+        'phone_number': from_phone_number,
+        'account_id': 'account-id',
+        'api_token': 'api-token',
+    }
+
+
+def test_fetch_secrets(secret_arn, twilio_secret):
+    get_secret_values = mock.Mock(return_value={
+        secret_arn: json.dumps(twilio_secret),
+        'arn:other': json.dumps({'foo': 'bar'}),
+    })
+    provider = secret_provider(
+        name='dummy',
+        get_secret_values=get_secret_values,
+    )
+
+    secrets = fetch_secrets(
+        secret_arns=[secret_arn, 'arn:other'],
+        provider=provider,
+    )
+
+    assert secrets == {
+        secret_arn: twilio_secret,
+        'arn:other': {'foo': 'bar'},
+    }
+    get_secret_values.assert_called_once_with([secret_arn, 'arn:other'])
+
+
+def test_resolve_secrets(secret_arn, twilio_secret):
+    fetch_secrets_mock = mock.Mock(return_value={secret_arn: twilio_secret})
+
+    values = resolve_secrets(
+        field_arns={'account_id': secret_arn, 'api_token': secret_arn},
+        fetch_secrets=fetch_secrets_mock,
+    )
+
+    assert values == {
+        'account_id': twilio_secret['account_id'],
+        'api_token': twilio_secret['api_token'],
+    }
+    assert fetch_secrets_mock.call_count == 1
+
+    with pytest.raises(SecretResolutionException):
+        resolve_secrets(
+            field_arns={'missing_field': secret_arn},
+            fetch_secrets=fetch_secrets_mock,
+        )
+
+
+def test_get_notifier_secrets(secret_arn, twilio_secret):
+    resolve_secrets_mock = mock.Mock(return_value=twilio_secret)
+
+    secrets = get_notifier_secrets(
+        secret_arn=secret_arn,
+        resolve_secrets=resolve_secrets_mock,
+        cache={},
+    )
+
+    assert isinstance(secrets, NotifierSecrets)
+    assert secrets._asdict() == twilio_secret
+    resolve_secrets_mock.assert_called_once_with(
+        field_arns={
+            'phone_number': secret_arn,
+            'account_id': secret_arn,
+            'api_token': secret_arn,
+        },
+    )
+
+    # The bundle is immutable
+    with pytest.raises(AttributeError):
+        secrets.api_token = 'changed'
+
+
+def test_get_notifier_secrets_cache(secret_arn, twilio_secret):
+    resolve_secrets_mock = mock.Mock(return_value=twilio_secret)
+    now = mock.Mock(return_value=1000)
+    cache = {}
+
+    kwargs = {
+        'secret_arn': secret_arn,
+        'resolve_secrets': resolve_secrets_mock,
+        'cache': cache,
+        'cache_ttl': 300,
+        'now': now,
+    }
+
+    secrets = get_notifier_secrets(**kwargs)
+
+    # Warm invocations within the TTL reuse the resolved bundle
+    now.return_value = 1299
+    assert get_notifier_secrets(**kwargs) is secrets
+    assert resolve_secrets_mock.call_count == 1
+
+    # Expired bundles are resolved again
+    now.return_value = 1300
+    assert get_notifier_secrets(**kwargs) == secrets
+    assert resolve_secrets_mock.call_count == 2
+
+    # A zero TTL disables caching
+    get_notifier_secrets(**{**kwargs, 'cache': {}, 'cache_ttl': 0})
+    get_notifier_secrets(**{**kwargs, 'cache': {}, 'cache_ttl': 0})
+    assert resolve_secrets_mock.call_count == 4
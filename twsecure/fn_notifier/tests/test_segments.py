@@ -0,0 +1,133 @@
+from segments import (
+    combine,
+    count_segments,
+    measure,
+    pack_entries,
+    segment_count,
+    text_units,
+)
+
+
+def test_measure():
+    assert measure('Hello') == text_units(gsm7=5, ucs2=5)
+
+    # Extension table characters take two septets
+    assert measure('€10 [x]') == text_units(gsm7=10, ucs2=7)
+
+    # Characters outside the GSM alphabet force UCS-2
+    assert measure('Café Ō') == text_units(gsm7=None, ucs2=6)
+
+    # Astral plane characters take two UTF-16 code units
+    assert measure('😀') == text_units(gsm7=None, ucs2=2)
+
+
+def test_combine():
+    assert combine(measure('ab'), measure('€')) == text_units(gsm7=4, ucs2=3)
+    assert combine(measure('ab'), measure('Ō')) == \
+        text_units(gsm7=None, ucs2=3)
+
+
+def test_segment_count():
+    assert segment_count('') == 0
+
+    # GSM-7: 160 characters in a single segment, 153 per concatenated one
+    assert segment_count('a' * 160) == 1
+    assert segment_count('a' * 161) == 2
+    assert segment_count('a' * 306) == 2
+    assert segment_count('a' * 307) == 3
+    assert segment_count('€' * 80) == 1
+    assert segment_count('€' * 81) == 2
+
+    # UCS-2: 70 characters in a single segment, 67 per concatenated one
+    assert segment_count('Ō' * 70) == 1
+    assert segment_count('Ō' * 71) == 2
+    assert segment_count('Ō' * 134) == 2
+    assert segment_count('Ō' * 135) == 3
+
+    # A single non-GSM character switches the whole message to UCS-2
+    assert segment_count('a' * 100) == 1
+    assert segment_count('a' * 99 + 'Ō') == 2
+
+    assert count_segments(text_units(gsm7=None, ucs2=70)) == 1
+
+
+def test_pack_entries():
+    entries = [f'entry {i}' for i in range(0, 100)]
+
+    packed = pack_entries(
+        entries=iter(entries),
+        fixed_units=measure('x' * 100),
+        truncation_suffix='...',
+        segment_budget=1,
+    )
+
+    # 100 + 6 * 7 + 5 * 2 (separators) + 3 (suffix) = 155, a 7th is too long
+    assert packed.packed_count == 6
+    assert packed.truncated is True
+    assert packed.entries == ', '.join(entries[0:6]) + '...'
+
+    packed = pack_entries(
+        entries=entries[0:3],
+        fixed_units=measure(''),
+        truncation_suffix='...',
+    )
+
+    assert packed.truncated is False
+    assert packed.entries == 'entry 0, entry 1, entry 2'
+
+
+def test_pack_entries_last_entry_fills_budget():
+    '''The last entry needs no room for a suffix that can't be added'''
+    entries = ['x' * 50, 'y' * 50, 'z' * 50]
+
+    # 6 + 3 * 50 + 2 * 2 (separators) = 160 GSM-7 characters: one full segment
+    packed = pack_entries(
+        entries=entries,
+        fixed_units=measure('w' * 6),
+        truncation_suffix=' ... and others',
+        segment_budget=1,
+    )
+
+    assert packed.packed_count == 3
+    assert packed.truncated is False
+    assert packed.entries == ', '.join(entries)
+
+
+def test_pack_entries_stops_consuming():
+    consumed = []
+
+    def entries():
+        for i in range(0, 1000):
+            consumed.append(i)
+            yield f'entry {i}'
+
+    packed = pack_entries(
+        entries=entries(),
+        fixed_units=measure(''),
+        segment_budget=1,
+    )
+
+    # The entry not fitting, and the one looked ahead
+    assert packed.packed_count == len(consumed) - 2
+
+
+def test_pack_entries_encoding_switch():
+    packed = pack_entries(
+        entries=['Shop (1.00)', 'Café Ōsaka (2.00)', 'Shop 3 (3.00)'],
+        fixed_units=measure('a' * 120),
+        segment_budget=1,
+    )
+
+    # Packing the UCS-2 entry would need 3 segments instead of one
+    assert packed.entries == 'Shop (1.00)'
+    assert packed.truncated is True
+
+
+def test_pack_entries_max_length():
+    packed = pack_entries(
+        entries=['abcd', 'efgh'],
+        fixed_units=measure(''),
+        max_length=8,
+    )
+
+    assert packed.entries == 'abcd'
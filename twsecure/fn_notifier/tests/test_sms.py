@@ -1,72 +1,110 @@
+import threading
 from unittest import mock
 
+import pytest
+from requests.exceptions import ConnectionError
+from twilio.base.exceptions import TwilioRestException
+
+from secret_bundle import NotifierSecrets
 from sms import (
-    get_twilio_account_secret,
+    BaseUrlHttpClient,
+    credentials_fingerprint,
+    get_http_client,
+    get_pooled_client,
     get_twilio_client,
+    is_transient_error,
+    prewarm_twilio_client,
+    reserve_send_slot,
+    retry_delay,
+    rewrite_base_url,
     send_message,
-    SECRET_ARN,
+    send_scheduled_message,
+    SmsNotSentInTimeException,
 )
 
 
-@mock.patch('sms.get_secret')
-def test_get_twilio_account_secret(get_secret):
-    secret_key = 'dummy-key'
-    secret_val = 'foobar'
+def twilio_error(status):
+    return TwilioRestException(status=status, uri='/Messages.json')
 
-    get_secret.return_value = {secret_key: secret_val}
 
-    secret = get_twilio_account_secret(secret_key=secret_key)
+class FakeClock():
+    '''Monotonic clock advanced by sleep calls'''
 
-    get_secret.assert_called_with(
-        SECRET_ARN,
-        load_json=True,
-    )
+    def __init__(self, start=100.0):
+        self.time = start
 
-    assert secret == secret_val
+    def now(self):
+        return self.time
 
+    def sleep(self, seconds):
+        self.time += seconds
 
-@mock.patch('sms.get_twilio_account_secret')
-@mock.patch('sms.TwilioClient')
-def test_get_twilio_client(client_mock, get_secret_mock):
+
+@pytest.fixture
+def secrets():
+    return NotifierSecrets(
+        phone_number='+1234567890',
+        account_id='secret-account-id',
+        api_token='secret-api-token',
+    )
+
+
+@mock.patch('twilio.rest.Client')
+def test_get_twilio_client(client_mock, secrets):
     client_instance = mock.Mock()
     client_mock.return_value = client_instance
 
-    secret_val = 'my-secret'
-    get_secret_mock.return_value = secret_val
+    get_secrets = mock.Mock(return_value=secrets)
 
-    # Try without providing secrets
-    client = get_twilio_client()
+    # Try without providing secrets: the bundle is resolved only once
+    client = get_twilio_client(get_secrets=get_secrets)
 
     assert client == client_instance
 
-    assert get_secret_mock.call_count == 2
-    get_secret_mock.assert_has_calls([
-        mock.call(secret_key='account_id'),
-        mock.call(secret_key='api_token'),
-    ])
+    get_secrets.assert_called_once_with()
     client_mock.assert_called_once_with(
-        username=secret_val,
-        password=secret_val,
+        username=secrets.account_id,
+        password=secrets.api_token,
+        http_client=None,
+    )
+
+    # Try with a pre-resolved secrets bundle
+    client_mock.reset_mock()
+    get_secrets.reset_mock()
+
+    client = get_twilio_client(secrets=secrets, get_secrets=get_secrets)
+
+    assert client == client_instance
+    get_secrets.assert_not_called()
+    client_mock.assert_called_once_with(
+        username=secrets.account_id,
+        password=secrets.api_token,
+        http_client=None,
     )
 
     # Try with custom secret args
     client_mock.reset_mock()
-    get_secret_mock.reset_mock()
+    get_secrets.reset_mock()
 
     account_id = 'account-id'
     api_token = 'api-token'
 
-    client = get_twilio_client(account_id=account_id, api_token=api_token)
+    client = get_twilio_client(
+        account_id=account_id,
+        api_token=api_token,
+        get_secrets=get_secrets,
+    )
 
     assert client == client_instance
-    get_secret_mock.assert_not_called()
+    get_secrets.assert_not_called()
     client_mock.assert_called_once_with(
         username=account_id,
         password=api_token,
+        http_client=None,
     )
 
 
-@mock.patch('sms.get_twilio_client')
+@mock.patch('sms.get_pooled_client')
 def test_send_message(get_client_mock):
     # Mock Twilio response object
     twilio_response = mock.Mock()
@@ -101,7 +139,7 @@ def test_send_message(get_client_mock):
     assert response.get('error_code') == twilio_response.error_code
     assert response.get('error_message') == twilio_response.error_message
 
-    assert get_client_mock.called
+    get_client_mock.assert_called_once_with(secrets=None)
     create_method.assert_called_once_with(
         body=kwargs['message'],
         from_=kwargs['from_phone_number'],
@@ -124,3 +162,260 @@ def test_send_message(get_client_mock):
         from_=kwargs['from_phone_number'],
         to=kwargs['to_phone_number'],
     )
+
+
+def test_get_http_client():
+    http_client = get_http_client(
+        connect_timeout=1.5,
+        read_timeout=4,
+        max_retries=2,
+    )
+
+    assert http_client.timeout == (1.5, 4)
+    assert http_client.session.adapters['https://'].max_retries.total == 2
+
+    # Connections are kept alive in a pooled session
+    assert http_client.session is not None
+    assert type(http_client) is not BaseUrlHttpClient
+
+
+def test_rewrite_base_url():
+    url = 'https://api.twilio.com/2010-04-01/Accounts/AC1/Messages.json?a=1'
+
+    assert rewrite_base_url(url, 'http://localhost:8082') == \
+        'http://localhost:8082/2010-04-01/Accounts/AC1/Messages.json?a=1'
+    assert rewrite_base_url(url, 'http://stub.local/twilio/') == \
+        'http://stub.local/twilio/2010-04-01/Accounts/AC1/Messages.json?a=1'
+
+
+@mock.patch('twilio.http.http_client.TwilioHttpClient.request')
+def test_get_http_client_base_url(request_mock):
+    http_client = get_http_client(base_url='http://localhost:8082')
+
+    assert isinstance(http_client, BaseUrlHttpClient)
+
+    http_client.request('POST', 'https://api.twilio.com/2010-04-01/x.json')
+
+    assert request_mock.call_args[0] == \
+        ('POST', 'http://localhost:8082/2010-04-01/x.json')
+
+
+def test_get_pooled_client(secrets):
+    registry = {}
+    new_client = mock.Mock(side_effect=lambda **kwargs: mock.Mock())
+    new_http_client = mock.Mock()
+
+    kwargs = {
+        'registry': registry,
+        'new_client': new_client,
+        'new_http_client': new_http_client,
+    }
+
+    client = get_pooled_client(secrets=secrets, **kwargs)
+
+    new_client.assert_called_once_with(
+        account_id=secrets.account_id,
+        api_token=secrets.api_token,
+        http_client=new_http_client.return_value,
+    )
+    assert registry['twilio'] == (
+        credentials_fingerprint(secrets.account_id, secrets.api_token),
+        client,
+    )
+
+    # Warm invocations reuse the same client
+    assert get_pooled_client(secrets=secrets, **kwargs) is client
+    assert new_client.call_count == 1
+
+    # Rotated credentials rebuild the client
+    rotated = secrets._replace(api_token='rotated-api-token')
+
+    new_client_instance = get_pooled_client(secrets=rotated, **kwargs)
+
+    assert new_client_instance is not client
+    assert new_client.call_count == 2
+    assert get_pooled_client(secrets=rotated, **kwargs) is new_client_instance
+
+    # Secrets are resolved when not provided
+    get_secrets = mock.Mock(return_value=rotated)
+
+    get_pooled_client(get_secrets=get_secrets, **kwargs)
+
+    get_secrets.assert_called_once_with()
+    assert new_client.call_count == 2
+
+
+def test_prewarm_twilio_client():
+    client = mock.Mock()
+    client.username = 'account-id'
+    get_pooled_client_mock = mock.Mock(return_value=client)
+
+    response = prewarm_twilio_client(
+        open_connection=False,
+        get_pooled_client=get_pooled_client_mock,
+    )
+
+    assert response is client
+    client.api.v2010.accounts.assert_not_called()
+
+    response = prewarm_twilio_client(
+        open_connection=True,
+        get_pooled_client=get_pooled_client_mock,
+    )
+
+    client.api.v2010.accounts.assert_called_once_with('account-id')
+    client.api.v2010.accounts.return_value.fetch.assert_called_once_with()
+
+    # Failures must not break the Lambda init phase
+    get_pooled_client_mock.side_effect = Exception('No secrets available')
+
+    assert prewarm_twilio_client(get_pooled_client=get_pooled_client_mock) \
+        is None
+
+
+def test_is_transient_error():
+    assert is_transient_error(twilio_error(429)) is True
+    assert is_transient_error(twilio_error(503)) is True
+    assert is_transient_error(twilio_error(400)) is False
+    assert is_transient_error(ConnectionError()) is True
+    assert is_transient_error(ValueError()) is False
+
+
+def test_retry_delay():
+    uniform = mock.Mock(side_effect=lambda low, high: high)
+
+    delays = [
+        retry_delay(attempt, base_delay=0.5, max_delay=3, uniform=uniform)
+        for attempt in range(0, 5)
+    ]
+
+    assert delays == [0.5, 1, 2, 3, 3]
+
+
+def test_reserve_send_slot():
+    clock = FakeClock(start=100)
+    kwargs = {
+        'rate': 2,
+        'slots': {},
+        'lock': threading.Lock(),
+        'now': clock.now,
+    }
+
+    # Sends from the same number are spaced by 1 / rate seconds
+    assert reserve_send_slot('+1', deadline=101, **kwargs) == 100
+    assert reserve_send_slot('+1', deadline=101, **kwargs) == 100.5
+    assert reserve_send_slot('+1', deadline=101, **kwargs) == 101
+    assert reserve_send_slot('+1', deadline=101, **kwargs) is None
+
+    # Other senders are paced independently
+    assert reserve_send_slot('+2', deadline=101, **kwargs) == 100
+
+    # Idle senders do not accumulate a burst allowance
+    clock.sleep(10)
+    assert reserve_send_slot('+1', deadline=200, **kwargs) == 110
+
+
+def test_reserve_send_slot_unpaced():
+    '''A rate of zero (or less) disables pacing'''
+    clock = FakeClock(start=100)
+
+    for rate in (0, -1):
+        slots = {}
+        kwargs = {
+            'rate': rate,
+            'slots': slots,
+            'lock': threading.Lock(),
+            'now': clock.now,
+        }
+
+        assert reserve_send_slot('+1', deadline=101, **kwargs) == 100
+        assert reserve_send_slot('+1', deadline=101, **kwargs) == 100
+
+        # A throttled sender is still held back
+        slots['+1'] = 100.5
+        assert reserve_send_slot('+1', deadline=101, **kwargs) == 100.5
+
+
+def scheduled_kwargs(clock, slots=None):
+    slots = {} if slots is None else slots
+
+    return {
+        'message': 'Dummy message',
+        'from_phone_number': '+1234567890',
+        'to_phone_number': '+1987654321',
+        'retry_delay': lambda attempt: 2 ** attempt,
+        'reserve_send_slot': lambda from_phone_number, deadline:
+            reserve_send_slot(
+                from_phone_number,
+                deadline=deadline,
+                rate=1,
+                slots=slots,
+                lock=threading.Lock(),
+                now=clock.now,
+            ),
+        'defer_sender': lambda from_phone_number, until:
+            slots.update({from_phone_number: until}),
+        'now': clock.now,
+        'sleep': clock.sleep,
+    }
+
+
+def test_send_scheduled_message_retries():
+    clock = FakeClock(start=100)
+    send = mock.Mock(side_effect=[
+        twilio_error(429),
+        twilio_error(500),
+        {'message_id': 'sid-1'},
+    ])
+    kwargs = scheduled_kwargs(clock)
+
+    response = send_scheduled_message(send_message=send, timeout=10, **kwargs)
+
+    assert response == {'message_id': 'sid-1'}
+    assert send.call_count == 3
+
+    # Retries waited for 1 then 2 seconds of backoff
+    assert clock.now() == 103
+
+
+def test_send_scheduled_message_permanent_error():
+    clock = FakeClock()
+    send = mock.Mock(side_effect=twilio_error(400))
+
+    with pytest.raises(TwilioRestException):
+        send_scheduled_message(send_message=send, **scheduled_kwargs(clock))
+
+    assert send.call_count == 1
+
+    # Transient errors are raised once attempts are exhausted
+    send = mock.Mock(side_effect=twilio_error(503))
+
+    with pytest.raises(TwilioRestException):
+        send_scheduled_message(
+            send_message=send,
+            max_attempts=3,
+            **scheduled_kwargs(clock),
+        )
+
+    assert send.call_count == 3
+
+
+def test_send_scheduled_message_past_deadline():
+    clock = FakeClock(start=100)
+    send = mock.Mock(side_effect=twilio_error(429))
+    kwargs = scheduled_kwargs(clock)
+
+    # Backing off again would go past the timeout: not delivered
+    with pytest.raises(SmsNotSentInTimeException):
+        send_scheduled_message(send_message=send, timeout=2, **kwargs)
+
+    assert send.call_count == 2
+
+    # No send slot is free for this sender before the deadline
+    send = mock.Mock()
+    kwargs = scheduled_kwargs(clock, slots={'+1234567890': clock.now() + 60})
+
+    with pytest.raises(SmsNotSentInTimeException):
+        send_scheduled_message(send_message=send, timeout=5, **kwargs)
+
+    send.assert_not_called()
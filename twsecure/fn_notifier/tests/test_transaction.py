@@ -1,11 +1,28 @@
+import base64
+import json
 import os
 from unittest import mock
 
+import pytest
+
+from details_codec import encode_binary
+from dispatch import DispatchStatus, Recipient
+from ledger import memory_cache, memory_ledger
 from transaction import (
+    batch_item_failures,
     build_transaction_alert_message,
+    claim_alerts,
+    decode_key,
+    deliver_alert,
     get_transactions_from_event,
     get_table_name,
+    iter_transaction_records,
+    pack_transaction_alert,
+    parse_event,
+    parsed_event,
     process_event,
+    process_flush,
+    release_alerts,
     SMS_MESSAGE_MAX_CHAR_LENGTH,
 )
 
@@ -13,8 +30,11 @@ from transaction import (
 def twilio_response_generator(max):
     for i in range(0, max):
         yield {
-            'message_id': f'sid-{i}',
-            'outcome': 'confirmed',
+            'channel': 'sms',
+            'recipient': f'+100000000{i}',
+            'status': DispatchStatus.SENT,
+            'response': {'message_id': f'sid-{i}'},
+            'error': None,
         }
 
 
@@ -31,19 +51,22 @@ def transactions_generator(max):
         }
 
 
-@mock.patch('transaction.get_transactions_from_event')
-@mock.patch('transaction.send_message')
+@mock.patch('transaction.parse_event')
+@mock.patch('transaction.dispatch_alert')
 def test_process_event(
-    send_message,
+    dispatch_alert,
     get_transactions_mock,
     dynamodb_event,
     transactions_sample,
     from_phone_number,
     to_phone_number,
 ):
-    get_transactions_mock.return_value = transactions_sample
-    twilio_responses = twilio_response_generator(max=len(transactions_sample))
-    send_message.side_effect = twilio_responses
+    get_transactions_mock.return_value = parsed_event(
+        transactions=transactions_sample,
+        sequence_numbers=['1', '2', '3'],
+        undecodable_sequence_numbers=[],
+    )
+    dispatch_alert.return_value = list(twilio_response_generator(max=1))
 
     response = process_event(
         dynamodb_event=dynamodb_event,
@@ -54,19 +77,30 @@ def test_process_event(
     assert type(response) is dict
     assert 'send_message_response' in response.keys()
     assert 'transactions' in response.keys()
+    assert response['send_message_response'] == dispatch_alert.return_value
+    assert response['batch_item_failures'] == []
+    assert response['sms_segments'] == 1
+
+    dispatch_alert.assert_called_once_with(
+        message=build_transaction_alert_message(transactions_sample),
+        recipients=[Recipient(channel='sms', address=to_phone_number)],
+        from_phone_number=from_phone_number,
+        secrets=None,
+        transactions=transactions_sample,
+    )
 
 
-@mock.patch('transaction.get_transactions_from_event')
-@mock.patch('transaction.send_message')
+@mock.patch('transaction.parse_event')
+@mock.patch('transaction.dispatch_alert')
 def test_process_event_no_valid_transactions(
-    send_message,
+    dispatch_alert,
     get_transactions_mock,
     dynamodb_event,
     transactions_sample,
     from_phone_number,
     to_phone_number,
 ):
-    get_transactions_mock.return_value = []
+    get_transactions_mock.return_value = parsed_event([], [], [])
 
     response = process_event(
         dynamodb_event=dynamodb_event,
@@ -74,7 +108,7 @@ def test_process_event_no_valid_transactions(
         to_phone_number=to_phone_number,
     )
 
-    send_message.assert_not_called()
+    dispatch_alert.assert_not_called()
 
     assert type(response) is dict
     assert 'send_message_response' in response.keys()
@@ -82,6 +116,267 @@ def test_process_event_no_valid_transactions(
     assert response['send_message_response'] is None
     assert type(response['transactions']) is list
     assert len(response['transactions']) == 0
+    assert response['batch_item_failures'] == []
+
+
+@mock.patch('transaction.parse_event')
+@mock.patch('transaction.dispatch_alert')
+def test_process_event_batch_item_failures(
+    dispatch_alert,
+    parse_event_mock,
+    dynamodb_event,
+    transactions_sample,
+    from_phone_number,
+    to_phone_number,
+):
+    parse_event_mock.return_value = parsed_event(
+        transactions=transactions_sample,
+        sequence_numbers=['1', '2', '3'],
+        undecodable_sequence_numbers=['4'],
+    )
+    dispatch_alert.return_value = list(twilio_response_generator(max=1))
+
+    kwargs = {
+        'dynamodb_event': dynamodb_event,
+        'from_phone_number': from_phone_number,
+        'to_phone_number': to_phone_number,
+    }
+
+    # The record that could not be decoded is skipped, not retried
+    response = process_event(**kwargs)
+
+    assert response['batch_item_failures'] == []
+
+    # No recipient got the alert: every record is retried
+    dispatch_alert.return_value[0]['status'] = DispatchStatus.FAILED
+
+    response = process_event(**kwargs)
+
+    assert response['batch_item_failures'] == [
+        {'itemIdentifier': seq} for seq in ['1', '2', '3']
+    ]
+
+    # Coalesced transactions go back to the buffer instead
+    coalescer = mock.Mock()
+    coalescer.add.return_value = transactions_sample
+
+    response = process_event(coalescer=coalescer, **kwargs)
+
+    coalescer.restore.assert_called_once_with()
+    coalescer.complete.assert_not_called()
+    assert response['batch_item_failures'] == []
+
+
+@mock.patch('transaction.parse_event')
+@mock.patch('transaction.dispatch_alert')
+def test_process_event_coalesced(
+    dispatch_alert,
+    get_transactions_mock,
+    dynamodb_event,
+    transactions_sample,
+    from_phone_number,
+    to_phone_number,
+):
+    get_transactions_mock.return_value = parsed_event(
+        transactions=transactions_sample,
+        sequence_numbers=['1', '2', '3'],
+        undecodable_sequence_numbers=[],
+    )
+    coalescer = mock.Mock()
+
+    # Transactions are held back while the coalescing window is open
+    coalescer.add.return_value = None
+
+    response = process_event(
+        dynamodb_event=dynamodb_event,
+        from_phone_number=from_phone_number,
+        to_phone_number=to_phone_number,
+        coalescer=coalescer,
+    )
+
+    coalescer.add.assert_called_once_with(transactions=transactions_sample)
+    dispatch_alert.assert_not_called()
+    assert response['send_message_response'] is None
+    assert response['transactions'] == transactions_sample
+    assert response['alerted_transactions_count'] == 0
+
+    # Everything buffered is alerted at once when the window is due
+    buffered = transactions_sample + list(transactions_generator(max=2))
+    coalescer.add.return_value = buffered
+    dispatch_alert.return_value = list(twilio_response_generator(max=1))
+
+    response = process_event(
+        dynamodb_event=dynamodb_event,
+        from_phone_number=from_phone_number,
+        to_phone_number=to_phone_number,
+        coalescer=coalescer,
+    )
+
+    dispatch_alert.assert_called_once()
+    assert dispatch_alert.call_args[1]['transactions'] == buffered
+    assert response['alerted_transactions_count'] == len(buffered)
+    # Delivered: the claimed transactions leave the buffer
+    coalescer.complete.assert_called_once_with(transactions=buffered)
+    coalescer.restore.assert_not_called()
+
+
+@mock.patch('transaction.parse_event')
+@mock.patch('transaction.dispatch_alert')
+def test_process_event_idempotency_ledger(
+    dispatch_alert,
+    parse_event_mock,
+    dynamodb_event,
+    transactions_sample,
+    from_phone_number,
+    to_phone_number,
+):
+    parse_event_mock.return_value = parsed_event(
+        transactions=transactions_sample,
+        sequence_numbers=['1', '2', '3'],
+        undecodable_sequence_numbers=[],
+    )
+    dispatch_alert.return_value = list(twilio_response_generator(max=1))
+
+    kwargs = {
+        'dynamodb_event': dynamodb_event,
+        'from_phone_number': from_phone_number,
+        'to_phone_number': to_phone_number,
+        'ledger': memory_ledger(cache=memory_cache(state={})),
+    }
+
+    response = process_event(**kwargs)
+
+    assert response['alerted_transactions_count'] == len(transactions_sample)
+
+    # Stream redeliveries of the same records are not alerted twice
+    response = process_event(**kwargs)
+
+    dispatch_alert.assert_called_once()
+    assert response['send_message_response'] is None
+    assert response['alerted_transactions_count'] == 0
+    assert response['batch_item_failures'] == []
+
+    # Undelivered alerts are released from the ledger to be retried
+    kwargs['ledger'] = mock.Mock()
+    kwargs['ledger'].claim.return_value = ['hash-1']
+    dispatch_alert.return_value[0]['status'] = DispatchStatus.FAILED
+
+    response = process_event(**kwargs)
+
+    assert dispatch_alert.call_args[1]['transactions'] == \
+        transactions_sample[0:1]
+    kwargs['ledger'].release.assert_called_once_with(['hash-1'])
+    assert len(response['batch_item_failures']) == 3
+
+
+@mock.patch('transaction.dispatch_alert')
+def test_deliver_alert_claims(
+    dispatch_alert,
+    transactions_sample,
+    from_phone_number,
+    to_phone_number,
+):
+    ledger = mock.Mock()
+    ledger.claim.return_value = ['hash-1', 'hash-2']
+    coalescer = mock.Mock()
+    kwargs = {
+        'transactions': transactions_sample,
+        'from_phone_number': from_phone_number,
+        'to_phone_number': to_phone_number,
+        'coalescer': coalescer,
+        'ledger': ledger,
+    }
+
+    # Delivered: the claims are confirmed
+    dispatch_alert.return_value = list(twilio_response_generator(max=1))
+
+    delivery = deliver_alert(**kwargs)
+
+    assert delivery.delivered is True
+    assert delivery.transactions == transactions_sample[0:2]
+    ledger.confirm.assert_called_once_with(['hash-1', 'hash-2'])
+    coalescer.complete.assert_called_once_with(
+        transactions=transactions_sample)
+    ledger.release.assert_not_called()
+
+    # A send raising releases the claims before the exception goes on
+    dispatch_alert.side_effect = RuntimeError('Dispatch failed')
+
+    with pytest.raises(RuntimeError):
+        deliver_alert(**kwargs)
+
+    ledger.release.assert_called_once_with(['hash-1', 'hash-2'])
+    coalescer.restore.assert_called_once_with()
+
+
+@mock.patch('transaction.dispatch_alert')
+def test_process_flush(
+    dispatch_alert,
+    transactions_sample,
+    from_phone_number,
+    to_phone_number,
+):
+    coalescer = mock.Mock()
+    coalescer.flush.return_value = None
+
+    response = process_flush(
+        coalescer=coalescer,
+        from_phone_number=from_phone_number,
+        to_phone_number=to_phone_number,
+    )
+
+    dispatch_alert.assert_not_called()
+    assert response['alerted_transactions_count'] == 0
+
+    coalescer.flush.return_value = transactions_sample
+    dispatch_alert.return_value = list(twilio_response_generator(max=1))
+
+    response = process_flush(
+        coalescer=coalescer,
+        from_phone_number=from_phone_number,
+        to_phone_number=to_phone_number,
+    )
+
+    dispatch_alert.assert_called_once()
+    assert response['send_message_response'] == dispatch_alert.return_value
+    assert response['alerted_transactions_count'] == len(transactions_sample)
+    coalescer.complete.assert_called_once_with(
+        transactions=transactions_sample)
+    coalescer.restore.assert_not_called()
+
+    # Undelivered alerts stay buffered for the next flush
+    dispatch_alert.return_value = [{'status': DispatchStatus.TIMEOUT}]
+
+    process_flush(
+        coalescer=coalescer,
+        from_phone_number=from_phone_number,
+        to_phone_number=to_phone_number,
+    )
+
+    coalescer.restore.assert_called_once_with()
+    coalescer.complete.assert_called_once()
+
+
+def test_claim_alerts(transactions_sample):
+    ledger = mock.Mock()
+    ledger.claim.return_value = ['hash-2']
+
+    assert claim_alerts(transactions_sample, ledger=None) == \
+        transactions_sample
+    assert claim_alerts([], ledger=ledger) == []
+    assert claim_alerts(transactions_sample, ledger=ledger) == \
+        transactions_sample[1:2]
+
+
+def test_release_alerts(transactions_sample):
+    ledger = mock.Mock()
+
+    release_alerts([], ledger=ledger)
+    ledger.release.assert_not_called()
+
+    release_alerts(transactions_sample, ledger=ledger)
+    ledger.release.assert_called_once_with(
+        [t['transaction-hash'] for t in transactions_sample])
 
 
 def test_get_table_name(table_name):
@@ -128,6 +423,70 @@ def test_get_transactions_from_event(
             assert hash_ in item_hashes
 
 
+def test_iter_transaction_records(table_name, dynamodb_event):
+    records = list(iter_transaction_records(dynamodb_event, table_name))
+
+    assert [r['dynamodb']['Keys']['transaction-hash']['S'] for r in records] \
+        == ['hash-1', 'hash-2', 'hash-3']
+
+
+def test_parse_event(table_name, dynamodb_event):
+    dynamodb_event['Records'][1]['dynamodb']['NewImage']['details']['S'] = \
+        '{not json'
+    expected_sequence_numbers = [
+        dynamodb_event['Records'][i]['dynamodb']['SequenceNumber']
+        for i in [0, 1, 2]
+    ]
+
+    event = parse_event(dynamodb_event, get_table_name=lambda: table_name)
+
+    assert [t['transaction-hash'] for t in event.transactions] == \
+        ['hash-1', 'hash-3']
+    assert event.sequence_numbers == [
+        expected_sequence_numbers[0],
+        expected_sequence_numbers[2],
+    ]
+    assert event.undecodable_sequence_numbers == [expected_sequence_numbers[1]]
+
+
+def test_decode_key():
+    assert decode_key({'S': 'abc123'}) == 'abc123'
+
+    # Binary keys are base64-encoded in stream events
+    assert decode_key({'B': 'q8EjRQ=='}) == 'abc12345'
+
+
+def test_parse_event_binary_keys(table_name, dynamodb_event):
+    dynamodb_event['Records'][0]['dynamodb']['Keys']['transaction-hash'] = \
+        {'B': 'q8EjRQ=='}
+
+    event = parse_event(dynamodb_event, get_table_name=lambda: table_name)
+
+    assert [t['transaction-hash'] for t in event.transactions] == \
+        ['abc12345', 'hash-2', 'hash-3']
+
+
+def test_parse_event_binary_details(table_name, dynamodb_event):
+    new_image = dynamodb_event['Records'][0]['dynamodb']['NewImage']
+    details = json.loads(new_image['details']['S'])
+    new_image['details'] = {
+        'B': base64.b64encode(encode_binary(details)).decode(),
+    }
+
+    event = parse_event(dynamodb_event, get_table_name=lambda: table_name)
+
+    assert event.transactions[0]['details'] == details
+    assert event.undecodable_sequence_numbers == []
+
+
+def test_batch_item_failures():
+    assert batch_item_failures([]) == []
+    assert batch_item_failures(['1', '2', '1']) == [
+        {'itemIdentifier': '1'},
+        {'itemIdentifier': '2'},
+    ]
+
+
 def test_build_single_transaction_alert_message():
     transactions = [{
         'transaction-hash': 'hash-1',
@@ -175,5 +534,31 @@ def test_build_multi_transactions_alert_message():
     assert '... and others' in sms_msg
 
 
+def test_pack_transaction_alert():
+    transactions = list(transactions_generator(max=200))
+
+    message = pack_transaction_alert(transactions, segment_budget=1)
+
+    assert message.segments == 1
+    assert message.text.endswith('... and others (reply STOP to unsubscribe)')
+    assert message.packed_count == message.text.count('Dummy Merchant')
+
+    message_2_segments = pack_transaction_alert(
+        transactions,
+        segment_budget=2,
+    )
+
+    assert message_2_segments.segments == 2
+    assert message_2_segments.packed_count > message.packed_count
+
+    # A non-GSM payee would switch the whole message to UCS-2 encoding
+    transactions[1]['details']['payee'] = 'Caf\u00e9 \u014csaka'
+
+    message = pack_transaction_alert(transactions, segment_budget=1)
+
+    assert message.packed_count == 1
+    assert message.segments == 1
+
+
 def test_send_sms():
     pass
@@ -1,80 +1,420 @@
-import json
+import base64
+from collections import namedtuple
+import logging
 import os
-from typing import Callable, List
+from typing import Callable, Iterator, List, Optional, Tuple
 
-from sms import send_message
+from details_codec import decode_details
+import metrics
+
+import coalesce
+from dispatch import dispatch_alert, get_recipients, is_delivered, Recipient
+from ledger import alert_ledger
+from secret_bundle import NotifierSecrets
+from segments import measure, pack_entries, segment_count, SMS_SEGMENT_BUDGET
+
+
+log = logging.getLogger(os.environ.get('LOGGER_NAME', 'NOTIFIER_LOGGER'))
 
 SMS_MESSAGE_MAX_CHAR_LENGTH = 300
 SINGLE_TRANSACTION_MSG_TEMPLATE = 'Transferwise debit: {currency} ' \
     '{value} from {account} to {payee} (reply STOP to unsubscribe)'
 MULTI_TRANSACTION_MSG_TEMPLATE = 'Transferwise {transactions_count} debits ' \
     'to: {payees} (reply STOP to unsubscribe)'
+TRUNCATION_SUFFIX = '... and others'
+
+
+alert_message = namedtuple('alert_message', 'text segments packed_count')
+alert_result = namedtuple('alert_result', 'response segments')
+alert_delivery = namedtuple('alert_delivery', 'alert transactions delivered')
+
+parsed_event = namedtuple('parsed_event', [
+    'transactions',
+    'sequence_numbers',
+    'undecodable_sequence_numbers',
+])
 
 
 def process_event(
     dynamodb_event: dict,
     from_phone_number: str,
     to_phone_number: str,
+    secrets: Optional[NotifierSecrets] = None,
+    recipients: Optional[List[Recipient]] = None,
+    coalescer: Optional[coalesce.coalescer] = None,
+    ledger: Optional[alert_ledger] = None,
 ) -> dict:
-    transactions = get_transactions_from_event(event=dynamodb_event)
-    response = None
+    with metrics.timer('parse_event'):
+        event = parse_event(event=dynamodb_event)
 
-    if len(transactions) > 0:
-        message = build_transaction_alert_message(transactions)
+    transactions = event.transactions
+    alert_transactions = transactions
+    coalesced = None
+    failed_sequence_numbers = []
 
-        response = send_message(
-            message=message,
-            from_phone_number=from_phone_number,
-            to_phone_number=to_phone_number,
-        )
+    if coalescer is not None and len(transactions) > 0:
+        # Hold transactions back until the coalescing window is due
+        coalesced = coalescer.add(transactions=transactions)
+        alert_transactions = coalesced or []
+
+    delivery = deliver_alert(
+        transactions=alert_transactions,
+        from_phone_number=from_phone_number,
+        to_phone_number=to_phone_number,
+        secrets=secrets,
+        recipients=recipients,
+        coalescer=coalescer if coalesced else None,
+        ledger=ledger,
+    )
+
+    # Buffered transactions are retried by the next flush instead
+    if not delivery.delivered and coalescer is None:
+        failed_sequence_numbers += event.sequence_numbers
+
+    metrics.count('records_received', len(dynamodb_event.get('Records', [])))
+    metrics.count('records_failed', len(failed_sequence_numbers))
+    metrics.count('records_undecodable',
+                  len(event.undecodable_sequence_numbers))
+    metrics.count('transactions_alerted', len(delivery.transactions))
 
     return {
-        'send_message_response': response,
+        'send_message_response': delivery.alert.response,
         'transactions': transactions,
+        'alerted_transactions_count': len(delivery.transactions),
+        'sms_segments': delivery.alert.segments,
+        'batch_item_failures': batch_item_failures(failed_sequence_numbers),
     }
 
 
+def process_flush(
+    coalescer: coalesce.coalescer,
+    from_phone_number: str,
+    to_phone_number: str,
+    secrets: Optional[NotifierSecrets] = None,
+    recipients: Optional[List[Recipient]] = None,
+    ledger: Optional[alert_ledger] = None,
+) -> dict:
+    '''Alert transactions held in the coalescing buffer once it is due'''
+    coalesced = coalescer.flush()
+
+    delivery = deliver_alert(
+        transactions=coalesced or [],
+        from_phone_number=from_phone_number,
+        to_phone_number=to_phone_number,
+        secrets=secrets,
+        recipients=recipients,
+        coalescer=coalescer if coalesced else None,
+        ledger=ledger,
+    )
+
+    return {
+        'send_message_response': delivery.alert.response,
+        'transactions': [],
+        'alerted_transactions_count': len(delivery.transactions),
+        'sms_segments': delivery.alert.segments,
+        'batch_item_failures': [],
+    }
+
+
+def deliver_alert(
+    transactions: List[dict],
+    from_phone_number: str,
+    to_phone_number: str,
+    secrets: Optional[NotifierSecrets] = None,
+    recipients: Optional[List[Recipient]] = None,
+    coalescer: Optional[coalesce.coalescer] = None,
+    ledger: Optional[alert_ledger] = None,
+) -> alert_delivery:
+    '''Alert transactions not alerted yet, then settle their claims
+
+    The transactions claimed in the ledger (and in the coalescing buffer, if
+    given) are confirmed once the alert is delivered. When it is not, or the
+    send raises, the claims are released right away for the alert to be
+    retried, instead of holding until they expire.
+    '''
+    claimed = []
+
+    try:
+        claimed = claim_alerts(transactions, ledger=ledger)
+
+        alert = send_transactions_alert(
+            transactions=claimed,
+            from_phone_number=from_phone_number,
+            to_phone_number=to_phone_number,
+            secrets=secrets,
+            recipients=recipients,
+        )
+
+    except Exception:
+        release_alerts(claimed, ledger=ledger)
+
+        if coalescer is not None:
+            coalescer.restore()
+
+        raise
+
+    delivered = alert.response is None or is_delivered(alert.response)
+
+    if not delivered:
+        release_alerts(claimed, ledger=ledger)
+
+        if coalescer is not None:
+            coalescer.restore()
+
+    else:
+        confirm_alerts(claimed, ledger=ledger)
+
+        if coalescer is not None:
+            coalescer.complete(transactions=transactions)
+
+    return alert_delivery(
+        alert=alert,
+        transactions=claimed,
+        delivered=delivered,
+    )
+
+
+def claim_alerts(
+    transactions: List[dict],
+    ledger: Optional[alert_ledger] = None,
+) -> List[dict]:
+    '''Drop transactions the idempotency ledger says were already alerted'''
+    if ledger is None or len(transactions) == 0:
+        return transactions
+
+    with metrics.timer('ledger_claim'):
+        claimed = set(ledger.claim(
+            t['transaction-hash'] for t in transactions))
+
+    new_transactions = [
+        t for t in transactions
+        if t['transaction-hash'] in claimed
+    ]
+
+    if len(new_transactions) < len(transactions):
+        skipped_count = len(transactions) - len(new_transactions)
+        log.info(f'## Skipping {skipped_count} already alerted transactions')
+
+    return new_transactions
+
+
+def confirm_alerts(
+    transactions: List[dict],
+    ledger: Optional[alert_ledger] = None,
+) -> None:
+    '''Remember delivered alerts for the whole ledger TTL'''
+    if ledger is None or len(transactions) == 0:
+        return
+
+    try:
+        ledger.confirm([t['transaction-hash'] for t in transactions])
+
+    except Exception:
+        # Already delivered: failing now would only get it retried, the
+        # claims expire early instead
+        log.exception('## Could not confirm the alerted transactions')
+
+
+def release_alerts(
+    transactions: List[dict],
+    ledger: Optional[alert_ledger] = None,
+) -> None:
+    '''Allow transactions whose alert was not delivered to be alerted again'''
+    if ledger is None or len(transactions) == 0:
+        return
+
+    ledger.release([t['transaction-hash'] for t in transactions])
+
+
+def send_transactions_alert(
+    transactions: List[dict],
+    from_phone_number: str,
+    to_phone_number: str,
+    secrets: Optional[NotifierSecrets] = None,
+    recipients: Optional[List[Recipient]] = None,
+) -> alert_result:
+    if len(transactions) == 0:
+        return alert_result(response=None, segments=0)
+
+    message = pack_transaction_alert(transactions)
+
+    if recipients is None:
+        recipients = get_recipients(to_phone_number=to_phone_number)
+
+    # Fan out to every recipient and channel concurrently
+    with metrics.timer('dispatch_alert'):
+        response = dispatch_alert(
+            message=message.text,
+            recipients=recipients,
+            from_phone_number=from_phone_number,
+            secrets=secrets,
+            transactions=transactions,
+        )
+
+    return alert_result(response=response, segments=message.segments)
+
+
+def batch_item_failures(sequence_numbers: List[str]) -> List[dict]:
+    '''Format failed records for the Lambda ReportBatchItemFailures response'''
+    return [
+        {'itemIdentifier': sequence_number}
+        for sequence_number in dict.fromkeys(sequence_numbers)
+    ]
+
+
 def get_table_name():
     return os.environ['TRANSACTIONS_TABLE_NAME']
 
 
+def iter_transaction_records(event: dict, table_name: str) -> Iterator[dict]:
+    '''Yield INSERT records of the transactions table, without decoding them
+
+    Only cheap string comparisons are made on each record; records from other
+    tables or events are skipped before any payload is touched.
+    '''
+    stream_marker = f':table/{table_name}/stream/'
+
+    for record in event['Records']:
+        if record['eventName'] != 'INSERT':
+            continue
+
+        if stream_marker not in record['eventSourceARN']:
+            continue
+
+        yield record
+
+
+def decode_key(attribute: dict) -> str:
+    '''Hexadecimal transaction hash of a stream key
+
+    Tables with binary keys hold the raw hash bytes, base64-encoded in stream
+    events.
+    '''
+    if 'B' in attribute:
+        return base64.b64decode(attribute['B']).hex()
+
+    return attribute['S']
+
+
+def decode_transaction(record: dict) -> dict:
+    return {
+        'transaction-hash': decode_key(record['dynamodb']['Keys']['transaction-hash']),  # NOQA
+        'details': decode_details(record['dynamodb']['NewImage']['details']),
+    }
+
+
+def iter_event_transactions(
+    event: dict,
+    table_name: str,
+    decode_transaction: Callable = decode_transaction,
+) -> Iterator[Tuple[str, Optional[dict]]]:
+    '''Lazily decode transactions, yielding (sequence number, transaction)
+
+    Records that cannot be decoded are yielded with a None transaction.
+    '''
+    for record in iter_transaction_records(event, table_name=table_name):
+        sequence_number = record['dynamodb']['SequenceNumber']
+
+        try:
+            yield sequence_number, decode_transaction(record)
+
+        except (KeyError, TypeError, ValueError) as exc:
+            log.error(f'## Could not decode record {sequence_number}: {exc}')
+            yield sequence_number, None
+
+
+def parse_event(
+    event: dict,
+    get_table_name: Callable = get_table_name,
+) -> parsed_event:
+    '''Decode the transactions of a stream event
+
+    Records that can't be decoded are logged and skipped, not reported as
+    batch item failures: retrying them would fail the same way, while
+    holding back the shard until they are dropped.
+    '''
+    transactions = []
+    sequence_numbers = []
+    undecodable_sequence_numbers = []
+
+    for sequence_number, transaction in iter_event_transactions(
+        event,
+        table_name=get_table_name(),
+    ):
+        if transaction is None:
+            undecodable_sequence_numbers.append(sequence_number)
+            continue
+
+        transactions.append(transaction)
+        sequence_numbers.append(sequence_number)
+
+    if len(undecodable_sequence_numbers) > 0:
+        log.error(f'## Skipping {len(undecodable_sequence_numbers)} records '
+                  f'that could not be decoded')
+
+    return parsed_event(
+        transactions=transactions,
+        sequence_numbers=sequence_numbers,
+        undecodable_sequence_numbers=undecodable_sequence_numbers,
+    )
+
+
 def get_transactions_from_event(
     event: dict,
     get_table_name: Callable = get_table_name,
 ) -> list:
-    table_name = get_table_name()
+    return parse_event(event, get_table_name=get_table_name).transactions
 
-    return [
-        {
-            'transaction-hash': record['dynamodb']['Keys']['transaction-hash']['S'],  # NOQA
-            'details': json.loads(record['dynamodb']['NewImage']['details']['S']),  # NOQA
-        }
-        for record in event['Records']
-        if table_name in record['eventSourceARN'] and
-        record['eventName'] == 'INSERT'
-    ]
 
+def iter_payee_entries(transactions: List[dict]) -> Iterator[str]:
+    for t in transactions:
+        yield f'{t["details"]["payee"]} ({t["details"]["value"]})'
 
-def build_transaction_alert_message(
+
+def pack_transaction_alert(
     transactions: List[dict],
     message_max_length: int = SMS_MESSAGE_MAX_CHAR_LENGTH,
+    segment_budget: int = SMS_SEGMENT_BUDGET,
     single_transaction_template: str = SINGLE_TRANSACTION_MSG_TEMPLATE,
     multi_transaction_template: str = MULTI_TRANSACTION_MSG_TEMPLATE,
-) -> str:
+) -> alert_message:
+    '''Build the alert, packing as many payees as fit in the segment budget'''
     if len(transactions) == 1:
-        return single_transaction_template.format(**transactions[0]['details'])
+        text = single_transaction_template.format(**transactions[0]['details'])
 
-    max_payee_length = message_max_length - len(multi_transaction_template)
+        return alert_message(
+            text=text,
+            segments=segment_count(text),
+            packed_count=1,
+        )
 
-    payees = ', '.join([
-        f'{t["details"]["payee"]} ({t["details"]["value"]})'
-        for t in transactions
-    ])
+    fixed_text = multi_transaction_template.format(
+        transactions_count=len(transactions),
+        payees='',
+    )
 
-    if len(payees) > max_payee_length:
-        payees = payees[0:max_payee_length] + '... and others'
+    payees = pack_entries(
+        entries=iter_payee_entries(transactions),
+        fixed_units=measure(fixed_text),
+        truncation_suffix=TRUNCATION_SUFFIX,
+        segment_budget=segment_budget,
+        max_length=message_max_length,
+    )
 
-    return multi_transaction_template.format(
+    text = multi_transaction_template.format(
         transactions_count=len(transactions),
-        payees=payees,
+        payees=payees.entries,
     )
+
+    return alert_message(
+        text=text,
+        segments=segment_count(text),
+        packed_count=payees.packed_count,
+    )
+
+
+def build_transaction_alert_message(
+    transactions: List[dict],
+    **kwargs,
+) -> str:
+    return pack_transaction_alert(transactions, **kwargs).text
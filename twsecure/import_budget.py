@@ -0,0 +1,252 @@
+#!/.env/bin/python Python3
+'''Import-time budget report for the Lambda handlers
+
+Each handler module is imported in a fresh interpreter with "-X importtime"
+(the closest local equivalent of a cold start's init phase), a few times to
+smooth out noise. The output is parsed into a summary of total import time
+and the most expensive modules, and checked against a time budget and a
+list of heavy packages that must only be imported on first use.
+
+Exits with status 1 when a handler is over budget.
+'''
+import argparse
+from collections import namedtuple
+import json
+import os
+import subprocess
+import sys
+from typing import Dict, Iterable, List, Optional, Set
+
+
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+LAYER_PATHS = [
+    os.path.join(ROOT_PATH, 'layer_dynamodb/python/lib/python3.8/site-packages'),  # NOQA
+    os.path.join(ROOT_PATH, 'layer_secret/python/lib/python3.8/site-packages'),  # NOQA
+    os.path.join(ROOT_PATH, 'layer_common/python/lib/python3.8/site-packages'),  # NOQA
+]
+
+handler_spec = namedtuple('handler_spec', 'path module budget_ms')
+
+HANDLERS = {
+    'monitor': handler_spec(
+        path=os.path.join(ROOT_PATH, 'fn_monitor'),
+        module='monitor',
+        budget_ms=60,
+    ),
+    'notifier': handler_spec(
+        path=os.path.join(ROOT_PATH, 'fn_notifier'),
+        module='notifier',
+        budget_ms=60,
+    ),
+}
+
+# Packages only needed once a handler talks to an API
+DEFERRED_PACKAGES = ('boto3', 'botocore', 'requests', 'twilio', 'yaml')
+
+# Init-phase prewarming (clients created before the first invocation, e.g.
+# TWILIO_PREWARM) is opt-in work moved to init on purpose: it is switched off
+# so that only the imports themselves are measured
+MEASURED_ENV = {
+    'AWS_CLIENTS_PREWARM': '',
+    'TWILIO_PREWARM': 'false',
+    'TWILIO_PREWARM_CONNECTION': 'false',
+}
+
+import_entry = namedtuple('import_entry', 'name self_us cumulative_us depth')
+
+
+def parse_importtime(lines: Iterable[str]) -> List[import_entry]:
+    '''Parse "-X importtime" lines, e.g.
+
+    import time: self [us] | cumulative | imported package
+    import time:       317 |     172475 |   transferwise
+    '''
+    entries = []
+
+    for line in lines:
+        if not line.startswith('import time:'):
+            continue
+
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+
+        if not self_us.strip().isdigit():
+            continue  # Header line
+
+        entries.append(import_entry(
+            name=name.strip(),
+            self_us=int(self_us),
+            cumulative_us=int(cumulative_us),
+            depth=(len(name) - len(name.lstrip()) - 1) // 2,
+        ))
+
+    return entries
+
+
+def import_module(
+    module: str,
+    path: str,
+    source_paths: List[str] = LAYER_PATHS,
+    python: str = sys.executable,
+    env: Optional[Dict[str, str]] = None,
+) -> List[import_entry]:
+    '''Import a module in a fresh interpreter and parse its import times'''
+    result = subprocess.run(
+        [python, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=path,
+        env={
+            **(os.environ if env is None else env),
+            **MEASURED_ENV,
+            'PYTHONPATH': os.pathsep.join([path, *source_paths]),
+        },
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    return parse_importtime(result.stderr.splitlines())
+
+
+IMPORTED_MODULES_SCRIPT = '''
+import sys
+import {module}
+print("\\n".join(sys.modules))
+'''
+
+
+def imported_packages(
+    module: str,
+    path: str,
+    source_paths: List[str] = LAYER_PATHS,
+    python: str = sys.executable,
+) -> Set[str]:
+    '''Top-level packages loaded by a module imported in a fresh interpreter'''
+    result = subprocess.run(
+        [python, '-c', IMPORTED_MODULES_SCRIPT.format(module=module)],
+        cwd=path,
+        env={
+            **os.environ,
+            **MEASURED_ENV,
+            'PYTHONPATH': os.pathsep.join([path, *source_paths]),
+        },
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    return {name.split('.')[0] for name in result.stdout.split()}
+
+
+def best_of(runs: List[List[import_entry]]) -> List[import_entry]:
+    '''Keep the fastest run, as noise only ever adds time'''
+    return min(runs, key=lambda entries: sum(e.self_us for e in entries))
+
+
+def summarize(
+    entries: List[import_entry],
+    module: str,
+    top_n: int = 10,
+    deferred_packages: Iterable[str] = DEFERRED_PACKAGES,
+) -> dict:
+    # Children are listed before their parent: the handler's imports are the
+    # deeper entries right above its own line
+    handler_index = max(
+        index for index, entry in enumerate(entries) if entry.name == module)
+    handler_entry = entries[handler_index]
+    handler_entries = [handler_entry]
+
+    for entry in reversed(entries[:handler_index]):
+        if entry.depth <= handler_entry.depth:
+            break
+
+        handler_entries.append(entry)
+
+    loaded = {entry.name.split('.')[0] for entry in handler_entries}
+
+    return {
+        'module': module,
+        'total_ms': round(handler_entry.cumulative_us / 1000, 1),
+        'modules_imported': len(handler_entries),
+        'slowest_cumulative': [
+            {'module': e.name, 'ms': round(e.cumulative_us / 1000, 1)}
+            for e in sorted(handler_entries[1:], key=lambda e: e.cumulative_us,
+                            reverse=True)[:top_n]
+        ],
+        'slowest_self': [
+            {'module': e.name, 'ms': round(e.self_us / 1000, 1)}
+            for e in sorted(handler_entries, key=lambda e: e.self_us,
+                            reverse=True)[:top_n]
+        ],
+        'deferred_packages_imported': sorted(
+            package for package in deferred_packages if package in loaded
+        ),
+    }
+
+
+def check_budget(summary: dict, budget_ms: float) -> List[str]:
+    '''Budget violations of a handler summary, empty when within budget'''
+    violations = []
+
+    if summary['total_ms'] > budget_ms:
+        violations.append(
+            f'{summary["module"]} imports in {summary["total_ms"]} ms, over '
+            f'the {budget_ms} ms budget')
+
+    for package in summary['deferred_packages_imported']:
+        violations.append(
+            f'{summary["module"]} imports "{package}" at import time')
+
+    return violations
+
+
+def report(
+    handlers: Dict[str, handler_spec] = HANDLERS,
+    runs: int = 5,
+    top_n: int = 10,
+    budget_ms: Optional[float] = None,
+) -> dict:
+    results = {}
+
+    for name, spec in handlers.items():
+        entries = best_of([
+            import_module(spec.module, path=spec.path)
+            for _ in range(runs)
+        ])
+
+        summary = summarize(entries, module=spec.module, top_n=top_n)
+        handler_budget = spec.budget_ms if budget_ms is None else budget_ms
+
+        results[name] = {
+            **summary,
+            'budget_ms': handler_budget,
+            'violations': check_budget(summary, budget_ms=handler_budget),
+        }
+
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+
+    parser.add_argument('handlers', nargs='*', metavar='handler',
+                        help=f'One of {", ".join(HANDLERS)} (default: all)')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help='Override the budget of every handler')
+
+    args = parser.parse_args()
+
+    results = report(
+        handlers={name: HANDLERS[name] for name in args.handlers or HANDLERS},
+        runs=args.runs,
+        top_n=args.top,
+        budget_ms=args.budget_ms,
+    )
+
+    print(json.dumps(results, indent=2))
+
+    return 1 if any(r['violations'] for r in results.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
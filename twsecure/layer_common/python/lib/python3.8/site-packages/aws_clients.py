@@ -0,0 +1,126 @@
+#!/usr/bin/python3 Python3
+'''Container-wide AWS clients, one per service and region
+
+Creating a boto3 client sets up a session, loads the service model and
+resolves its endpoint, which is too slow to repeat on every invocation.
+Clients are created once with a tuned botocore config (timeouts, retries,
+connection pool, TCP keepalive), and reused by warm containers.
+
+Services listed in AWS_CLIENTS_PREWARM are created when a handler module is
+imported, during the Lambda init phase. boto3 is imported on first use.
+'''
+import logging
+import os
+import threading
+from typing import (
+    Callable, Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING,
+)
+
+if TYPE_CHECKING:
+    import botocore  # NOQA
+
+
+log = logging.getLogger(os.environ.get('LOGGER_NAME'))
+
+AWS_CONNECT_TIMEOUT = float(os.environ.get('AWS_CONNECT_TIMEOUT', 3))
+AWS_READ_TIMEOUT = float(os.environ.get('AWS_READ_TIMEOUT', 5))
+# Total attempts, including the first one, with the "standard" retry mode
+# (exponential back-off with jitter, throttling errors included)
+AWS_MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', 3))
+AWS_RETRY_MODE = os.environ.get('AWS_RETRY_MODE', 'standard')
+# Matches the thread pools concurrently calling a client (e.g. notifier
+# dispatch); botocore defaults to 10
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 10))
+AWS_TCP_KEEPALIVE = os.environ.get('AWS_TCP_KEEPALIVE', 'true') == 'true'
+
+# Comma-separated services to create clients for in the Lambda init phase
+AWS_CLIENTS_PREWARM = [
+    service.strip()
+    for service in os.environ.get('AWS_CLIENTS_PREWARM', '').split(',')
+    if service.strip()
+]
+
+# Clients of the container, by (service name, region name)
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+
+def client_config(
+    connect_timeout: float = AWS_CONNECT_TIMEOUT,
+    read_timeout: float = AWS_READ_TIMEOUT,
+    max_attempts: int = AWS_MAX_ATTEMPTS,
+    retry_mode: str = AWS_RETRY_MODE,
+    max_pool_connections: int = AWS_MAX_POOL_CONNECTIONS,
+    tcp_keepalive: bool = AWS_TCP_KEEPALIVE,
+) -> 'botocore.config.Config':
+    from botocore.config import Config
+
+    return Config(
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        retries={'max_attempts': max_attempts, 'mode': retry_mode},
+        max_pool_connections=max_pool_connections,
+        tcp_keepalive=tcp_keepalive,
+    )
+
+
+def new_client(
+    service_name: str,
+    region_name: Optional[str] = None,
+    config: Optional['botocore.config.Config'] = None,
+) -> 'botocore.client.BaseClient':
+    import boto3
+
+    return boto3.client(
+        service_name,
+        region_name=region_name,
+        config=client_config() if config is None else config,
+    )
+
+
+def default_region() -> Optional[str]:
+    return os.environ.get('AWS_REGION') or \
+        os.environ.get('AWS_DEFAULT_REGION')
+
+
+def get_client(
+    service_name: str,
+    region_name: Optional[str] = None,
+    clients: Dict[Tuple[str, Optional[str]], object] = CLIENTS,
+    new_client: Callable = new_client,
+) -> 'botocore.client.BaseClient':
+    '''Return the container-wide client of a service, creating it once'''
+    key = (service_name, region_name or default_region())
+
+    client = clients.get(key)
+
+    if client is not None:
+        return client
+
+    # boto3's default session is not thread-safe while creating clients
+    with CLIENTS_LOCK:
+        if key not in clients:
+            clients[key] = new_client(service_name, region_name=key[1])
+
+        return clients[key]
+
+
+def prewarm(
+    service_names: Iterable[str] = AWS_CLIENTS_PREWARM,
+    get_client: Callable = get_client,
+) -> List['botocore.client.BaseClient']:
+    '''Lambda init-phase hook: create the clients a handler will use
+
+    Failures are left for the first invocation to surface.
+    '''
+    clients = []
+
+    for service_name in service_names:
+        try:
+            clients.append(get_client(service_name))
+
+        except Exception as exc:
+            log.warning(
+                f'## Could not pre-warm the {service_name} client: {exc}')
+
+    return clients
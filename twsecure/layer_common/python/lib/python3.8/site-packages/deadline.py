@@ -0,0 +1,70 @@
+#!/usr/bin/python3 Python3
+'''Time budget of the running invocation, from the Lambda context
+
+A handler starts the deadline at the beginning of each invocation from
+"context.get_remaining_time_in_millis()", less a safety margin to return
+its response. Code down the call stack (including worker threads) shortens
+its network timeouts with "call_timeout" and checks "expired" before
+starting more work. Without a Lambda context (e.g. local runs) there is no
+deadline.
+'''
+import math
+import os
+import time
+from typing import Callable
+
+
+# Seconds kept after the deadline to build and return the response
+DEADLINE_SAFETY_MARGIN = float(
+    os.environ.get('DEADLINE_SAFETY_MARGIN_SECONDS', 2))
+# Shortest timeout given to a call, however close the deadline is
+DEADLINE_MIN_CALL_TIMEOUT = float(
+    os.environ.get('DEADLINE_MIN_CALL_TIMEOUT_SECONDS', 0.5))
+
+# Deadline of the running invocation, as a time.monotonic() timestamp
+CURRENT = {'deadline': math.inf}
+
+
+def start(
+    context=None,
+    safety_margin: float = DEADLINE_SAFETY_MARGIN,
+    current: dict = CURRENT,
+    now: Callable = time.monotonic,
+) -> float:
+    '''Start the deadline of an invocation, returning the seconds available'''
+    get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+
+    if get_remaining_time is None:
+        current['deadline'] = math.inf
+    else:
+        current['deadline'] = \
+            now() + get_remaining_time() / 1000 - safety_margin
+
+    return remaining(current=current, now=now)
+
+
+def remaining(
+    current: dict = CURRENT,
+    now: Callable = time.monotonic,
+) -> float:
+    '''Seconds left until the deadline (infinite without one)'''
+    return current['deadline'] - now()
+
+
+def expired(
+    reserve: float = 0,
+    current: dict = CURRENT,
+    now: Callable = time.monotonic,
+) -> bool:
+    '''Whether less than "reserve" seconds are left until the deadline'''
+    return remaining(current=current, now=now) <= reserve
+
+
+def call_timeout(
+    timeout: float,
+    min_timeout: float = DEADLINE_MIN_CALL_TIMEOUT,
+    current: dict = CURRENT,
+    now: Callable = time.monotonic,
+) -> float:
+    '''Timeout of a call, shortened so that it ends by the deadline'''
+    return min(timeout, max(remaining(current=current, now=now), min_timeout))
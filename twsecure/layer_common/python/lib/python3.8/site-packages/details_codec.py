@@ -0,0 +1,213 @@
+#!/usr/bin/python3 Python3
+'''Encoding of the transaction "details" attribute stored in DynamoDB
+
+DETAILS_ENCODING selects how the monitor writes it:
+
+- "json": JSON text in an S attribute, as stored so far
+- "binary": a B attribute holding a version byte, a compression byte and
+  the details as length-prefixed UTF-8 key/value strings, compressed with
+  DETAILS_COMPRESSION ("zlib" or "zstd") when at least
+  DETAILS_COMPRESSION_THRESHOLD bytes long
+
+Readers decode either form, so the encoding can be switched at any time.
+'''
+import base64
+import json
+import os
+from typing import Callable, Dict, Iterator, Tuple
+
+
+class DetailsEncoding():
+    JSON = 'json'
+    BINARY = 'binary'
+
+
+DETAILS_ENCODING = os.environ.get('DETAILS_ENCODING', DetailsEncoding.JSON)
+DETAILS_COMPRESSION = os.environ.get('DETAILS_COMPRESSION', 'zlib')
+DETAILS_COMPRESSION_THRESHOLD = int(
+    os.environ.get('DETAILS_COMPRESSION_THRESHOLD', 256))
+
+BINARY_VERSION = 1
+
+# Compression byte of a binary attribute
+COMPRESSION_NONE = 0
+COMPRESSION_IDS = {'none': COMPRESSION_NONE, 'zlib': 1, 'zstd': 2}
+
+
+def zlib_codec() -> Tuple[Callable, Callable]:
+    import zlib
+
+    return zlib.compress, zlib.decompress
+
+
+def zstd_codec() -> Tuple[Callable, Callable]:
+    # Optional dependency, only needed when zstd is configured or read
+    import zstandard
+
+    return (
+        zstandard.ZstdCompressor().compress,
+        zstandard.ZstdDecompressor().decompress,
+    )
+
+
+# Factories of (compress, decompress) by compression byte
+COMPRESSION_CODECS = {1: zlib_codec, 2: zstd_codec}
+
+
+def write_varint(value: int) -> bytes:
+    encoded = bytearray()
+
+    while value >= 0x80:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+
+    encoded.append(value)
+
+    return bytes(encoded)
+
+
+def read_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    '''Decode a varint at an offset, returning (value, next offset)'''
+    value = 0
+    shift = 0
+
+    while True:
+        if offset >= len(data):
+            raise ValueError('Truncated binary details')
+
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+
+        if byte < 0x80:
+            return value, offset
+
+        shift += 7
+
+
+def pack_strings(details: Dict[str, str]) -> bytes:
+    chunks = []
+
+    for key, value in details.items():
+        if not isinstance(value, str):
+            raise TypeError(
+                f'Binary details only hold strings, got {key}={value!r}')
+
+        for text in (key, value):
+            encoded = text.encode('utf-8')
+            chunks.append(write_varint(len(encoded)))
+            chunks.append(encoded)
+
+    return b''.join(chunks)
+
+
+def iter_strings(data: bytes) -> Iterator[str]:
+    offset = 0
+
+    while offset < len(data):
+        length, offset = read_varint(data, offset)
+
+        if offset + length > len(data):
+            raise ValueError('Truncated binary details')
+
+        yield data[offset:offset + length].decode('utf-8')
+        offset += length
+
+
+def unpack_strings(data: bytes) -> Dict[str, str]:
+    strings = list(iter_strings(data))
+
+    if len(strings) % 2 != 0:
+        raise ValueError('Binary details have a key without a value')
+
+    return dict(zip(strings[::2], strings[1::2]))
+
+
+def encode_binary(
+    details: Dict[str, str],
+    compression: str = DETAILS_COMPRESSION,
+    threshold: int = DETAILS_COMPRESSION_THRESHOLD,
+    codecs: dict = COMPRESSION_CODECS,
+) -> bytes:
+    if compression not in COMPRESSION_IDS:
+        raise ValueError(f'Unknown details compression: {compression}')
+
+    body = pack_strings(details)
+    compression_id = COMPRESSION_NONE
+
+    if COMPRESSION_IDS[compression] != COMPRESSION_NONE and \
+            len(body) >= threshold:
+        compress, _ = codecs[COMPRESSION_IDS[compression]]()
+        compressed = compress(body)
+
+        # Small or random payloads can grow once compressed
+        if len(compressed) < len(body):
+            body = compressed
+            compression_id = COMPRESSION_IDS[compression]
+
+    return bytes((BINARY_VERSION, compression_id)) + body
+
+
+def decode_binary(
+    data: bytes,
+    codecs: dict = COMPRESSION_CODECS,
+) -> Dict[str, str]:
+    if len(data) < 2:
+        raise ValueError('Binary details are missing their header')
+
+    version, compression_id = data[0], data[1]
+
+    if version != BINARY_VERSION:
+        raise ValueError(f'Unsupported binary details version: {version}')
+
+    body = data[2:]
+
+    if compression_id != COMPRESSION_NONE:
+        if compression_id not in codecs:
+            raise ValueError(
+                f'Unknown binary details compression: {compression_id}')
+
+        _, decompress = codecs[compression_id]()
+
+        try:
+            body = decompress(body)
+
+        except Exception as exc:
+            raise ValueError(f'Corrupt binary details: {exc}') from exc
+
+    return unpack_strings(body)
+
+
+def encode_details(
+    details: dict,
+    encoding: str = DETAILS_ENCODING,
+    encode_binary: Callable = encode_binary,
+) -> dict:
+    '''DynamoDB attribute holding the details of a transaction'''
+    if encoding == DetailsEncoding.BINARY:
+        return {'B': encode_binary(details)}
+
+    if encoding != DetailsEncoding.JSON:
+        raise ValueError(f'Unknown details encoding: {encoding}')
+
+    return {'S': json.dumps(details)}
+
+
+def decode_details(
+    attribute: dict,
+    decode_binary: Callable = decode_binary,
+) -> dict:
+    '''Details held by an attribute of either encoding
+
+    Binary values are bytes when read through boto3, but base64 text in
+    DynamoDB stream events.
+    '''
+    if 'B' in attribute:
+        data = attribute['B']
+
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+
+        return decode_binary(bytes(data))
+
+    return json.loads(attribute['S'])
@@ -0,0 +1,185 @@
+#!/usr/bin/python3 Python3
+'''Per-invocation timers and counters, emitted as CloudWatch EMF log lines
+
+A handler starts a recorder at the beginning of each invocation; any code
+down the call stack (including worker threads) records into it with the
+module-level "timer", "count" and "timed" helpers. When metrics are disabled
+those helpers resolve to no-ops.
+'''
+from collections import namedtuple
+import contextlib
+from functools import wraps
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false') == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'TransferwiseSecure')
+
+# EMF accepts up to 100 values per metric in a single log line
+MAX_VALUES_PER_METRIC = 100
+
+recorder = namedtuple('recorder', 'enabled timer count snapshot')
+
+NULL_TIMER = contextlib.nullcontext()
+
+NULL_RECORDER = recorder(
+    enabled=False,
+    timer=lambda name: NULL_TIMER,
+    count=lambda name, value=1: None,
+    snapshot=lambda: {'timers': {}, 'counters': {}},
+)
+
+# Recorder of the running invocation
+CURRENT = {'recorder': NULL_RECORDER}
+
+
+def new_recorder(now: Callable = time.perf_counter) -> recorder:
+    timers = {}
+    counters = {}
+    lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(name: str):
+        started_at = now()
+
+        try:
+            yield
+
+        finally:
+            elapsed_ms = (now() - started_at) * 1000
+
+            with lock:
+                timers.setdefault(name, []).append(elapsed_ms)
+
+    def count(name: str, value: float = 1) -> None:
+        with lock:
+            counters[name] = counters.get(name, 0) + value
+
+    def snapshot() -> dict:
+        with lock:
+            return {
+                'timers': {name: list(values) for name, values in
+                           timers.items()},
+                'counters': dict(counters),
+            }
+
+    return recorder(
+        enabled=True,
+        timer=timer,
+        count=count,
+        snapshot=snapshot,
+    )
+
+
+def start(
+    enabled: bool = METRICS_ENABLED,
+    current: dict = CURRENT,
+) -> recorder:
+    '''Start recording a new invocation'''
+    current['recorder'] = new_recorder() if enabled else NULL_RECORDER
+
+    return current['recorder']
+
+
+def timer(name: str, current: dict = CURRENT):
+    '''Context manager timing a block of code, in milliseconds'''
+    return current['recorder'].timer(name)
+
+
+def count(name: str, value: float = 1, current: dict = CURRENT) -> None:
+    current['recorder'].count(name, value)
+
+
+def timed(name: str, func: Callable, current: dict = CURRENT) -> Callable:
+    '''Wrap a function so that each call is timed
+
+    The recorder is looked up on each call, so functions can be wrapped once
+    (e.g. at import time) and still record into the running invocation.
+    '''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with current['recorder'].timer(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def summarize(snapshot: dict) -> dict:
+    '''Compact version of a snapshot, to attach to handler responses'''
+    return {
+        'timers': {
+            name: {
+                'count': len(values),
+                'total_ms': round(sum(values), 3),
+                'max_ms': round(max(values), 3),
+            }
+            for name, values in snapshot['timers'].items()
+        },
+        'counters': snapshot['counters'],
+    }
+
+
+def emf_record(
+    snapshot: dict,
+    dimensions: Dict[str, str],
+    namespace: str = METRICS_NAMESPACE,
+    timestamp: Optional[int] = None,
+) -> dict:
+    '''CloudWatch Embedded Metric Format document for a snapshot'''
+    values = {
+        **{
+            f'{name}_ms': [
+                round(value, 3)
+                for value in timings[-MAX_VALUES_PER_METRIC:]
+            ]
+            for name, timings in snapshot['timers'].items()
+        },
+        **snapshot['counters'],
+    }
+
+    units = {
+        **{f'{name}_ms': 'Milliseconds' for name in snapshot['timers']},
+        **{name: 'Count' for name in snapshot['counters']},
+    }
+
+    return {
+        '_aws': {
+            'Timestamp': timestamp if timestamp is not None else
+            int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [list(dimensions.keys())],
+                'Metrics': [
+                    {'Name': name, 'Unit': unit}
+                    for name, unit in units.items()
+                ],
+            }],
+        },
+        **dimensions,
+        **values,
+    }
+
+
+def emit(
+    dimensions: Dict[str, str],
+    current: dict = CURRENT,
+    print: Callable = print,
+) -> Optional[dict]:
+    '''Log the invocation metrics as an EMF line and return their summary
+
+    Returns None when metrics are disabled.
+    '''
+    active_recorder = current['recorder']
+
+    if not active_recorder.enabled:
+        return None
+
+    snapshot = active_recorder.snapshot()
+
+    print(json.dumps(emf_record(snapshot, dimensions=dimensions)))
+
+    return summarize(snapshot)
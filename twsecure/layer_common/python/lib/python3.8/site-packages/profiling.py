@@ -0,0 +1,254 @@
+#!/usr/bin/python3 Python3
+'''Opt-in profiling of Lambda handlers, controlled by environment variables
+
+PROFILING_MODES is a comma-separated list of profilers to run on sampled
+invocations:
+
+- "cprofile": deterministic profile, top functions by cumulative time
+- "tracemalloc": peak traced memory and top allocating lines
+- "sampling": wall-clock stack sampling of the handler thread, which also
+  catches time spent waiting on the network
+
+Summaries are logged as a JSON line or, with PROFILING_OUTPUT=tmp, written
+to PROFILING_DIR. When no mode is set, or an unknown one (logged as a
+warning), handlers are left unwrapped.
+'''
+from collections import Counter, namedtuple
+from functools import wraps
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from typing import Callable, List, Optional
+
+
+log = logging.getLogger(os.environ.get('LOGGER_NAME'))
+
+PROFILING_MODES = [
+    mode.strip().lower()
+    for mode in os.environ.get('PROFILING_MODES', '').split(',')
+    if mode.strip()
+]
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 1))
+PROFILING_TOP_N = int(os.environ.get('PROFILING_TOP_N', 15))
+PROFILING_OUTPUT = os.environ.get('PROFILING_OUTPUT', 'log')
+PROFILING_DIR = os.environ.get('PROFILING_DIR', '/tmp/profiles')
+
+# Seconds between two stack samples of the sampling profiler
+PROFILING_SAMPLE_INTERVAL = float(
+    os.environ.get('PROFILING_SAMPLE_INTERVAL', 0.005))
+
+profiler = namedtuple('profiler', 'start stop')
+
+
+def frame_name(code) -> str:
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+def cprofile_profiler(top_n: int = PROFILING_TOP_N) -> profiler:
+    # Profilers are imported on first use, as profiling is usually disabled
+    import cProfile
+    import pstats
+
+    profile = cProfile.Profile()
+
+    def stop() -> dict:
+        profile.disable()
+
+        stats = pstats.Stats(profile).stats
+        top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+
+        return {
+            'cprofile': [
+                {
+                    'function': f'{os.path.basename(filename)}:{line}'
+                                f'({function})',
+                    'calls': calls,
+                    'own_ms': round(own_time * 1000, 3),
+                    'cumulative_ms': round(cumulative_time * 1000, 3),
+                }
+                for (filename, line, function), (_, calls, own_time,
+                                                 cumulative_time, _) in
+                top[:top_n]
+            ],
+        }
+
+    return profiler(start=profile.enable, stop=stop)
+
+
+def tracemalloc_profiler(top_n: int = PROFILING_TOP_N) -> profiler:
+    import tracemalloc
+
+    def start() -> None:
+        tracemalloc.start()
+
+    def stop() -> dict:
+        _, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().statistics('lineno')
+        tracemalloc.stop()
+
+        return {
+            'tracemalloc': {
+                'peak_kb': round(peak / 1024, 1),
+                'top_allocations': [
+                    {
+                        'line': f'{os.path.basename(stat.traceback[0].filename)}'  # NOQA
+                                f':{stat.traceback[0].lineno}',
+                        'size_kb': round(stat.size / 1024, 1),
+                        'count': stat.count,
+                    }
+                    for stat in statistics[:top_n]
+                ],
+            },
+        }
+
+    return profiler(start=start, stop=stop)
+
+
+def sampling_profiler(
+    thread_id: Optional[int] = None,
+    interval: float = PROFILING_SAMPLE_INTERVAL,
+    top_n: int = PROFILING_TOP_N,
+    current_frames: Callable = sys._current_frames,
+) -> profiler:
+    '''Sample the stack of a thread (the caller's by default) periodically
+
+    "self" counts the innermost frame of each sample, "total" every function
+    on the stack, so a slow call shows up under all of its callers.
+    '''
+    if thread_id is None:
+        thread_id = threading.get_ident()
+
+    own_samples = Counter()
+    total_samples = Counter()
+    sample_count = [0]
+    stopped = threading.Event()
+
+    def sample() -> None:
+        frame = current_frames().get(thread_id)
+
+        if frame is None:
+            return
+
+        sample_count[0] += 1
+        own_samples[frame_name(frame.f_code)] += 1
+
+        on_stack = set()
+
+        while frame is not None:
+            on_stack.add(frame_name(frame.f_code))
+            frame = frame.f_back
+
+        total_samples.update(on_stack)
+
+    def run() -> None:
+        while not stopped.wait(interval):
+            sample()
+
+    sampler = threading.Thread(target=run, daemon=True)
+
+    def stop() -> dict:
+        stopped.set()
+        sampler.join()
+
+        return {
+            'sampling': {
+                'interval_ms': interval * 1000,
+                'samples': sample_count[0],
+                'self': dict(own_samples.most_common(top_n)),
+                'total': dict(total_samples.most_common(top_n)),
+            },
+        }
+
+    return profiler(start=sampler.start, stop=stop)
+
+
+PROFILERS = {
+    'cprofile': cprofile_profiler,
+    'tracemalloc': tracemalloc_profiler,
+    'sampling': sampling_profiler,
+}
+
+
+def write_summary(
+    summary: dict,
+    output: str = PROFILING_OUTPUT,
+    directory: str = PROFILING_DIR,
+    print: Callable = print,
+) -> Optional[str]:
+    '''Log a profile summary, or write it to a file and return its path'''
+    if output != 'tmp':
+        print(json.dumps({'message': 'profile', **summary}))
+        return None
+
+    os.makedirs(directory, exist_ok=True)
+
+    path = os.path.join(
+        directory,
+        f'{summary["handler"]}-{int(summary["started_at"] * 1000)}-'
+        f'{summary["request_id"]}.json',
+    )
+
+    with open(path, 'w') as file:
+        json.dump(summary, file)
+
+    print(f'## Profile written to {path}')
+
+    return path
+
+
+def profiled(
+    name: str,
+    modes: List[str] = PROFILING_MODES,
+    sample_rate: float = PROFILING_SAMPLE_RATE,
+    profilers: dict = PROFILERS,
+    write_summary: Callable = write_summary,
+    random: Callable = random.random,
+) -> Callable:
+    '''Decorate a handler to profile a sample of its invocations'''
+    unknown_modes = [mode for mode in modes if mode not in profilers]
+
+    # Decorators run at handler import: a mistyped mode must not fail the
+    # function init
+    if unknown_modes:
+        log.warning(f'## Unknown profiling modes {unknown_modes}: '
+                    f'profiling disabled')
+
+    def decorator(handler: Callable) -> Callable:
+        if not modes or unknown_modes:
+            return handler
+
+        @wraps(handler)
+        def wrapper(event, context):
+            if random() >= sample_rate:
+                return handler(event, context)
+
+            active = [profilers[mode]() for mode in modes]
+            started_at = time.time()
+
+            for active_profiler in active:
+                active_profiler.start()
+
+            try:
+                return handler(event, context)
+
+            finally:
+                summary = {
+                    'handler': name,
+                    'request_id': getattr(context, 'aws_request_id', None),
+                    'started_at': started_at,
+                    'duration_ms': round((time.time() - started_at) * 1000, 3),
+                }
+
+                # Profilers are stopped in the reverse order they were started
+                for active_profiler in reversed(active):
+                    summary.update(active_profiler.stop())
+
+                write_summary(summary)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,14 @@
+from setuptools import setup
+
+setup(
+    name='common-helpers',
+    version='0.1',
+    py_modules=[
+        'aws_clients',
+        'deadline',
+        'details_codec',
+        'metrics',
+        'profiling',
+        'structured_log',
+    ],
+)
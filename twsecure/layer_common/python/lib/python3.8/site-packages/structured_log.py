@@ -0,0 +1,150 @@
+#!/usr/bin/python3 Python3
+'''Sampled, size-bounded JSON log lines for handler payloads
+
+Payloads are only walked when their level is enabled and the invocation is
+sampled. Serialization redacts sensitive keys on the fly and stops as soon
+as the size limit is reached, so a large stream batch costs at most
+LOG_MAX_PAYLOAD_BYTES of encoding work.
+'''
+import json
+import os
+import random
+from typing import Any, Callable, Iterable, Iterator, Tuple
+
+
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# Share of invocations whose event and response payloads are logged
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1))
+LOG_MAX_PAYLOAD_BYTES = int(os.environ.get('LOG_MAX_PAYLOAD_BYTES', 4096))
+
+# Keys holding transaction details (payees, values), message contents or
+# alert recipients (phone numbers, email addresses)
+LOG_REDACTED_KEYS = frozenset(
+    key.strip()
+    for key in os.environ.get(
+        'LOG_REDACTED_KEYS',
+        'details,NewImage,OldImage,payee,payees,value,amount,message,body,'
+        'recipient,recipients,to',
+    ).split(',')
+    if key.strip()
+)
+
+REDACTED = '[REDACTED]'
+
+# Sampling decision of the running invocation
+CURRENT = {'sampled': False}
+
+
+def start(
+    sample_rate: float = LOG_SAMPLE_RATE,
+    current: dict = CURRENT,
+    random: Callable = random.random,
+) -> bool:
+    '''Decide whether payloads are logged for a new invocation'''
+    current['sampled'] = sample_rate >= 1 or random() < sample_rate
+
+    return current['sampled']
+
+
+def is_enabled(level: str, threshold: str = LOG_LEVEL) -> bool:
+    return LEVELS[level] >= LEVELS.get(threshold, LEVELS['INFO'])
+
+
+def iter_json(
+    value: Any,
+    redacted_keys: Iterable[str] = LOG_REDACTED_KEYS,
+) -> Iterator[str]:
+    '''Encode a value as JSON chunks, redacting the values of sensitive keys
+
+    Chunks are ASCII-only, so their length equals their size in bytes.
+    '''
+    if isinstance(value, dict):
+        yield '{'
+
+        for index, (key, item) in enumerate(value.items()):
+            if index > 0:
+                yield ', '
+
+            yield json.dumps(str(key)) + ': '
+
+            if key in redacted_keys:
+                yield json.dumps(REDACTED)
+            else:
+                yield from iter_json(item, redacted_keys=redacted_keys)
+
+        yield '}'
+
+    elif isinstance(value, (list, tuple)):
+        yield '['
+
+        for index, item in enumerate(value):
+            if index > 0:
+                yield ', '
+
+            yield from iter_json(item, redacted_keys=redacted_keys)
+
+        yield ']'
+
+    else:
+        yield json.dumps(value, default=str)
+
+
+def serialize(
+    value: Any,
+    max_bytes: int = LOG_MAX_PAYLOAD_BYTES,
+    redacted_keys: Iterable[str] = LOG_REDACTED_KEYS,
+) -> Tuple[str, bool]:
+    '''Redacted JSON of a value, cut at max_bytes: (text, truncated)'''
+    chunks = []
+    size = 0
+
+    for chunk in iter_json(value, redacted_keys=redacted_keys):
+        if size + len(chunk) > max_bytes:
+            chunks.append(chunk[:max_bytes - size])
+            return ''.join(chunks), True
+
+        chunks.append(chunk)
+        size += len(chunk)
+
+    return ''.join(chunks), False
+
+
+def log_payload(
+    message: str,
+    payload: Any,
+    level: str = 'INFO',
+    threshold: str = LOG_LEVEL,
+    current: dict = CURRENT,
+    max_bytes: int = LOG_MAX_PAYLOAD_BYTES,
+    redacted_keys: Iterable[str] = LOG_REDACTED_KEYS,
+    print: Callable = print,
+) -> bool:
+    '''Log a payload as a single JSON line, if enabled and sampled
+
+    "payload" may be a callable, only invoked when the line is logged.
+    Returns whether anything was logged.
+    '''
+    if not is_enabled(level, threshold=threshold) or not current['sampled']:
+        return False
+
+    if callable(payload):
+        payload = payload()
+
+    text, truncated = serialize(
+        payload,
+        max_bytes=max_bytes,
+        redacted_keys=redacted_keys,
+    )
+
+    header = json.dumps({'level': level, 'message': message})[:-1]
+
+    if truncated:
+        # Cut JSON is no longer valid, so it is logged as a string
+        print(f'{header}, "truncated": true, "payload": {json.dumps(text)}}}')
+    else:
+        print(f'{header}, "payload": {text}}}')
+
+    return True
@@ -0,0 +1,76 @@
+#!/usr/bin/python3 Python3
+import os
+import subprocess
+import sys
+from unittest import mock
+
+from aws_clients import client_config, get_client, prewarm
+
+
+def test_client_config():
+    config = client_config(
+        connect_timeout=1,
+        read_timeout=2,
+        max_attempts=4,
+        retry_mode='standard',
+        max_pool_connections=20,
+        tcp_keepalive=True,
+    )
+
+    assert config.connect_timeout == 1
+    assert config.read_timeout == 2
+    assert config.retries == {'max_attempts': 4, 'mode': 'standard'}
+    assert config.max_pool_connections == 20
+    assert config.tcp_keepalive is True
+
+
+def test_get_client():
+    clients = {}
+    new_client = mock.Mock(side_effect=lambda service_name, region_name: (
+        service_name, region_name, object()))
+
+    with mock.patch.dict(os.environ, {'AWS_REGION': 'eu-west-1'}):
+        dynamodb = get_client('dynamodb', clients=clients,
+                              new_client=new_client)
+
+        assert get_client('dynamodb', clients=clients,
+                          new_client=new_client) is dynamodb
+        assert new_client.call_count == 1
+        new_client.assert_called_with('dynamodb', region_name='eu-west-1')
+
+        # One client per service and region
+        assert get_client('ses', clients=clients,
+                          new_client=new_client) is not dynamodb
+        assert get_client('dynamodb', region_name='us-east-1',
+                          clients=clients,
+                          new_client=new_client) is not dynamodb
+
+    assert set(clients) == {
+        ('dynamodb', 'eu-west-1'),
+        ('ses', 'eu-west-1'),
+        ('dynamodb', 'us-east-1'),
+    }
+
+
+def test_prewarm():
+    get_client_mock = mock.Mock(side_effect=['client', Exception('Boom')])
+
+    assert prewarm(['dynamodb', 'secretsmanager'],
+                   get_client=get_client_mock) == ['client']
+    assert prewarm([], get_client=get_client_mock) == []
+    assert get_client_mock.call_count == 2
+
+
+def test_no_boto3_import_without_prewarm():
+    code = (
+        'import sys, aws_clients; '
+        'aws_clients.prewarm(); '
+        'sys.exit(int("boto3" in sys.modules))'
+    )
+
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)}
+    env.pop('AWS_CLIENTS_PREWARM', None)
+
+    result = subprocess.run([sys.executable, '-c', code], env=env)
+
+    assert result.returncode == 0
@@ -0,0 +1,51 @@
+#!/usr/bin/python3 Python3
+import math
+from types import SimpleNamespace
+
+from deadline import call_timeout, expired, remaining, start
+
+
+def lambda_context(remaining_ms):
+    return SimpleNamespace(get_remaining_time_in_millis=lambda: remaining_ms)
+
+
+def test_start():
+    current = {}
+
+    available = start(
+        lambda_context(30000),
+        safety_margin=2,
+        current=current,
+        now=lambda: 100,
+    )
+
+    assert available == 28
+    assert current['deadline'] == 128
+
+    # No deadline without a Lambda context
+    assert start(None, current=current) == math.inf
+    assert current['deadline'] == math.inf
+
+
+def test_remaining_expired():
+    current = {'deadline': 110}
+
+    assert remaining(current=current, now=lambda: 100) == 10
+    assert expired(current=current, now=lambda: 100) is False
+    assert expired(reserve=10, current=current, now=lambda: 100) is True
+    assert expired(current=current, now=lambda: 111) is True
+
+
+def test_call_timeout():
+    current = {'deadline': 110}
+
+    assert call_timeout(5, current=current, now=lambda: 100) == 5
+    assert call_timeout(5, current=current, now=lambda: 107) == 3
+
+    # A call always gets a minimal timeout, even past the deadline
+    assert call_timeout(5, min_timeout=0.5, current=current,
+                        now=lambda: 120) == 0.5
+
+    assert call_timeout(5, current={'deadline': math.inf}) == 5
+    assert call_timeout(0.1, min_timeout=0.5,
+                        current={'deadline': math.inf}) == 0.1
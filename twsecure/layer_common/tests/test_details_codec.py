@@ -0,0 +1,106 @@
+#!/usr/bin/python3 Python3
+import base64
+import json
+
+import pytest
+
+from details_codec import (
+    BINARY_VERSION,
+    decode_binary,
+    decode_details,
+    encode_binary,
+    encode_details,
+    read_varint,
+    write_varint,
+)
+
+
+DETAILS = {
+    'account': 'John Doe',
+    'currency': 'EUR',
+    'value': '12.34',
+    'payee': 'Café Zürich',
+}
+
+
+@pytest.mark.parametrize('value', [0, 1, 127, 128, 300, 2 ** 21])
+def test_varint(value):
+    encoded = write_varint(value)
+
+    assert read_varint(encoded + b'tail', 0) == (value, len(encoded))
+
+
+def test_encode_details_json():
+    attribute = encode_details(DETAILS, encoding='json')
+
+    assert attribute == {'S': json.dumps(DETAILS)}
+    assert decode_details(attribute) == DETAILS
+
+
+def test_encode_details_binary():
+    attribute = encode_details(DETAILS, encoding='binary')
+    data = attribute['B']
+
+    assert data[0] == BINARY_VERSION
+    assert data[1] == 0  # Below the compression threshold
+    assert len(data) < len(json.dumps(DETAILS))
+    assert decode_details(attribute) == DETAILS
+
+
+def test_encode_details_unknown():
+    with pytest.raises(ValueError):
+        encode_details(DETAILS, encoding='xml')
+
+    with pytest.raises(ValueError):
+        encode_binary(DETAILS, compression='lzma')
+
+    with pytest.raises(TypeError):
+        encode_binary({'value': 12.34})
+
+
+def test_encode_binary_compression():
+    details = {**DETAILS, 'description': 'Card payment ' * 50}
+
+    data = encode_binary(details, compression='zlib', threshold=256)
+
+    assert data[1] == 1
+    assert len(data) < len(encode_binary(details, compression='none'))
+    assert decode_binary(data) == details
+
+    # Payloads below the threshold are left uncompressed
+    assert encode_binary(details, compression='zlib', threshold=10 ** 6)[1] \
+        == 0
+
+
+def test_encode_binary_compression_not_smaller():
+    '''Compressed bodies are only kept when they are smaller'''
+    data = encode_binary(
+        DETAILS,
+        compression='zlib',
+        threshold=0,
+        codecs={1: lambda: (lambda body: body * 2, None)},
+    )
+
+    assert data[1] == 0
+    assert decode_binary(data) == DETAILS
+
+
+def test_decode_details_stream_event():
+    '''Binary attributes are base64 text in stream events'''
+    data = encode_binary(DETAILS)
+
+    assert decode_details({'B': base64.b64encode(data).decode()}) == DETAILS
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    bytes((BINARY_VERSION + 1, 0)),
+    bytes((BINARY_VERSION, 9)),
+    bytes((BINARY_VERSION, 1)) + b'not zlib',
+    bytes((BINARY_VERSION, 0, 5)) + b'abc',
+    bytes((BINARY_VERSION, 0, 0x80)),
+    bytes((BINARY_VERSION, 0, 1)) + b'a',
+])
+def test_decode_binary_invalid(data):
+    with pytest.raises(ValueError):
+        decode_binary(data)
@@ -0,0 +1,151 @@
+#!/usr/bin/python3 Python3
+import json
+from unittest import mock
+
+import pytest
+
+import metrics
+from metrics import (
+    emf_record,
+    emit,
+    new_recorder,
+    NULL_RECORDER,
+    start,
+    summarize,
+    timed,
+    timer,
+)
+
+
+@pytest.fixture
+def current():
+    return {'recorder': NULL_RECORDER}
+
+
+def test_new_recorder():
+    now = mock.Mock(side_effect=[1.0, 1.25, 2.0, 2.5])
+    recorder = new_recorder(now=now)
+
+    with recorder.timer('get_statement'):
+        pass
+
+    with pytest.raises(ValueError):
+        with recorder.timer('get_statement'):
+            raise ValueError()
+
+    recorder.count('transactions')
+    recorder.count('transactions', 4)
+
+    assert recorder.snapshot() == {
+        'timers': {'get_statement': [250.0, 500.0]},
+        'counters': {'transactions': 5},
+    }
+
+
+def test_start(current):
+    assert start(enabled=False, current=current) is NULL_RECORDER
+
+    recorder = start(enabled=True, current=current)
+
+    assert recorder.enabled is True
+    assert current['recorder'] is recorder
+
+    # Each invocation starts from scratch
+    metrics.count('dummy', current=current)
+    start(enabled=True, current=current)
+
+    assert current['recorder'].snapshot()['counters'] == {}
+
+
+def test_module_helpers(current):
+    # Disabled: everything is a no-op
+    with timer('dummy', current=current):
+        pass
+
+    metrics.count('dummy', current=current)
+
+    wrapped = timed('wrapped', lambda x: x * 2, current=current)
+
+    assert wrapped(2) == 4
+    assert current['recorder'].snapshot() == {'timers': {}, 'counters': {}}
+
+    # Functions wrapped before the invocation starts record into it
+    start(enabled=True, current=current)
+
+    assert wrapped(3) == 6
+
+    with timer('block', current=current):
+        pass
+
+    metrics.count('dummy', 2, current=current)
+
+    snapshot = current['recorder'].snapshot()
+
+    assert list(snapshot['timers'].keys()) == ['wrapped', 'block']
+    assert snapshot['counters'] == {'dummy': 2}
+
+
+def test_summarize():
+    snapshot = {
+        'timers': {'get_statement': [1.5, 3.25, 2.0]},
+        'counters': {'transactions': 3},
+    }
+
+    assert summarize(snapshot) == {
+        'timers': {
+            'get_statement': {'count': 3, 'total_ms': 6.75, 'max_ms': 3.25},
+        },
+        'counters': {'transactions': 3},
+    }
+
+
+def test_emf_record():
+    snapshot = {
+        'timers': {'get_statement': [1.5, 3.25]},
+        'counters': {'transactions': 3},
+    }
+
+    record = emf_record(
+        snapshot,
+        dimensions={'Service': 'monitor'},
+        namespace='Dummy',
+        timestamp=1234,
+    )
+
+    assert record == {
+        '_aws': {
+            'Timestamp': 1234,
+            'CloudWatchMetrics': [{
+                'Namespace': 'Dummy',
+                'Dimensions': [['Service']],
+                'Metrics': [
+                    {'Name': 'get_statement_ms', 'Unit': 'Milliseconds'},
+                    {'Name': 'transactions', 'Unit': 'Count'},
+                ],
+            }],
+        },
+        'Service': 'monitor',
+        'get_statement_ms': [1.5, 3.25],
+        'transactions': 3,
+    }
+
+
+def test_emit(current):
+    print_mock = mock.Mock()
+
+    assert emit({'Service': 'monitor'}, current=current,
+                print=print_mock) is None
+    print_mock.assert_not_called()
+
+    start(enabled=True, current=current)
+    metrics.count('transactions', current=current)
+
+    summary = emit({'Service': 'monitor'}, current=current, print=print_mock)
+
+    assert summary == {'timers': {}, 'counters': {'transactions': 1}}
+
+    line = json.loads(print_mock.call_args[0][0])
+
+    assert line['Service'] == 'monitor'
+    assert line['transactions'] == 1
+    assert '_aws' in line
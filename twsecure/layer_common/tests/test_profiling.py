@@ -0,0 +1,140 @@
+#!/usr/bin/python3 Python3
+import json
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from profiling import (
+    cprofile_profiler,
+    profiled,
+    sampling_profiler,
+    tracemalloc_profiler,
+    write_summary,
+)
+
+
+def busy_function():
+    return sum(i * i for i in range(20000))
+
+
+def test_cprofile_profiler():
+    profiler = cprofile_profiler(top_n=5)
+
+    profiler.start()
+    busy_function()
+    summary = profiler.stop()
+
+    assert len(summary['cprofile']) <= 5
+    assert any('busy_function' in entry['function']
+               for entry in summary['cprofile'])
+
+
+def test_tracemalloc_profiler():
+    profiler = tracemalloc_profiler(top_n=3)
+
+    profiler.start()
+    allocated = [bytearray(1024) for _ in range(100)]
+    summary = profiler.stop()
+
+    assert len(allocated) == 100
+    assert summary['tracemalloc']['peak_kb'] >= 100
+    assert 0 < len(summary['tracemalloc']['top_allocations']) <= 3
+
+
+def test_sampling_profiler():
+    profiler = sampling_profiler(
+        thread_id=threading.get_ident(),
+        interval=0.001,
+        top_n=100,
+    )
+
+    profiler.start()
+    time.sleep(0.05)
+    summary = profiler.stop()['sampling']
+
+    assert summary['samples'] > 0
+    assert 'test_profiling.py:test_sampling_profiler' in summary['total']
+
+
+def test_write_summary(tmp_path):
+    summary = {'handler': 'monitor', 'request_id': 'abc', 'started_at': 1.5}
+    print_mock = mock.Mock()
+
+    assert write_summary(summary, output='log', print=print_mock) is None
+    assert json.loads(print_mock.call_args[0][0]) == \
+        {'message': 'profile', **summary}
+
+    path = write_summary(summary, output='tmp', directory=str(tmp_path),
+                         print=print_mock)
+
+    assert path == str(tmp_path / 'monitor-1500-abc.json')
+    with open(path) as file:
+        assert json.load(file) == summary
+
+
+def test_profiled():
+    handler = mock.Mock(return_value={'statusCode': 200})
+    handler.__name__ = 'handler'
+
+    assert profiled('monitor', modes=[])(handler) is handler
+
+    profiler = mock.Mock()
+    profiler.stop.return_value = {'fake': 'summary'}
+    write_summary_mock = mock.Mock()
+    context = mock.Mock(aws_request_id='abc')
+
+    wrapped = profiled(
+        'monitor',
+        modes=['fake'],
+        sample_rate=0.5,
+        profilers={'fake': lambda: profiler},
+        write_summary=write_summary_mock,
+        random=mock.Mock(side_effect=[0.9, 0.1]),
+    )(handler)
+
+    # Not sampled
+    assert wrapped({}, context) == {'statusCode': 200}
+    profiler.start.assert_not_called()
+
+    # Sampled
+    assert wrapped({}, context) == {'statusCode': 200}
+    profiler.start.assert_called_once()
+    profiler.stop.assert_called_once()
+
+    summary = write_summary_mock.call_args[0][0]
+    assert summary['handler'] == 'monitor'
+    assert summary['request_id'] == 'abc'
+    assert summary['fake'] == 'summary'
+
+
+def test_profiled_invalid_mode(caplog):
+    '''An unknown mode disables profiling instead of failing at import'''
+    handler = mock.Mock(return_value={'statusCode': 200})
+    handler.__name__ = 'handler'
+
+    wrapped = profiled('monitor', modes=['cprofile', 'cprofiler'])(handler)
+
+    assert wrapped is handler
+    assert "['cprofiler']" in caplog.text
+
+
+def test_profiled_handler_error():
+    '''Summaries are written even when the handler raises'''
+    handler = mock.Mock(side_effect=RuntimeError())
+    handler.__name__ = 'handler'
+    write_summary_mock = mock.Mock()
+
+    wrapped = profiled(
+        'notifier',
+        modes=['cprofile'],
+        write_summary=write_summary_mock,
+        random=lambda: 0,
+    )(handler)
+
+    with pytest.raises(RuntimeError):
+        wrapped({}, None)
+
+    write_summary_mock.assert_called_once()
+    assert write_summary_mock.call_args[0][0]['request_id'] is None
@@ -0,0 +1,135 @@
+#!/usr/bin/python3 Python3
+import json
+from unittest import mock
+
+from structured_log import (
+    is_enabled,
+    log_payload,
+    REDACTED,
+    serialize,
+    start,
+)
+
+
+EVENT = {
+    'Records': [{
+        'eventName': 'INSERT',
+        'dynamodb': {
+            'SequenceNumber': '111',
+            'NewImage': {'details': {'S': '{"payee": "Jane Doe"}'}},
+        },
+    }],
+}
+
+
+def test_start():
+    current = {'sampled': False}
+
+    assert start(sample_rate=1, current=current) is True
+    assert current['sampled'] is True
+
+    assert start(sample_rate=0.1, current=current, random=lambda: 0.5) is \
+        False
+    assert current['sampled'] is False
+
+    assert start(sample_rate=0.1, current=current, random=lambda: 0.05) is \
+        True
+
+
+def test_is_enabled():
+    assert is_enabled('INFO', threshold='INFO') is True
+    assert is_enabled('ERROR', threshold='INFO') is True
+    assert is_enabled('DEBUG', threshold='INFO') is False
+    assert is_enabled('INFO', threshold='WARNING') is False
+
+
+def test_serialize():
+    text, truncated = serialize(EVENT, max_bytes=4096)
+
+    assert truncated is False
+    assert json.loads(text) == {
+        'Records': [{
+            'eventName': 'INSERT',
+            'dynamodb': {'SequenceNumber': '111', 'NewImage': REDACTED},
+        }],
+    }
+    assert 'Jane Doe' not in text
+
+    text, truncated = serialize(EVENT, max_bytes=20)
+
+    assert truncated is True
+    assert len(text) == 20
+    assert text == json.dumps(
+        {'Records': [{'eventName': 'INSERT'}]},
+    )[:20]
+
+
+def test_serialize_stops_early():
+    '''Encoding stops once the size limit is reached'''
+    encoded = []
+
+    class Value():
+        def __str__(self):
+            encoded.append(self)
+            return 'value'
+
+    serialize([Value() for _ in range(1000)], max_bytes=50)
+
+    assert len(encoded) < 10
+
+
+def test_log_payload():
+    print_mock = mock.Mock()
+    current = {'sampled': True}
+
+    logged = log_payload('event', EVENT, current=current, print=print_mock)
+
+    assert logged is True
+    line = json.loads(print_mock.call_args[0][0])
+    assert line['level'] == 'INFO'
+    assert line['message'] == 'event'
+    assert line['payload']['Records'][0]['dynamodb']['NewImage'] == REDACTED
+
+    log_payload('event', EVENT, current=current, max_bytes=20,
+                print=print_mock)
+
+    line = json.loads(print_mock.call_args[0][0])
+    assert line['truncated'] is True
+    assert isinstance(line['payload'], str)
+
+
+def test_log_payload_dispatch_result():
+    '''Alert recipients logged with the notifier response are redacted'''
+    print_mock = mock.Mock()
+    response = {'Dispatch': [{
+        'channel': 'sms',
+        'recipient': '+15550001111',
+        'status': 'SENT',
+        'response': {'sid': 'SM123', 'to': '+15550001111'},
+        'error': None,
+    }]}
+
+    log_payload('response', response, current={'sampled': True},
+                print=print_mock)
+
+    line = print_mock.call_args[0][0]
+    assert '+15550001111' not in line
+
+    result = json.loads(line)['payload']['Dispatch'][0]
+    assert result['recipient'] == REDACTED
+    assert result['response']['to'] == REDACTED
+    assert result['status'] == 'SENT'
+
+
+def test_log_payload_disabled():
+    '''Nothing is built nor serialized when the line is not logged'''
+    print_mock = mock.Mock()
+    payload = mock.Mock()
+
+    assert log_payload('event', payload, threshold='WARNING',
+                       current={'sampled': True}, print=print_mock) is False
+    assert log_payload('event', payload, current={'sampled': False},
+                       print=print_mock) is False
+
+    payload.assert_not_called()
+    print_mock.assert_not_called()
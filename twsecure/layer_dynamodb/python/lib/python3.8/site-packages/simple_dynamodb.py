@@ -4,15 +4,19 @@ from collections import namedtuple
 from datetime import datetime, timedelta
 import json
 import logging
+import math
 import os
 import queue
-from typing import Callable, List, Tuple, NamedTuple
-
-import boto3
-import botocore
+import time
+from typing import Callable, List, Tuple, NamedTuple, TYPE_CHECKING
 
 from retry_queue import RetryLimitQueue
 
+# boto3 is imported on first use, outside of the import-time path
+if TYPE_CHECKING:
+    import boto3  # NOQA
+    import botocore  # NOQA
+
 
 log = logging.getLogger(os.environ.get('LOGGER_NAME'))
 
@@ -28,9 +32,14 @@ BATCH_GET_MAX_SIZE = int(os.environ.get('DYNAMODB_BATCH_GET_MAX_SIZE', 100))
 BATCH_GET_MAX_RETRIES = int(os.environ.get('DYNAMODB_BATCH_GET_MAX_RETRIES', 3))  # NOQA
 BATCH_WRITE_MAX_SIZE = int(os.environ.get('DYNAMODB_BATCH_WRITE_MAX_SIZE', 25))
 BATCH_WRITE_MAX_RETRIES = int(os.environ.get('DYNAMODB_BATCH_WRITE_MAX_RETRIES', 3))  # NOQA
+# First wait before retrying unprocessed items, doubled on every retry
+BATCH_WRITE_BACKOFF = float(os.environ.get('DYNAMODB_BATCH_WRITE_BACKOFF_SECONDS', 0.1))  # NOQA
 
 # Namedtuples for block structure responses
 table_operations = namedtuple('operations', 'batch_get batch_put')
+# Items still unprocessed once the retries are exhausted were not written
+batch_put_result = namedtuple(
+    'batch_put_result', 'responses unprocessed_items')
 manager = namedtuple('batch_manager', [
     # Attributes
     'queue',
@@ -57,11 +66,14 @@ def boto3_local_client(
         aws_secret_access_key: str = 'LOCAL_SECRET_ACCESS_KEY',
         connect_timeout: int = CONNECTION_TIMEOUT,
         read_timeout: int = READ_TIMEOUT,
-        ) -> botocore.client.BaseClient:
+        ) -> 'botocore.client.BaseClient':
+    import boto3
+
     return boto3.client('dynamodb', **client_kwargs)
 
 
 def local_env_client_args(client_kwargs):
+    import botocore.client
     import yaml
 
     with open('dynamodb-local.yaml', 'r') as file:
@@ -79,12 +91,25 @@ def local_env_client_args(client_kwargs):
     }
 
 
+def time_remaining() -> float:
+    '''Seconds left in the invocation, from the common layer when attached'''
+    try:
+        import deadline
+
+    except ImportError:
+        return math.inf
+
+    return deadline.remaining()
+
+
 def get_table_operations(
         table_name: str,
-        client: botocore.client.BaseClient = None,
+        client: 'botocore.client.BaseClient' = None,
         ) -> Tuple[Callable]:
     if client is None:
-        client = boto3.client('dynamodb')
+        # Container-wide client, from the common layer
+        import aws_clients
+        client = aws_clients.get_client('dynamodb')
 
     put_manager = batch_put_manager
 
@@ -106,22 +131,59 @@ def get_table_operations(
             max_queue_size: int = 0,  # 0 (zero) leads to infinite-sized queue
             client: 'boto3.client' = client,
             ddb_batch_put_size: int = BATCH_WRITE_MAX_SIZE,
-            ) -> dict:
+            max_retries: int = BATCH_WRITE_MAX_RETRIES,
+            backoff: float = BATCH_WRITE_BACKOFF,
+            sleep: Callable = time.sleep,
+            remaining: Callable = time_remaining,
+            ) -> batch_put_result:
+        '''Write items in batches, retrying unprocessed ones with backoff
+
+        Retries stop short of the invocation deadline, leaving the time to
+        handle the items still unprocessed (e.g. backlog them).
+        '''
         responses = []
+        unprocessed_items = []
 
         batches = split_batch_items(items, ddb_batch_put_size)
 
         for batch_items in batches:
-            responses.append(client.batch_write_item(
-                RequestItems={
-                    table_name: [
-                        {'PutRequest': {'Item': item}}
-                        for item in batch_items
-                    ],
-                },
-            ))
-
-        return responses
+            requests = [
+                {'PutRequest': {'Item': item}}
+                for item in batch_items
+            ]
+
+            for attempt in range(max_retries + 1):
+                if attempt > 0:
+                    delay = backoff * 2 ** (attempt - 1)
+
+                    if delay >= remaining():
+                        log.warning('## Deadline near: no more retries of '
+                                    'unprocessed items')
+                        break
+
+                    sleep(delay)
+
+                response = client.batch_write_item(
+                    RequestItems={table_name: requests},
+                )
+                responses.append(response)
+
+                # Throttled writes are returned instead of raising an error
+                requests = response.get(
+                    'UnprocessedItems', {}).get(table_name, [])
+
+                if not requests:
+                    break
+
+            if requests:
+                log.error(f'## {len(requests)} items left unprocessed')
+                unprocessed_items.extend(
+                    request['PutRequest']['Item'] for request in requests)
+
+        return batch_put_result(
+            responses=responses,
+            unprocessed_items=unprocessed_items,
+        )
 
     def split_batch_items(items, batch_size):
         for i in range(0, len(items), batch_size):
@@ -0,0 +1,79 @@
+#!/usr/bin/python3 Python3
+from unittest import mock
+
+import simple_dynamodb as simple_ddb
+
+
+def put_requests(*items):
+    return [{'PutRequest': {'Item': item}} for item in items]
+
+
+def test_batch_put_retries_unprocessed_items():
+    client = mock.Mock()
+    client.batch_write_item.side_effect = [
+        {'UnprocessedItems': {'table': put_requests({'id': 2})}},
+        {'UnprocessedItems': {}},
+    ]
+    sleep = mock.Mock()
+
+    ddb_api = simple_ddb.get_table_operations('table', client=client)
+    result = ddb_api.batch_put(
+        items=[{'id': 1}, {'id': 2}], backoff=0.1, sleep=sleep)
+
+    assert result.unprocessed_items == []
+    assert len(result.responses) == 2
+    assert client.batch_write_item.call_args_list[1] == mock.call(
+        RequestItems={'table': put_requests({'id': 2})})
+    sleep.assert_called_once_with(0.1)
+
+
+def test_batch_put_returns_items_left_unprocessed():
+    client = mock.Mock()
+    client.batch_write_item.return_value = {
+        'UnprocessedItems': {'table': put_requests({'id': 2})},
+    }
+    sleep = mock.Mock()
+
+    ddb_api = simple_ddb.get_table_operations('table', client=client)
+    result = ddb_api.batch_put(
+        items=[{'id': 1}, {'id': 2}], max_retries=3, backoff=0.1, sleep=sleep)
+
+    assert result.unprocessed_items == [{'id': 2}]
+    assert client.batch_write_item.call_count == 4
+
+    # Exponential backoff between the retries
+    assert [c[0][0] for c in sleep.call_args_list] == [0.1, 0.2, 0.4]
+
+
+def test_batch_put_stops_retrying_at_the_deadline():
+    '''No backoff is slept past the invocation deadline'''
+    client = mock.Mock()
+    client.batch_write_item.return_value = {
+        'UnprocessedItems': {'table': put_requests({'id': 2})},
+    }
+    sleep = mock.Mock()
+
+    ddb_api = simple_ddb.get_table_operations('table', client=client)
+    result = ddb_api.batch_put(
+        items=[{'id': 1}, {'id': 2}],
+        max_retries=3,
+        backoff=0.1,
+        sleep=sleep,
+        remaining=mock.Mock(side_effect=[1, 0.15]),
+    )
+
+    # The second backoff (0.2 seconds) would pass the deadline
+    assert result.unprocessed_items == [{'id': 2}]
+    assert client.batch_write_item.call_count == 2
+    sleep.assert_called_once_with(0.1)
+
+
+def test_time_remaining():
+    with mock.patch.dict('sys.modules', {'deadline': None}):
+        assert simple_ddb.time_remaining() == float('inf')
+
+    deadline = mock.Mock()
+    deadline.remaining.return_value = 12
+
+    with mock.patch.dict('sys.modules', {'deadline': deadline}):
+        assert simple_ddb.time_remaining() == 12
@@ -1,10 +1,15 @@
 #!/usr/bin/python3 Python3
+from collections import namedtuple
 import json
 import logging
 import os
-from typing import Tuple
+import re
+from typing import (
+    Callable, Dict, Iterable, Optional, Tuple, TYPE_CHECKING, Union,
+)
 
-import boto3
+if TYPE_CHECKING:
+    import botocore  # NOQA
 
 
 log = logging.getLogger(os.environ.get('LOGGER_NAME', 'SECRET_LOGGER'))
@@ -19,39 +24,204 @@ SECRET_ARN = os.environ.get('SECRET_ARN')
 # unnecessary calls to the SecretsManager API across different Lambda requests
 SECRET_VALUE_ENV_VAR = 'TRANSIENT_SECRET_VALUE'
 
+# Secret provider selection: "aws" (SecretsManager), "file" or "env"
+SECRET_PROVIDER = os.environ.get('SECRET_PROVIDER', 'aws')
+SECRET_FILE_PATH = os.environ.get('SECRET_FILE_PATH', 'local-secrets.json')
+SECRET_ENV_PREFIX = os.environ.get('SECRET_ENV_PREFIX', 'SECRET_VALUE_')
+
+# SecretsManager BatchGetSecretValue accepts up to 20 secret ids per request
+AWS_SECRETS_BATCH_MAX_SIZE = 20
+
+secret_provider = namedtuple('secret_provider', 'name get_secret_values')
+
 
 class GetSecretValueFailureException(Exception):
     pass
 
 
+class UnknownSecretProviderException(Exception):
+    pass
+
+
+def secretsmanager_client() -> 'botocore.client.BaseClient':
+    '''Container-wide client from the common layer, when it is attached
+
+    The layer does not require the common layer: without it, a client of
+    its own is created.
+    '''
+    try:
+        import aws_clients
+
+    except ImportError:
+        import boto3
+        return boto3.client('secretsmanager')
+
+    return aws_clients.get_client('secretsmanager')
+
+
+def aws_provider(
+        client: Optional['botocore.client.BaseClient'] = None,
+        batch_size: int = AWS_SECRETS_BATCH_MAX_SIZE,
+        ) -> secret_provider:
+    '''Provider backed by AWS SecretsManager (boto3 is imported on first use)
+
+    A single secret is retrieved with GetSecretValue; multiple secrets are
+    retrieved with as few BatchGetSecretValue requests as possible.
+    '''
+    def get_secret_values(secret_ids: Iterable[str]) -> Dict[str, str]:
+        nonlocal client
+
+        if client is None:
+            client = secretsmanager_client()
+
+        secret_ids = list(dict.fromkeys(secret_ids))
+        values = {}
+
+        for i in range(0, len(secret_ids), batch_size):
+            batch = secret_ids[i:i + batch_size]
+
+            if len(batch) == 1:
+                r = client.get_secret_value(SecretId=batch[0])
+                values[batch[0]] = r['SecretString']
+                continue
+
+            r = client.batch_get_secret_value(SecretIdList=batch)
+
+            if r.get('Errors'):
+                raise GetSecretValueFailureException(
+                    'Failed to retrieve secrets: ' +
+                    ', '.join(e['SecretId'] for e in r['Errors'])
+                )
+
+            for secret in r['SecretValues']:
+                # Secrets may be requested either by ARN or by name
+                for secret_id in (secret['ARN'], secret['Name']):
+                    if secret_id in batch:
+                        values[secret_id] = secret['SecretString']
+
+        return values
+
+    return secret_provider(name='aws', get_secret_values=get_secret_values)
+
+
+def file_provider(path: str = SECRET_FILE_PATH) -> secret_provider:
+    '''Provider reading secrets from a local JSON file mapping ids to values
+
+    Values may be strings or JSON objects (serialized back to a string, the
+    same way SecretsManager returns them).
+    '''
+    def get_secret_values(secret_ids: Iterable[str]) -> Dict[str, str]:
+        with open(path, 'r') as file:
+            secrets = json.loads(file.read())
+
+        return {
+            secret_id: secret_string(secrets[secret_id])
+            for secret_id in secret_ids
+        }
+
+    return secret_provider(name='file', get_secret_values=get_secret_values)
+
+
+def env_provider(prefix: str = SECRET_ENV_PREFIX) -> secret_provider:
+    '''Provider reading secrets from environment variables
+
+    A secret id such as "arn:aws:secretsmanager:...:secret:twilio" is read
+    from the variable "<prefix>ARN_AWS_SECRETSMANAGER_..._SECRET_TWILIO".
+    '''
+    def get_secret_values(secret_ids: Iterable[str]) -> Dict[str, str]:
+        return {
+            secret_id: os.environ[env_var_name(secret_id, prefix=prefix)]
+            for secret_id in secret_ids
+        }
+
+    return secret_provider(name='env', get_secret_values=get_secret_values)
+
+
+SECRET_PROVIDERS = {
+    'aws': aws_provider,
+    'file': file_provider,
+    'env': env_provider,
+}
+
+
+def get_provider(
+        name: str = SECRET_PROVIDER,
+        providers: Dict[str, Callable] = SECRET_PROVIDERS,
+        **kwargs,
+        ) -> secret_provider:
+    '''Instantiate a secret provider by its configured name'''
+    try:
+        factory = providers[name]
+    except KeyError as e:
+        raise UnknownSecretProviderException(
+            f'Unknown secret provider "{name}", options are: '
+            f'{", ".join(providers.keys())}'
+        ) from e
+
+    return factory(**kwargs)
+
+
+def env_var_name(secret_id: str, prefix: str = SECRET_ENV_PREFIX) -> str:
+    return prefix + re.sub(r'[^A-Z0-9]', '_', secret_id.upper())
+
+
+def secret_string(value: Union[str, dict, list]) -> str:
+    return value if type(value) is str else json.dumps(value)
+
+
+def get_secret_values(
+        secret_ids: Iterable[str],
+        provider: Optional[secret_provider] = None,
+        ) -> Dict[str, str]:
+    '''Retrieve raw secret strings for all ids in as few calls as possible'''
+    if provider is None:
+        provider = get_provider()
+
+    try:
+        return provider.get_secret_values(secret_ids)
+    except KeyError as e:
+        raise GetSecretValueFailureException(
+            f'Secret not found by the "{provider.name}" provider: {e}'
+        ) from e
+
+
+def get_secret(
+        secret_id: str,
+        load_json: bool = True,
+        provider: Optional[secret_provider] = None,
+        ) -> Union[str, dict, list]:
+    '''Retrieve a single secret value, optionally parsing it as JSON'''
+    value = get_secret_values([secret_id], provider=provider)[secret_id]
+    return json.loads(value) if load_json else value
+
+
 def get_secrets(
         secret_arn: str = SECRET_ARN,
-        client: 'boto3.client' = None,
+        client: Optional['botocore.client.BaseClient'] = None,
+        provider: Optional[secret_provider] = None,
         ) -> dict:
-    '''Retrive a secret value from AWS SecretsManager'''
+    '''Retrive a secret value from the configured provider'''
     try:
-        if client is None:
-            client = boto3.client(service_name='secretsmanager')
-
-        # Only fallback to SecretsManager if the secret is not available from
+        # Only fallback to the provider if the secret is not available from
         # previous Lambda requests
         if SECRET_VALUE_ENV_VAR not in os.environ.keys():
             log.info('## Secret value not available in env vars\n')
 
-            r = client.get_secret_value(SecretId=secret_arn)
+            if provider is None:
+                provider = \
+                    aws_provider(client=client) if client else get_provider()
+
+            os.environ[SECRET_VALUE_ENV_VAR] = get_secret_values(
+                [secret_arn],
+                provider=provider,
+            )[secret_arn]
 
-            os.environ[SECRET_VALUE_ENV_VAR] = r['SecretString']
-        
         else:
             log.info('## Secret value was already available in env vars\n')
 
     except (KeyError, ValueError) as e:
         raise GetSecretValueFailureException('Failed to extract secret') from e
 
-    except boto3.exceptions.Boto3Error as boto3exc:
-        log.error('Failed to retrieve secret from AWS SecretsManager\n')
-        raise boto3exc
-
     else:
         return json.loads(os.environ.get(SECRET_VALUE_ENV_VAR))
 
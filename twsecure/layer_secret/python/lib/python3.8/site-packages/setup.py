@@ -4,7 +4,8 @@ setup(
     name='secret-helpers',
     version='0.1',
     py_modules=['secret'],
-    install_requires=[
-        'boto3>=1.16.30',
-    ],
+    extras_require={
+        # Only needed by the SecretsManager ("aws") provider
+        'aws': ['boto3>=1.33.0'],
+    },
 )
\ No newline at end of file
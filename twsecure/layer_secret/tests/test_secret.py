@@ -0,0 +1,182 @@
+#!/usr/bin/python3 Python3
+import json
+import os
+import subprocess
+import sys
+from unittest import mock
+
+import pytest
+
+import secret
+from secret import (
+    aws_provider,
+    env_provider,
+    env_var_name,
+    file_provider,
+    get_provider,
+    get_secret,
+    get_secret_values,
+    get_secrets,
+    GetSecretValueFailureException,
+    SECRET_VALUE_ENV_VAR,
+    UnknownSecretProviderException,
+)
+
+
+@pytest.fixture
+def secret_arn():
+    return 'arn:aws:secretsmanager:us-east-1:123:secret:dummy-secret'
+
+
+@pytest.fixture
+def secret_value():
+    return {'api_token': 'dummy-token'}
+
+
+def test_aws_provider_single_secret(secret_arn, secret_value):
+    client = mock.Mock()
+    client.get_secret_value.return_value = {
+        'SecretString': json.dumps(secret_value),
+    }
+
+    provider = aws_provider(client=client)
+
+    values = provider.get_secret_values([secret_arn, secret_arn])
+
+    assert provider.name == 'aws'
+    assert values == {secret_arn: json.dumps(secret_value)}
+    client.get_secret_value.assert_called_once_with(SecretId=secret_arn)
+    client.batch_get_secret_value.assert_not_called()
+
+
+def test_secretsmanager_client_without_common_layer():
+    '''Without the common layer, the secret layer creates its own client'''
+    boto3 = mock.Mock()
+
+    with mock.patch.dict(sys.modules, {'aws_clients': None, 'boto3': boto3}):
+        client = secret.secretsmanager_client()
+
+    assert client is boto3.client.return_value
+    boto3.client.assert_called_once_with('secretsmanager')
+
+
+def test_aws_provider_batched_secrets():
+    secret_ids = ['arn:secret:a', 'arn:secret:b', 'secret-c-name']
+
+    client = mock.Mock()
+    client.batch_get_secret_value.return_value = {
+        'SecretValues': [
+            {'ARN': 'arn:secret:a', 'Name': 'a', 'SecretString': 'A'},
+            {'ARN': 'arn:secret:b', 'Name': 'b', 'SecretString': 'B'},
+            {'ARN': 'arn:secret:c', 'Name': 'secret-c-name', 'SecretString': 'C'},  # NOQA
+        ],
+        'Errors': [],
+    }
+
+    values = aws_provider(client=client).get_secret_values(secret_ids)
+
+    assert values == {
+        'arn:secret:a': 'A',
+        'arn:secret:b': 'B',
+        'secret-c-name': 'C',
+    }
+    client.batch_get_secret_value.assert_called_once_with(
+        SecretIdList=secret_ids,
+    )
+    client.get_secret_value.assert_not_called()
+
+    # Batches are split according to the API limits
+    client.reset_mock()
+    client.get_secret_value.return_value = {'SecretString': 'C'}
+
+    aws_provider(client=client, batch_size=2).get_secret_values(secret_ids)
+
+    assert client.batch_get_secret_value.call_count == 1
+    client.get_secret_value.assert_called_once_with(SecretId=secret_ids[2])
+
+    # Errors reported by the batch API are raised
+    client.reset_mock()
+    client.batch_get_secret_value.return_value = {
+        'SecretValues': [],
+        'Errors': [{'SecretId': 'arn:secret:a', 'ErrorCode': 'Denied'}],
+    }
+
+    with pytest.raises(GetSecretValueFailureException):
+        aws_provider(client=client).get_secret_values(secret_ids)
+
+
+def test_file_provider(tmp_path, secret_arn, secret_value):
+    path = tmp_path / 'secrets.json'
+    path.write_text(json.dumps({
+        secret_arn: secret_value,
+        'plain-secret': 'plain-value',
+    }))
+
+    provider = file_provider(path=str(path))
+
+    assert provider.name == 'file'
+    assert provider.get_secret_values([secret_arn, 'plain-secret']) == {
+        secret_arn: json.dumps(secret_value),
+        'plain-secret': 'plain-value',
+    }
+
+    with pytest.raises(GetSecretValueFailureException):
+        get_secret_values(['missing-secret'], provider=provider)
+
+
+def test_env_provider(secret_arn, secret_value):
+    prefix = 'DUMMY_SECRET_'
+    env_vars = {
+        env_var_name(secret_arn, prefix=prefix): json.dumps(secret_value),
+    }
+
+    assert list(env_vars.keys())[0] == \
+        'DUMMY_SECRET_ARN_AWS_SECRETSMANAGER_US_EAST_1_123_SECRET_DUMMY_SECRET'
+
+    with mock.patch.dict(os.environ, env_vars):
+        provider = env_provider(prefix=prefix)
+
+        assert provider.name == 'env'
+        assert get_secret(secret_arn, provider=provider) == secret_value
+        assert get_secret(secret_arn, load_json=False, provider=provider) == \
+            json.dumps(secret_value)
+
+        with pytest.raises(GetSecretValueFailureException):
+            get_secret('missing-secret', provider=provider)
+
+
+def test_get_provider():
+    assert get_provider(name='env').name == 'env'
+    assert get_provider(name='file', path='dummy.json').name == 'file'
+    assert get_provider(name='aws', client=mock.Mock()).name == 'aws'
+
+    with pytest.raises(UnknownSecretProviderException):
+        get_provider(name='unknown')
+
+
+def test_get_secrets_env_memoization(secret_arn, secret_value):
+    get_values = mock.Mock(return_value={secret_arn: json.dumps(secret_value)})
+    provider = secret.secret_provider(name='dummy', get_secret_values=get_values)  # NOQA
+
+    with mock.patch.dict(os.environ, {}):
+        os.environ.pop(SECRET_VALUE_ENV_VAR, None)
+
+        assert get_secrets(secret_arn, provider=provider) == secret_value
+        assert get_secrets(secret_arn, provider=provider) == secret_value
+
+    get_values.assert_called_once_with([secret_arn])
+
+
+def test_no_boto3_import_for_local_providers():
+    code = (
+        'import sys, secret; '
+        'secret.get_provider(name="env"); '
+        'sys.exit(int("boto3" in sys.modules))'
+    )
+
+    result = subprocess.run(
+        [sys.executable, '-c', code],
+        env={**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)},
+    )
+
+    assert result.returncode == 0
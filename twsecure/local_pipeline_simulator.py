@@ -0,0 +1,549 @@
+#!/.env/bin/python Python3
+'''End-to-end local simulation of the monitor and notifier pipeline
+
+Both Lambda handlers run in-process: the monitor polls the local Transferwise
+stub and writes to a local transactions table, whose stream emits INSERT
+batches (with a batching window and at-least-once redelivery) to the
+notifier, which alerts through the local Twilio stub. Secrets are served by
+the "env" secret provider.
+
+Reports throughput and p50/p99 latencies from a transaction being detected
+(written to the table) and created (appearing in the statement) to alerted.
+'''
+import argparse
+from collections import deque, namedtuple
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+from unittest import mock
+
+from local_stub_servers import (
+    base_url,
+    latency_sampler,
+    start_stub_servers,
+    stub_config,
+    transaction_created_at,
+)
+
+
+log = logging.getLogger()
+logging.basicConfig(level=logging.INFO)
+
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+SOURCE_PATHS = [
+    os.path.join(ROOT_PATH, 'fn_monitor'),
+    os.path.join(ROOT_PATH, 'fn_notifier'),
+    os.path.join(ROOT_PATH, 'layer_dynamodb/python/lib/python3.8/site-packages'),  # NOQA
+    os.path.join(ROOT_PATH, 'layer_secret/python/lib/python3.8/site-packages'),  # NOQA
+    os.path.join(ROOT_PATH, 'layer_common/python/lib/python3.8/site-packages'),  # NOQA
+]
+
+TABLE_NAME = 'transferwise-transactions-simulation'
+STREAM_ARN = 'arn:aws:dynamodb:us-east-1:000000000000:table/{table_name}' \
+    '/stream/2020-01-01T00:00:00.000'
+MONITOR_SECRET_ARN = 'arn:aws:secretsmanager:local:secret:transferwise'
+NOTIFIER_SECRET_ARN = 'arn:aws:secretsmanager:local:secret:twilio'
+PAYEE_PREFIX = 'Sim Merchant'
+
+simulation_config = namedtuple('simulation_config', [
+    'profiles',
+    'accounts',
+    'currencies',
+    'transaction_rate',  # New debits per second in each statement
+    'duration',  # Seconds during which the monitor keeps polling
+    'monitor_interval',  # Seconds between monitor invocations
+    'batch_size',  # Maximum stream records per notifier invocation
+    'batching_window',  # Seconds the stream waits to fill a batch
+    'redelivery_rate',  # Probability of a processed batch being redelivered
+    'latency_ms',  # Mean stub API latency
+    'latency_distribution',
+    'throttle_rate',  # Probability of a stub answering with a 429
+    'write_budget',  # New transactions stored per monitor run (0: all)
+    'seed',
+])
+
+local_table = namedtuple('local_table', 'client stream')
+local_stream = namedtuple('local_stream', 'next_batch redeliver pending')
+
+
+def local_dynamodb(
+    table_name: str = TABLE_NAME,
+    now: Callable = time.time,
+) -> local_table:
+    '''In-memory transactions table emitting stream-shaped INSERT records'''
+    items = {}
+    records = deque()
+    lock = threading.Condition()
+    sequence = {'number': 0}
+    stream_arn = STREAM_ARN.format(table_name=table_name)
+
+    def batch_get_item(RequestItems: dict) -> dict:
+        keys = RequestItems[table_name]['Keys']
+
+        with lock:
+            found = [
+                items[key['transaction-hash']['S']]
+                for key in keys
+                if key['transaction-hash']['S'] in items
+            ]
+
+        return {'Responses': {table_name: found}, 'UnprocessedKeys': {}}
+
+    def batch_write_item(RequestItems: dict) -> dict:
+        with lock:
+            for request in RequestItems[table_name]:
+                item = request['PutRequest']['Item']
+                key = item['transaction-hash']['S']
+                is_new = key not in items
+                items[key] = item
+
+                if not is_new:
+                    continue
+
+                sequence['number'] += 1
+                records.append({
+                    'eventID': f'event-{sequence["number"]}',
+                    'eventName': 'INSERT',
+                    'eventSource': 'aws:dynamodb',
+                    'eventSourceARN': stream_arn,
+                    'dynamodb': {
+                        'ApproximateCreationDateTime': now(),
+                        'Keys': {'transaction-hash': {'S': key}},
+                        'NewImage': item,
+                        'SequenceNumber': str(sequence['number']).zfill(21),
+                        'StreamViewType': 'NEW_IMAGE',
+                    },
+                })
+
+            lock.notify_all()
+
+        return {'UnprocessedItems': {}}
+
+    def next_batch(
+        batch_size: int,
+        batching_window: float,
+        timeout: float,
+    ) -> Optional[dict]:
+        '''Wait for records, then for the batch to fill or the window to end'''
+        deadline = time.monotonic() + timeout
+
+        with lock:
+            while not records:
+                remaining_time = deadline - time.monotonic()
+
+                if remaining_time <= 0:
+                    return None
+
+                lock.wait(timeout=remaining_time)
+
+            window_end = time.monotonic() + batching_window
+
+            while len(records) < batch_size and time.monotonic() < window_end:
+                lock.wait(timeout=window_end - time.monotonic())
+
+            batch = [
+                records.popleft()
+                for _ in range(0, min(batch_size, len(records)))
+            ]
+
+        return {'Records': batch}
+
+    def redeliver(batch: List[dict]) -> None:
+        '''Put records back at the head of the shard, keeping their order'''
+        with lock:
+            records.extendleft(reversed(batch))
+            lock.notify_all()
+
+    def pending() -> int:
+        with lock:
+            return len(records)
+
+    client = SimpleNamespace(
+        batch_get_item=batch_get_item,
+        batch_write_item=batch_write_item,
+    )
+
+    return local_table(
+        client=client,
+        stream=local_stream(
+            next_batch=next_batch,
+            redeliver=redeliver,
+            pending=pending,
+        ),
+    )
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    '''Nearest-rank percentile'''
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def setup_environment(
+    transferwise_url: str,
+    twilio_url: str,
+    table_name: str = TABLE_NAME,
+    write_budget: int = 0,
+    state_dir: Optional[str] = None,
+) -> None:
+    '''Point both functions at the local stand-ins, before importing them'''
+    # Read by the secret layer when it is first imported
+    os.environ['SECRET_PROVIDER'] = 'env'
+
+    from secret import env_var_name
+
+    os.environ.update({
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'SECRET_ARN': MONITOR_SECRET_ARN,
+        'TRANSACTIONS_TABLE_NAME': table_name,
+        'TIME_DELTA_UNIT': 'hours',
+        'TIME_DELTA_VALUE': '24',
+        'SEND_SMS_TO_PHONE_NUMBER': '+15550000001',
+        'TRANSFERWISE_API_BASE_URI': transferwise_url,
+        'TWILIO_API_BASE_URL': twilio_url,
+        'MAX_NEW_TRANSACTIONS_PER_EXECUTION': str(write_budget),
+        env_var_name(MONITOR_SECRET_ARN): json.dumps({
+            'api_token': 'local-transferwise-token',
+        }),
+        env_var_name(NOTIFIER_SECRET_ARN): json.dumps({
+            'phone_number': '+15550000000',
+            'account_id': 'ACLOCAL',
+            'api_token': 'local-twilio-token',
+        }),
+    })
+
+    for variable in ['STATE_TABLE_NAME', 'ALERT_COALESCE_WINDOW_SECONDS']:
+        os.environ.pop(variable, None)
+
+    # Without a state table, the monitor backlog and checkpoint are local files
+    if state_dir is not None:
+        os.environ['BACKLOG_SPILL_PATH'] = os.path.join(
+            state_dir, 'backlog.json')
+        os.environ['CHECKPOINT_PATH'] = os.path.join(
+            state_dir, 'checkpoint.json')
+
+
+def run_monitor_loop(
+    monitor_handler: Callable,
+    config: simulation_config,
+    stop_at: float,
+    errors: List[str],
+) -> int:
+    invocations = 0
+
+    while time.monotonic() < stop_at:
+        started_at = time.monotonic()
+
+        try:
+            monitor_handler({}, None)
+        except Exception as exc:
+            errors.append(f'monitor: {exc!r}')
+
+        invocations += 1
+        elapsed = time.monotonic() - started_at
+        time.sleep(max(config.monitor_interval - elapsed, 0))
+
+    return invocations
+
+
+def run_stream_loop(
+    notifier_handler: Callable,
+    table: local_table,
+    config: simulation_config,
+    stop_event: threading.Event,
+    alerts: Dict[str, float],
+    rng: random.Random,
+    stats: dict,
+    errors: List[str],
+) -> None:
+    '''Lambda event source mapping stand-in'''
+    while not (stop_event.is_set() and table.stream.pending() == 0):
+        event = table.stream.next_batch(
+            batch_size=config.batch_size,
+            batching_window=config.batching_window,
+            timeout=0.1,
+        )
+
+        if event is None:
+            continue
+
+        stats['invocations'] += 1
+        stats['records'] += len(event['Records'])
+
+        try:
+            response = notifier_handler(event, None)
+        except Exception as exc:
+            # The whole batch is retried, as Lambda does for failed invocations
+            errors.append(f'notifier: {exc!r}')
+            table.stream.redeliver(event['Records'])
+            continue
+
+        alerted_at = time.time()
+        failed = {
+            failure['itemIdentifier']
+            for failure in response.get('batchItemFailures', [])
+        }
+
+        # Lambda resumes from the first failed record, included
+        retry_from = next(
+            (
+                i for i, record in enumerate(event['Records'])
+                if record['dynamodb']['SequenceNumber'] in failed
+            ),
+            len(event['Records']),
+        )
+
+        for record in event['Records'][0:retry_from]:
+            key = record['dynamodb']['Keys']['transaction-hash']['S']
+            alerts.setdefault(key, alerted_at)
+
+        if retry_from < len(event['Records']):
+            stats['failed_records'] += len(event['Records']) - retry_from
+            table.stream.redeliver(event['Records'][retry_from:])
+
+        elif rng.random() < config.redelivery_rate:
+            # At-least-once delivery: the same batch shows up again
+            stats['redelivered_records'] += len(event['Records'])
+            table.stream.redeliver(event['Records'])
+
+
+def simulation_report(
+    table: local_table,
+    alerts: Dict[str, float],
+    stub: stub_config,
+    started_at: float,
+    finished_at: float,
+    stats: dict,
+) -> dict:
+    # Importable once the source paths are set up, like the handlers
+    from details_codec import decode_details
+
+    detect_latencies = []
+    create_latencies = []
+
+    for record in stats['stream_records']:
+        key = record['dynamodb']['Keys']['transaction-hash']['S']
+
+        if key not in alerts:
+            continue
+
+        detected_at = record['dynamodb']['ApproximateCreationDateTime']
+        details = decode_details(record['dynamodb']['NewImage']['details'])
+        index = int(details['payee'].rsplit('-', 1)[1])
+
+        detect_latencies.append(alerts[key] - detected_at)
+
+        created_at = transaction_created_at(stub, index)
+
+        # Debits present before the simulation started have no creation time
+        if created_at > stub.started_at:
+            create_latencies.append(alerts[key] - created_at)
+
+    elapsed = finished_at - started_at
+
+    def latency_summary(values: List[float]) -> dict:
+        return {
+            'count': len(values),
+            'p50_ms': round((percentile(values, 50) or 0) * 1000, 1),
+            'p99_ms': round((percentile(values, 99) or 0) * 1000, 1),
+            'max_ms': round(max(values, default=0) * 1000, 1),
+        }
+
+    return {
+        'elapsed_seconds': round(elapsed, 2),
+        'transactions_detected': len(stats['stream_records']),
+        'transactions_alerted': len(alerts),
+        'throughput_alerts_per_second': round(len(alerts) / elapsed, 2),
+        'monitor_invocations': stats['monitor_invocations'],
+        'notifier_invocations': stats['invocations'],
+        'stream_records_delivered': stats['records'],
+        'stream_records_failed': stats['failed_records'],
+        'stream_records_redelivered': stats['redelivered_records'],
+        'detected_to_alerted': latency_summary(detect_latencies),
+        'created_to_alerted': latency_summary(create_latencies),
+        'transferwise_api': dict(stats['transferwise_stats']),
+        'twilio_api': dict(stats['twilio_stats']),
+        'errors': stats['errors'][0:10],
+    }
+
+
+def run_simulation(config: simulation_config) -> dict:
+    rng = random.Random(config.seed)
+
+    stub = stub_config(
+        profiles=config.profiles,
+        accounts=config.accounts,
+        currencies=config.currencies,
+        transactions=0,
+        latency=latency_sampler(
+            distribution=config.latency_distribution,
+            mean_ms=config.latency_ms,
+            rng=random.Random(config.seed),
+        ),
+        throttle_rate=config.throttle_rate,
+        max_rps=0,
+        payee_prefix=PAYEE_PREFIX,
+        transaction_rate=config.transaction_rate,
+        started_at=time.time(),
+    )
+
+    servers = start_stub_servers(
+        config=stub,
+        transferwise_port=0,
+        twilio_port=0,
+        seed=config.seed,
+    )
+
+    sys.path[0:0] = SOURCE_PATHS
+
+    setup_environment(
+        transferwise_url=base_url(servers.transferwise),
+        twilio_url=base_url(servers.twilio),
+        write_budget=config.write_budget,
+        state_dir=tempfile.mkdtemp(prefix='twsecure-simulation-'),
+    )
+
+    logging.getLogger('twilio').setLevel(logging.WARNING)
+
+    # The monitor reads SECRET_ARN when imported, the notifier on each call
+    from monitor import handler as monitor_handler
+    os.environ['SECRET_ARN'] = NOTIFIER_SECRET_ARN
+    from notifier import handler as notifier_handler
+
+    table = local_dynamodb()
+    stream_records = []
+
+    # Keep every record emitted by the stream, to measure latencies
+    next_batch = table.stream.next_batch
+    seen_records = set()
+
+    def recording_next_batch(**kwargs) -> Optional[dict]:
+        event = next_batch(**kwargs)
+
+        for record in (event or {}).get('Records', []):
+            if record['eventID'] not in seen_records:
+                seen_records.add(record['eventID'])
+                stream_records.append(record)
+
+        return event
+
+    table = table._replace(stream=table.stream._replace(
+        next_batch=recording_next_batch))
+
+    def local_boto3_client(service_name, *args, **kwargs):
+        if service_name != 'dynamodb':
+            raise RuntimeError(f'No local stand-in for "{service_name}"')
+
+        return table.client
+
+    alerts = {}
+    errors = []
+    stats = {
+        'invocations': 0,
+        'records': 0,
+        'failed_records': 0,
+        'redelivered_records': 0,
+    }
+    stop_event = threading.Event()
+    started_at = time.monotonic()
+
+    # Handlers print every event and response: keep the report readable
+    with mock.patch('boto3.client', side_effect=local_boto3_client), \
+            contextlib.redirect_stdout(io.StringIO()):
+        stream_thread = threading.Thread(
+            target=run_stream_loop,
+            kwargs={
+                'notifier_handler': notifier_handler,
+                'table': table,
+                'config': config,
+                'stop_event': stop_event,
+                'alerts': alerts,
+                'rng': rng,
+                'stats': stats,
+                'errors': errors,
+            },
+            daemon=True,
+        )
+        stream_thread.start()
+
+        stats['monitor_invocations'] = run_monitor_loop(
+            monitor_handler=monitor_handler,
+            config=config,
+            stop_at=started_at + config.duration,
+            errors=errors,
+        )
+
+        # Let the stream drain what the last monitor runs detected
+        stop_event.set()
+        stream_thread.join(timeout=config.duration + 30)
+
+    finished_at = time.monotonic()
+
+    stats.update({
+        'stream_records': stream_records,
+        'transferwise_stats': servers.transferwise.stats,
+        'twilio_stats': servers.twilio.stats,
+        'errors': errors,
+    })
+
+    servers.stop()
+
+    return simulation_report(
+        table=table,
+        alerts=alerts,
+        stub=stub,
+        started_at=started_at,
+        finished_at=finished_at,
+        stats=stats,
+    )
+
+
+def parse_args(args: Optional[list] = None) -> simulation_config:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+
+    parser.add_argument('--profiles', type=int, default=2)
+    parser.add_argument('--accounts', type=int, default=1)
+    parser.add_argument('--currencies', type=int, default=2)
+    parser.add_argument('--transaction-rate', type=float, default=0.5,
+                        help='New debits per second in each statement')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--monitor-interval', type=float, default=1)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--batching-window', type=float, default=0.2)
+    parser.add_argument('--redelivery-rate', type=float, default=0.1)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--latency-distribution', default='lognormal',
+                        choices=['fixed', 'uniform', 'exponential',
+                                 'lognormal'])
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--write-budget', type=int, default=0,
+                        help='New transactions stored per monitor run, the '
+                        'others being backlogged (default: all)')
+    parser.add_argument('--seed', type=int, default=None)
+
+    namespace = parser.parse_args(args)
+
+    return simulation_config(**{
+        field: getattr(namespace, field)
+        for field in simulation_config._fields
+    })
+
+
+if __name__ == '__main__':
+    report = run_simulation(parse_args())
+
+    print(json.dumps(report, indent=2))
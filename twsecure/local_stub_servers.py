@@ -0,0 +1,520 @@
+#!/.env/bin/python Python3
+'''Local HTTP stand-ins for the Transferwise and Twilio APIs
+
+Serve realistic payloads over real sockets, so that the monitor and notifier
+HTTP clients (connection reuse, timeouts, retries on throttling) can be
+exercised and benchmarked offline. Point the functions at them with:
+
+    TRANSFERWISE_API_BASE_URI=http://localhost:8081
+    TWILIO_API_BASE_URL=http://localhost:8082
+
+Request, connection and throttling counters are served at "/__stats".
+'''
+import argparse
+from collections import Counter, namedtuple
+import datetime
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlparse
+import uuid
+
+
+log = logging.getLogger()
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_TRANSFERWISE_PORT = 8081
+DEFAULT_TWILIO_PORT = 8082
+
+stub_config = namedtuple('stub_config', [
+    'profiles',  # Number of profiles
+    'accounts',  # Borderless accounts per profile
+    'currencies',  # Currency balances per account
+    'transactions',  # Debit transactions per statement
+    'latency',  # Callable returning a response delay in seconds
+    'throttle_rate',  # Probability of answering any request with a 429
+    'max_rps',  # Requests per second above which a 429 is returned
+    'payee_prefix',  # Prefix of generated payee names
+    'transaction_rate',  # New debits per second in each statement
+    'started_at',  # Epoch timestamp new debits are counted from
+], defaults=[0, 0])
+
+stub_servers = namedtuple('stub_servers', 'transferwise twilio stop')
+
+STATEMENT_URI = re.compile(
+    r'^/v3/profiles/(?P<profile_id>\d+)/borderless-accounts/'
+    r'(?P<account_id>\d+)/statement\.json$'
+)
+MESSAGES_URI = re.compile(
+    r'^/2010-04-01/Accounts/(?P<sid>\w+)/Messages\.json$')
+ACCOUNT_URI = re.compile(r'^/2010-04-01/Accounts/(?P<sid>\w+)\.json$')
+
+CURRENCIES = ['USD', 'EUR', 'GBP', 'BRL', 'JPY', 'AUD', 'CAD', 'CHF']
+
+
+def latency_sampler(
+    distribution: str = 'fixed',
+    mean_ms: float = 0,
+    sigma: float = 0.5,
+    rng: Optional[random.Random] = None,
+) -> Callable:
+    '''Response delay generator, in seconds
+
+    Distributions: "fixed", "uniform" (0 to twice the mean), "exponential" or
+    "lognormal" (with the given sigma, a long tail for p99 studies).
+    '''
+    rng = rng or random.Random()
+    mean = mean_ms / 1000
+
+    if mean <= 0:
+        return lambda: 0
+
+    if distribution == 'fixed':
+        return lambda: mean
+
+    if distribution == 'uniform':
+        return partial(rng.uniform, 0, 2 * mean)
+
+    if distribution == 'exponential':
+        return partial(rng.expovariate, 1 / mean)
+
+    if distribution == 'lognormal':
+        # Parametrized so that the distribution mean is the requested one
+        mu = math.log(mean) - sigma ** 2 / 2
+        return partial(rng.lognormvariate, mu, sigma)
+
+    raise ValueError(f'Unknown latency distribution "{distribution}"')
+
+
+def stub_profiles(config: stub_config) -> list:
+    return [
+        {
+            'id': 1000 + p,
+            'type': 'personal' if p % 2 == 0 else 'business',
+            'details': {'firstName': f'Profile{p} Stub'} if p % 2 == 0 else
+            {'name': f'Business{p} Stub Ltd'},
+        }
+        for p in range(0, config.profiles)
+    ]
+
+
+def stub_accounts(config: stub_config, profile_id: int) -> list:
+    return [
+        {
+            'id': profile_id * 100 + a,
+            'profileId': profile_id,
+            'active': True,
+            'balances': [
+                {
+                    'currency': CURRENCIES[c % len(CURRENCIES)],
+                    'amount': {
+                        'value': 1000.0,
+                        'currency': CURRENCIES[c % len(CURRENCIES)],
+                    },
+                }
+                for c in range(0, config.currencies)
+            ],
+        }
+        for a in range(0, config.accounts)
+    ]
+
+
+def statement_size(config: stub_config, now: Callable = time.time) -> int:
+    '''Number of debits in each statement, growing with the transaction rate'''
+    if not config.transaction_rate:
+        return config.transactions
+
+    elapsed = max(now() - config.started_at, 0)
+
+    return config.transactions + int(elapsed * config.transaction_rate)
+
+
+def transaction_created_at(config: stub_config, index: int) -> float:
+    '''Epoch timestamp a debit appeared at (earlier for the initial ones)'''
+    if index < config.transactions or not config.transaction_rate:
+        return config.started_at
+
+    return config.started_at + \
+        (index - config.transactions + 1) / config.transaction_rate
+
+
+def parse_interval_bound(text: Optional[str]) -> Optional[float]:
+    '''Epoch timestamp of an ISO 8601 "intervalStart/End" query argument'''
+    if not text:
+        return None
+
+    return datetime.datetime.fromisoformat(
+        text.replace('Z', '+00:00')).timestamp()
+
+
+def in_interval(
+    created_at: float,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+) -> bool:
+    '''Whether a debit falls in [start, end), like consecutive statements'''
+    return (start is None or created_at >= start) and \
+        (end is None or created_at < end)
+
+
+def stub_statement(
+    config: stub_config,
+    profile_id: int,
+    account_id: int,
+    currency: str,
+    interval_start: Optional[str] = None,
+    interval_end: Optional[str] = None,
+) -> dict:
+    '''Statement with debits that are stable across calls (same hashes)
+
+    Only debits created within the requested interval are listed, so that
+    sliced or resumed fetches see each debit in exactly one statement.
+    '''
+    start = parse_interval_bound(interval_start)
+    end = parse_interval_bound(interval_end)
+
+    return {
+        'accountHolder': {'type': 'PERSONAL'},
+        'transactions': [
+            {
+                'type': 'DEBIT',
+                'date': datetime.datetime.utcfromtimestamp(
+                    transaction_created_at(config, t),
+                ).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                'amount': {
+                    'value': -round(1 + (account_id + t) % 97 + t / 100, 2),
+                    'currency': currency,
+                },
+                'details': {
+                    'type': 'CARD',
+                    'merchant': {
+                        'name': f'{config.payee_prefix} {account_id}-'
+                        f'{currency}-{t}',
+                    },
+                },
+                'referenceNumber': f'CARD-{account_id}-{currency}-{t}',
+            }
+            for t in range(0, statement_size(config))
+            if in_interval(transaction_created_at(config, t), start, end)
+        ],
+    }
+
+
+def twilio_message(sid: str, form: dict) -> dict:
+    now = datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S +0000')
+    body = form.get('Body', [''])[0]
+
+    return {
+        'sid': 'SM' + uuid.uuid4().hex,
+        'account_sid': sid,
+        'body': body,
+        'from': form.get('From', [''])[0],
+        'to': form.get('To', [''])[0],
+        'status': 'queued',
+        'num_segments': '1',
+        'direction': 'outbound-api',
+        'date_created': now,
+        'date_updated': now,
+        'error_code': None,
+        'error_message': None,
+        'uri': f'/2010-04-01/Accounts/{sid}/Messages.json',
+    }
+
+
+def throttler(config: stub_config, rng: random.Random) -> Callable:
+    '''Decide whether a request is answered with a 429'''
+    lock = threading.Lock()
+    window = {'second': 0, 'count': 0}
+
+    def is_throttled() -> bool:
+        if config.throttle_rate > 0 and rng.random() < config.throttle_rate:
+            return True
+
+        if not config.max_rps:
+            return False
+
+        with lock:
+            second = int(time.monotonic())
+
+            if window['second'] != second:
+                window.update({'second': second, 'count': 0})
+
+            window['count'] += 1
+
+            return window['count'] > config.max_rps
+
+    return is_throttled
+
+
+def stub_handler(
+    name: str,
+    routes: Callable,
+    config: stub_config,
+    stats: Counter,
+    is_throttled: Callable,
+) -> type:
+    '''Build a request handler class serving the routes of one API'''
+    stats_lock = threading.Lock()
+
+    def count(key: str) -> None:
+        with stats_lock:
+            stats[key] += 1
+
+    class StubRequestHandler(BaseHTTPRequestHandler):
+        # Keep-alive, so that client connection pooling can be observed
+        protocol_version = 'HTTP/1.1'
+        server_version = f'{name}Stub/1.0'
+
+        def setup(self):
+            super().setup()
+            count('connections')
+
+        def log_message(self, format, *args):
+            log.debug(f'## {name}: {format % args}')
+
+        def send_json(self, status: int, payload, headers: dict = {}):
+            data = json.dumps(payload).encode('utf-8')
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+
+            for header, value in headers.items():
+                self.send_header(header, value)
+
+            self.end_headers()
+            self.wfile.write(data)
+
+            count(f'status_{status}')
+
+            with stats_lock:
+                stats['response_bytes'] += len(data)
+
+        def handle_request(self, method: str):
+            url = urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length).decode('utf-8') if length else ''
+
+            if url.path == '/__stats':
+                return self.send_json(200, dict(stats))
+
+            count('requests')
+            time.sleep(config.latency())
+
+            if is_throttled():
+                return self.send_json(429, {
+                    'code': 20429,
+                    'message': 'Too Many Requests',
+                    'status': 429,
+                }, headers={'Retry-After': '1'})
+
+            status, payload = routes(
+                method=method,
+                path=url.path,
+                query=parse_qs(url.query),
+                form=parse_qs(body),
+            )
+
+            self.send_json(status, payload)
+
+        def do_GET(self):
+            self.handle_request('GET')
+
+        def do_POST(self):
+            self.handle_request('POST')
+
+    return StubRequestHandler
+
+
+def transferwise_routes(
+    config: stub_config,
+    method: str,
+    path: str,
+    query: dict,
+    form: dict,
+) -> tuple:
+    if method == 'GET' and path == '/v1/profiles':
+        return 200, stub_profiles(config)
+
+    if method == 'GET' and path == '/v1/borderless-accounts':
+        profile_id = int(query.get('profileId', ['0'])[0])
+        return 200, stub_accounts(config, profile_id=profile_id)
+
+    match = STATEMENT_URI.match(path)
+
+    if method == 'GET' and match:
+        return 200, stub_statement(
+            config,
+            profile_id=int(match['profile_id']),
+            account_id=int(match['account_id']),
+            currency=query.get('currency', ['USD'])[0],
+            interval_start=query.get('intervalStart', [None])[0],
+            interval_end=query.get('intervalEnd', [None])[0],
+        )
+
+    return 404, {'error': 'not_found', 'path': path}
+
+
+def twilio_routes(
+    config: stub_config,
+    method: str,
+    path: str,
+    query: dict,
+    form: dict,
+) -> tuple:
+    match = MESSAGES_URI.match(path)
+
+    if method == 'POST' and match:
+        return 201, twilio_message(sid=match['sid'], form=form)
+
+    match = ACCOUNT_URI.match(path)
+
+    if method == 'GET' and match:
+        return 200, {'sid': match['sid'], 'status': 'active'}
+
+    return 404, {'code': 20404, 'message': 'Not found', 'status': 404}
+
+
+def serve(
+    name: str,
+    routes: Callable,
+    config: stub_config,
+    port: int,
+    host: str = 'localhost',
+    seed: Optional[int] = None,
+) -> ThreadingHTTPServer:
+    '''Start a stub server in a background thread'''
+    stats = Counter()
+    handler = stub_handler(
+        name=name,
+        routes=partial(routes, config),
+        config=config,
+        stats=stats,
+        is_throttled=throttler(config, rng=random.Random(seed)),
+    )
+
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.stats = stats
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    log.info(f'## {name} stub listening on '
+             f'http://{host}:{server.server_address[1]}')
+
+    return server
+
+
+def start_stub_servers(
+    config: stub_config,
+    transferwise_port: int = DEFAULT_TRANSFERWISE_PORT,
+    twilio_port: int = DEFAULT_TWILIO_PORT,
+    twilio_config: Optional[stub_config] = None,
+    seed: Optional[int] = None,
+) -> stub_servers:
+    '''Start both stub servers; port 0 picks a free port'''
+    transferwise = serve(
+        name='Transferwise',
+        routes=transferwise_routes,
+        config=config,
+        port=transferwise_port,
+        seed=seed,
+    )
+    twilio = serve(
+        name='Twilio',
+        routes=twilio_routes,
+        config=twilio_config or config,
+        port=twilio_port,
+        seed=seed,
+    )
+
+    def stop():
+        for server in (transferwise, twilio):
+            server.shutdown()
+            server.server_close()
+
+    return stub_servers(transferwise=transferwise, twilio=twilio, stop=stop)
+
+
+def base_url(server: ThreadingHTTPServer) -> str:
+    host, port = server.server_address[0:2]
+    return f'http://{host}:{port}'
+
+
+def parse_args(args: Optional[list] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+
+    parser.add_argument('--transferwise-port', type=int,
+                        default=DEFAULT_TRANSFERWISE_PORT)
+    parser.add_argument('--twilio-port', type=int, default=DEFAULT_TWILIO_PORT)
+    parser.add_argument('--profiles', type=int, default=2)
+    parser.add_argument('--accounts', type=int, default=1)
+    parser.add_argument('--currencies', type=int, default=2)
+    parser.add_argument('--transactions', type=int, default=5)
+    parser.add_argument('--transaction-rate', type=float, default=0,
+                        help='New debits per second in each statement')
+    parser.add_argument('--latency-distribution', default='fixed',
+                        choices=['fixed', 'uniform', 'exponential',
+                                 'lognormal'])
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--latency-sigma', type=float, default=0.5)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--max-rps', type=int, default=0)
+    parser.add_argument('--twilio-max-rps', type=int, default=0,
+                        help='Overrides --max-rps for the Twilio stub')
+    parser.add_argument('--seed', type=int, default=None)
+
+    return parser.parse_args(args)
+
+
+def config_from_args(args: argparse.Namespace) -> stub_config:
+    return stub_config(
+        profiles=args.profiles,
+        accounts=args.accounts,
+        currencies=args.currencies,
+        transactions=args.transactions,
+        latency=latency_sampler(
+            distribution=args.latency_distribution,
+            mean_ms=args.latency_ms,
+            sigma=args.latency_sigma,
+            rng=random.Random(args.seed),
+        ),
+        throttle_rate=args.throttle_rate,
+        max_rps=args.max_rps,
+        payee_prefix='Stub Merchant',
+        transaction_rate=args.transaction_rate,
+        started_at=time.time(),
+    )
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = config_from_args(args)
+
+    servers = start_stub_servers(
+        config=config,
+        transferwise_port=args.transferwise_port,
+        twilio_port=args.twilio_port,
+        twilio_config=config._replace(
+            max_rps=args.twilio_max_rps or args.max_rps),
+        seed=args.seed,
+    )
+
+    log.info('## Export these variables to use the stubs:')
+    log.info(f'TRANSFERWISE_API_BASE_URI={base_url(servers.transferwise)}')
+    log.info(f'TWILIO_API_BASE_URL={base_url(servers.twilio)}')
+
+    try:
+        while True:
+            time.sleep(3600)
+
+    except KeyboardInterrupt:
+        servers.stop()
@@ -0,0 +1,42 @@
+'''Cold-start regression check: importing a handler module must stay within
+its import-time budget, and leave the heavy packages to be imported on first
+use'''
+import os
+
+import pytest
+
+from import_budget import (
+    best_of,
+    DEFERRED_PACKAGES,
+    HANDLERS,
+    import_module,
+    imported_packages,
+    summarize,
+)
+
+
+# Allowance over the budget for noisy (shared) CI machines
+BUDGET_HEADROOM = float(os.environ.get('IMPORT_BUDGET_HEADROOM', 1.5))
+
+
+@pytest.mark.parametrize('name', sorted(HANDLERS))
+def test_deferred_packages(name):
+    spec = HANDLERS[name]
+
+    packages = imported_packages(spec.module, path=spec.path)
+
+    assert sorted(packages.intersection(DEFERRED_PACKAGES)) == []
+
+
+@pytest.mark.parametrize('name', sorted(HANDLERS))
+def test_import_budget(name):
+    spec = HANDLERS[name]
+
+    entries = best_of([
+        import_module(spec.module, path=spec.path)
+        for _ in range(3)
+    ])
+    summary = summarize(entries, module=spec.module)
+
+    assert summary['total_ms'] <= spec.budget_ms * BUDGET_HEADROOM, \
+        summary['slowest_cumulative']
@@ -0,0 +1,45 @@
+'''Smoke test of the local pipeline: every debit the monitor detects is
+alerted by the notifier, through the stub servers and local DynamoDB'''
+import json
+import os
+import subprocess
+import sys
+
+
+SIMULATOR_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The simulator sets up its environment and imports both handlers: it runs
+# in its own interpreter, not to leak them into other tests
+SIMULATION_SCRIPT = '''
+import json
+from local_pipeline_simulator import parse_args, run_simulation
+report = run_simulation(parse_args([
+    "--duration", "1.5",
+    "--transaction-rate", "10",
+    "--redelivery-rate", "0.5",
+    "--latency-ms", "5",
+    "--seed", "1",
+]))
+print(json.dumps(report))
+'''
+
+
+def run_simulation() -> dict:
+    result = subprocess.run(
+        [sys.executable, '-c', SIMULATION_SCRIPT],
+        cwd=SIMULATOR_PATH,
+        capture_output=True,
+        text=True,
+        timeout=60,
+        check=True,
+    )
+
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def test_run_simulation():
+    report = run_simulation()
+
+    assert report['errors'] == []
+    assert report['transactions_detected'] > 0
+    assert report['transactions_alerted'] == report['transactions_detected']
@@ -0,0 +1,106 @@
+import datetime
+import time
+
+import pytest
+
+from local_stub_servers import (
+    in_interval,
+    parse_interval_bound,
+    stub_config,
+    stub_statement,
+    transferwise_routes,
+)
+
+
+@pytest.fixture
+def config():
+    return stub_config(
+        profiles=1,
+        accounts=1,
+        currencies=1,
+        transactions=2,
+        latency=lambda: 0,
+        throttle_rate=0,
+        max_rps=0,
+        payee_prefix='Stub Merchant',
+        transaction_rate=1,
+        # Whole second, as the interval bounds of the monitor
+        started_at=float(int(time.time()) - 10),
+    )
+
+
+def iso(timestamp: float) -> str:
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime(
+        '%Y-%m-%dT%H:%M:%SZ')
+
+
+def test_parse_interval_bound():
+    assert parse_interval_bound(None) is None
+    assert parse_interval_bound('2020-09-13T12:26:40Z') == 1600000000
+    assert parse_interval_bound('2020-09-13T12:26:40.500Z') == 1600000000.5
+
+
+def test_in_interval():
+    assert in_interval(100) is True
+    assert in_interval(100, start=100, end=101) is True
+    assert in_interval(99, start=100) is False
+    # Consecutive intervals share their bound: it belongs to the later one
+    assert in_interval(101, start=100, end=101) is False
+
+
+def test_stub_statement_interval(config):
+    kwargs = {
+        'config': config,
+        'profile_id': 1000,
+        'account_id': 100000,
+        'currency': 'USD',
+    }
+
+    # Without an interval, every debit created so far: two initial ones,
+    # then one per second
+    assert len(stub_statement(**kwargs)['transactions']) >= 12
+
+    # Every debit is listed by exactly one of consecutive statements
+    bounds = [config.started_at + offset for offset in (0, 2, 4)]
+    sliced = [
+        t['referenceNumber']
+        for start, end in zip(bounds, bounds[1:])
+        for t in stub_statement(
+            interval_start=iso(start),
+            interval_end=iso(end),
+            **kwargs,
+        )['transactions']
+    ]
+
+    assert sliced == [
+        'CARD-100000-USD-0',
+        'CARD-100000-USD-1',
+        'CARD-100000-USD-2',
+        'CARD-100000-USD-3',
+        'CARD-100000-USD-4',
+    ]
+
+    # Nothing was created before the first debit
+    assert stub_statement(
+        interval_start=iso(config.started_at - 60),
+        interval_end=iso(config.started_at),
+        **kwargs,
+    )['transactions'] == []
+
+
+def test_transferwise_routes_statement_interval(config):
+    status, statement = transferwise_routes(
+        config,
+        method='GET',
+        path='/v3/profiles/1000/borderless-accounts/100000/statement.json',
+        query={
+            'currency': ['EUR'],
+            'intervalStart': [iso(config.started_at + 1)],
+            'intervalEnd': [iso(config.started_at + 2)],
+        },
+        form={},
+    )
+
+    assert status == 200
+    assert [t['referenceNumber'] for t in statement['transactions']] == \
+        ['CARD-100000-EUR-2']